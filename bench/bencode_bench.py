@@ -0,0 +1,41 @@
+"""
+Microbenchmark: single-pass Decoder vs the regex tokenizer in LocalTorrent
+
+usage: python -m bench.bencode_bench [files] [repeat]
+ builds a synthetic multi-file .torrent (files entries, 20 bytes of pieces per
+ file) and reports the best time per decode for each backend
+"""
+import sys, timeit
+
+from churada.bencode import Decoder
+from churada.torrent import LocalTorrent
+
+def bstr(s):
+    return "%d:%s" %(len(s),s)
+
+def torrent_gen(files):
+    entries = "".join("d6:lengthi%de4:pathl%s%see" %(1000+i,bstr("season"),bstr("episode_%05d.mkv" %(i)))
+                      for i in range(files))
+    info = ("d5:filesl%se4:name%s12:piece lengthi262144e6:pieces%s7:privatei1ee"
+            %(entries,bstr("pack"),bstr("\x01"*20*files)))
+    return "d8:announce%s13:creation datei1234e4:info%se" %(bstr("http://www.tracker.com/announce"),info)
+
+def tokenizer_decode(bencode):
+    src = LocalTorrent.tokenize(bencode)
+    return LocalTorrent.parse_bencode(src.next,src.next())
+
+def decoder_decode(bencode):
+    return Decoder(bencode,skip=('pieces',)).decode()
+
+def main(files=5000,repeat=5):
+    bencode = torrent_gen(files)
+    print "torrent: %d files, %.2f MiB" %(files,len(bencode)/float(1<<20))
+    results = {}
+    for label,func in [("tokenizer",tokenizer_decode),("decoder",decoder_decode)]:
+        best = min(timeit.repeat(lambda: func(bencode),number=1,repeat=repeat))
+        results[label] = best
+        print "%-10s %8.2f ms" %(label,best*1000)
+    print "speedup    %8.2fx" %(results['tokenizer']/results['decoder'])
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,64 @@
+"""
+Benchmark: choosing deletion candidates on a large seedbox
+
+usage: python -m bench.columns_bench [records] [repeat]
+ "records" sorts the RemoteTorrents by score and checks the delete rules one
+ record at a time until the space is covered; "columns" builds a RemoteColumns
+ snapshot once, masks by state and partially sorts the scores, checking the
+ rules only on the candidates it yields; "heap" walks the score heap kept by
+ a RemoteRecord (already built, as after a merge). Space is 1% of the total size.
+"""
+import sys, timeit
+
+from churada.columns import RemoteColumns
+from churada.record import RemoteRecord
+from churada.rule import Rule
+from churada.torrent import RemoteTorrent
+
+from bench.generators import info_gen
+
+rules = [Rule('state',lambda state: state == 'Seeding'),Rule('ratio',lambda ratio: ratio > 1)]
+
+def valid(rtor):
+    return reduce(lambda x,y: x and y.query(rtor),rules,True)
+
+def select(rtor_iter,space):
+    result = []
+    for rtor in rtor_iter:
+        if space <= 0:
+            break
+        if valid(rtor):
+            result.append(rtor)
+            space -= rtor.size
+    return result
+
+def by_records(rtors,space):
+    ordered = sorted(rtors,key=lambda rtor: getattr(rtor,'score',float('inf')))
+    return select(ordered,space)
+
+def by_columns(rtors,space):
+    columns = RemoteColumns(rtors)
+    return select(columns.delete_candidates(space,columns.state_mask('Seeding')),space)
+
+def main(records=10000,repeat=5):
+    rtors = RemoteTorrent.batch_parse(info_gen(records),12345)
+    space = sum(rtor.size for rtor in rtors)/100
+    columns = RemoteColumns(rtors)
+    record = RemoteRecord(None,backend=object())
+    record.merge(rtors)
+    record.iter_by_score().next()
+    print "%d records, %.1f GiB to free" %(len(rtors),space/float(1<<30))
+    backends = [("records",lambda: by_records(rtors,space)),
+                ("columns",lambda: by_columns(rtors,space)),
+                ("snapshot",lambda: select(columns.delete_candidates(space,columns.state_mask('Seeding')),space)),
+                ("heap",lambda: select(record.iter_by_score(),space))]
+    results = {}
+    for label,func in backends:
+        count = len(func())
+        results[label] = min(timeit.repeat(func,number=1,repeat=repeat))
+        print "%-10s %8.2f ms  (%d candidates)" %(label,results[label]*1000,count)
+    print "speedup    %8.2fx (%.2fx with the snapshot already built, %.2fx from the heap)" %(
+        results['records']/results['columns'],results['records']/results['snapshot'],results['records']/results['heap'])
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
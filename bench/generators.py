@@ -0,0 +1,24 @@
+from string import Template
+import hashlib
+
+# same record layout as test/generators.rtor_template, with units as printed by deluge-console
+info_template = Template("""Name: $name
+ID: $id
+State: $state Up Speed: $uspeed KiB/s
+Seeds: $cseed ($tseed) Peers: $cpeer ($tpeer) Availability: $avail
+Size: $csize GiB/$size GiB Ratio: $ratio
+Seed time: $sdays days 0$shours:15:42 Active: $adays days 0$ahours:09:22
+Tracker status: $tracker: Announce OK""")
+
+def info_gen(records):
+    return "\n".join(info_template.substitute(name="torrent_%06d" %(i),
+                                              id=hashlib.sha1(str(i)).hexdigest(),
+                                              state='Seeding' if i % 7 else 'Paused',
+                                              uspeed="%.1f" %(i % 500 / 10.0),
+                                              cseed=i % 13,tseed=i % 97,cpeer=i % 5,tpeer=i % 11,
+                                              avail="%.2f" %(i % 3),
+                                              csize="%.1f" %(1 + i % 40),size="%.1f" %(1 + i % 40),
+                                              ratio="%.3f" %(i % 1000 / 100.0),
+                                              sdays=i % 300,shours=i % 10,adays=i % 300 + 1,ahours=i % 10,
+                                              tracker="tracker%d.com" %(i % 4))
+                     for i in range(records))
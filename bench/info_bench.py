@@ -0,0 +1,33 @@
+"""
+Benchmark: parsing a deluge-console 'info' listing
+
+usage: python -m bench.info_bench [records] [repeat]
+ compares the regex parser (three passes over the listing, then a re.search
+ per record; kept in churada.core) with the single-pass InfoParser, both on
+ the whole listing and fed in 64 KiB chunks as it would arrive from SSH
+"""
+import sys, timeit
+
+from churada import core
+from churada.torrent import RemoteTorrent
+
+from bench.generators import info_gen
+
+def chunked(info,size=1<<16):
+    return (info[i:i+size] for i in xrange(0,len(info),size))
+
+def main(records=10000,repeat=3):
+    info = info_gen(records)
+    print "listing: %d records, %.2f MiB" %(records,len(info)/float(1<<20))
+    backends = [("regex",lambda: core.RemoteTorrent.batch_parse(info,12345)),
+                ("single-pass",lambda: RemoteTorrent.batch_parse(info,12345)),
+                ("streamed",lambda: list(RemoteTorrent.stream_parse(chunked(info),12345)))]
+    results = {}
+    for label,func in backends:
+        count = len(func())
+        results[label] = min(timeit.repeat(func,number=1,repeat=repeat))
+        print "%-12s %8.1f ms  (%d records)" %(label,results[label]*1000,count)
+    print "speedup      %8.2fx" %(results['regex']/results['single-pass'])
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,75 @@
+"""
+Benchmark: allocations made by iterating records during one cycle
+
+usage: python -m bench.iteration_bench [records] [seedboxes] [repeat]
+ A cycle walks the records the way Controller.populate (three passes over the
+ upload queue) and Seedbox.act, upload, download and delete (per seedbox) do.
+ "before" iterates over a copy of the record, as the records used to;
+ "after" iterates over the records themselves. Bytes are those of the objects
+ created to start each walk (the copy and its iterator, or the walk itself),
+ which are garbage as soon as the walk ends; times are per cycle.
+"""
+import sys, copy, timeit
+
+from churada.record import LocalRecord,RemoteRecord
+from churada.torrent import RemoteTorrent
+
+from bench.generators import info_gen
+
+class Item(object):
+    __slots__ = ('name','path','info_hash','size')
+    def __init__(self,i):
+        self.name = "torrent_%06d" %(i)
+        self.path = "/watch/%06d.torrent" %(i)
+        self.info_hash = "%040x" %(i)
+        self.size = 1 + i % 40
+
+class Walks(object):
+    def __init__(self,copied):
+        self.copied = copied
+        self.allocated = 0
+    def __call__(self,record):
+        if self.copied:
+            items = copy.copy(self.copied[record])
+            walk = iter(items)
+            self.allocated += sys.getsizeof(items) + sys.getsizeof(walk)
+        else:
+            walk = iter(record)
+            self.allocated += sys.getsizeof(walk)
+        return walk
+
+def cycle(walk,up_queue,info,seedboxes):
+    # Controller.populate: three passes over the upload queue
+    for i in range(0,3):
+        for ltor in walk(up_queue):
+            pass
+    for i in range(0,seedboxes):
+        # Seedbox.act: upload size; upload; download; delete (walked for 1% of the record)
+        for ltor in walk(up_queue):
+            pass
+        for ltor in walk(up_queue):
+            pass
+        for rtor in walk(info):
+            pass
+        for j,rtor in enumerate(walk(info)):
+            if j >= len(info)/100:
+                break
+
+def main(records=10000,seedboxes=2,repeat=5):
+    up_queue = LocalRecord(None)
+    up_queue.record = [Item(i) for i in range(records)]
+    info = RemoteRecord(None,backend=object())
+    info.merge(RemoteTorrent.batch_parse(info_gen(records),12345))
+    print "%d records, %d seedboxes" %(records,seedboxes)
+    print "%-8s %14s %12s" %("","bytes/cycle","ms/cycle")
+    # the plain lists the records used to be
+    lists = {up_queue:up_queue.record,info:info.record}
+    for label,copied in [("before",lists),("after",None)]:
+        walk = Walks(copied)
+        cycle(walk,up_queue,info,seedboxes)
+        allocated = walk.allocated
+        best = min(timeit.repeat(lambda: cycle(walk,up_queue,info,seedboxes),number=1,repeat=repeat))
+        print "%-8s %14d %12.2f" %(label,allocated,best*1000)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:4]])
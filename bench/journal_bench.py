@@ -0,0 +1,102 @@
+"""
+Benchmark: cost of journaling record mutations, and of restoring from the journal
+
+usage: python -m bench.journal_bench [records] [repeat]
+ "mutation" times adding then deleting every torrent of a LocalRecord and of a
+ RemoteRecord, without and with a StateJournal attached; the overhead is per
+ mutation (one add or one delete). "restore" times opening the journal and
+ attaching empty records, from the journal entries and from a snapshot;
+ LocalTorrents are rebuilt from their journaled fields, without parsing.
+"""
+import sys, os, shutil, tempfile, timeit
+
+from churada.journal import StateJournal
+from churada.record import LocalRecord,RemoteRecord
+from churada.torrent import LocalTorrent,RemoteTorrent
+
+from bench.generators import info_gen
+
+def bstr(s):
+    return "%d:%s" %(len(s),s)
+
+def tfile_gen(i):
+    return ("d8:announce%s4:infod6:lengthi%de4:name%s12:piece lengthi262144e6:pieces20:%see"
+            %(bstr("http://www.tracker.com/announce"),1000+i,bstr("torrent_%06d" %(i)),"\x01"*20))
+
+def churn(lrec,rrec,ltors,rtors):
+    for ltor in ltors:
+        lrec.ltor_add(ltor=ltor)
+    for rtor in rtors:
+        rrec.rtor_add(rtor=rtor)
+    for ltor in ltors:
+        lrec.ltor_del(ltor=ltor)
+    for rtor in rtors:
+        rrec.rtor_del(rtor=rtor)
+
+# restoring must not snapshot, or the next run would restore from the snapshot
+def restore(path):
+    journal = StateJournal(path,snapshot_every=sys.maxint)
+    lrec = LocalRecord(None)
+    rrec = RemoteRecord(None,backend=object())
+    journal.attach('up_queue',lrec)
+    journal.attach('down_queue',rrec)
+    journal.close()
+    return len(lrec) + len(rrec)
+
+def main(records=5000,repeat=3):
+    tmp = tempfile.mkdtemp()
+    try:
+        ltors = []
+        for i in range(records):
+            path = os.path.join(tmp,"%06d.torrent" %(i))
+            with open(path,'wb') as tfile:
+                tfile.write(tfile_gen(i))
+            ltors.append(LocalTorrent(path))
+        rtors = RemoteTorrent.batch_parse(info_gen(records),12345)
+        mutations = 4*records
+        print "%d records, %d mutations per run" %(records,mutations)
+        times = {}
+        for label,journaled in [("plain",False),("journaled",True)]:
+            def run():
+                path = os.path.join(tmp,'journal')
+                for name in (path,path + '.snapshot'):
+                    if os.path.exists(name):
+                        os.remove(name)
+                lrec = LocalRecord(None)
+                rrec = RemoteRecord(None,backend=object())
+                if journaled:
+                    journal = StateJournal(path,snapshot_every=10*mutations)
+                    journal.attach('up_queue',lrec)
+                    journal.attach('down_queue',rrec)
+                churn(lrec,rrec,ltors,rtors)
+                if journaled:
+                    journal.close()
+            times[label] = min(timeit.repeat(run,number=1,repeat=repeat))
+            print "%-10s %8.2f ms  %6.2f us/mutation" %(label,times[label]*1000,times[label]*1e6/mutations)
+        print "overhead   %8.2f us/mutation" %((times['journaled'] - times['plain'])*1e6/mutations)
+        # a journal holding every torrent, then the same state as a snapshot
+        path = os.path.join(tmp,'journal')
+        os.remove(path)
+        journal = StateJournal(path,snapshot_every=10*mutations)
+        lrec = LocalRecord(None)
+        rrec = RemoteRecord(None,backend=object())
+        journal.attach('up_queue',lrec)
+        journal.attach('down_queue',rrec)
+        for ltor in ltors:
+            lrec.ltor_add(ltor=ltor)
+        for rtor in rtors:
+            rrec.rtor_add(rtor=rtor)
+        journal.close()
+        for label in ("journal","snapshot"):
+            if label == "snapshot":
+                journal = StateJournal(path)
+                journal.snapshot()
+                journal.close()
+            best = min(timeit.repeat(lambda: restore(path),number=1,repeat=repeat))
+            print "restore from %-8s %8.2f ms  (%d torrents, %d KiB on disk)" %(label,best*1000,restore(path),
+                  sum(os.path.getsize(name) for name in (path,path + '.snapshot') if os.path.exists(name))/1024)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,70 @@
+"""
+Benchmark: reading a large command output from an SSH channel
+
+usage: python -m bench.reader_bench [MiB] [repeat]
+ A fake channel delivers the output in 32 KiB packets (paramiko's default
+ maximum packet size), as if the data were already in its buffer. "before" is
+ the loop Shell used to read with: 1 KiB reads appended with output += part.
+ "after" is ChannelReader.read. Calls counts the channel methods called, which
+ is what the old loop spun on while waiting for data.
+"""
+import sys, timeit
+
+from churada.shell import ChannelReader
+
+class Channel(object):
+    packet = 32768
+    def __init__(self,size):
+        self.data = ["x"*self.packet for i in range(0,size/self.packet)]
+        self.buffer = ""
+        self.eof_received = False
+        self.closed = False
+        self.calls = 0
+    def __arrive(self):
+        if not self.buffer and self.data:
+            self.buffer = self.data.pop()
+        self.eof_received = not self.buffer and not self.data
+    def exit_status_ready(self):
+        self.calls += 1
+        self.__arrive()
+        return self.eof_received
+    def recv_ready(self):
+        self.calls += 1
+        self.__arrive()
+        return bool(self.buffer)
+    def recv(self,size):
+        self.calls += 1
+        data,self.buffer = self.buffer[:size],self.buffer[size:]
+        return data
+    def recv_stderr_ready(self):
+        self.calls += 1
+        return False
+    def recv_exit_status(self):
+        return 0
+
+def before(channel):
+    output = ""
+    while not channel.exit_status_ready():
+        if channel.recv_ready():
+            part = channel.recv(1024)
+            while part:
+                output += part
+                part = channel.recv(1024)
+    return output
+
+def after(channel):
+    return ChannelReader(channel).read()[1]
+
+def main(mib=16,repeat=3):
+    size = mib << 20
+    print "%d MiB output" %(mib)
+    for label,read in [("before",before),("after",after)]:
+        channels = []
+        def run():
+            channels.append(Channel(size))
+            assert len(read(channels[-1])) == size
+        best = min(timeit.repeat(run,number=1,repeat=repeat))
+        print "%-8s %8.2f ms  %8d channel calls" %(label,best*1000,channels[-1].calls)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
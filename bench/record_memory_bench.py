@@ -0,0 +1,79 @@
+"""
+Memory benchmark: bytes per LocalTorrent/RemoteTorrent record
+
+usage: python -m bench.record_memory_bench [records]
+ "before" stores the same parsed fields the way the records used to,
+ in a per-instance __dict__ with a logger attribute; "after" is the
+ slotted record. Sizes are deep sizes of everything reachable from a
+ record that is not shared with other records (class, logger, interned keys).
+"""
+import sys, os, shutil, tempfile, logging
+
+from churada.torrent import LocalTorrent,RemoteTorrent
+
+from bench.generators import info_gen
+
+class Legacy:
+    def __init__(self,fields,logger):
+        self.__dict__.update(fields)
+        self.logger = logger
+
+def deep_size(obj,seen):
+    if id(obj) in seen or isinstance(obj,(type,logging.Logger)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj,dict):
+        size += sum(deep_size(k,seen) + deep_size(v,seen) for k,v in obj.iteritems())
+    elif isinstance(obj,(list,tuple,set,frozenset)):
+        size += sum(deep_size(e,seen) for e in obj)
+    elif hasattr(obj,'__dict__'):
+        size += deep_size(obj.__dict__,seen)
+    if hasattr(type(obj),'__slots__'):
+        size += sum(deep_size(getattr(obj,key),seen) for key in type(obj).__slots__ if hasattr(obj,key))
+    return size
+
+# the fields of a LocalTorrent as they used to be stored: files as a list of dicts
+def legacy_fields(ltor):
+    fields = ltor.fields()
+    if 'files' in fields:
+        fields['files'] = [{'length':length,'path':list(path)} for path,length in ltor.files]
+    return fields
+
+def per_record(records):
+    # keys and other interned strings are shared by every record: count them once
+    seen = set()
+    deep_size(records[0],seen)
+    return sum(deep_size(record,seen) for record in records[1:])/float(len(records)-1)
+
+def bstr(s):
+    return "%d:%s" %(len(s),s)
+
+def tfile_gen(i,files):
+    entries = "".join("d6:lengthi%de4:pathl%s%see" %(1000+j,bstr("dir"),bstr("file_%03d.ext" %(j))) for j in range(files))
+    return ("d8:announce%s10:created by%s13:creation datei%de7:comment%s4:infod5:filesl%se4:name%s"
+            "12:piece lengthi262144e6:pieces20:%s7:privatei1eee"
+            %(bstr("http://www.tracker.com/announce"),bstr("mktorrent 1.0"),1400000000+i,
+              bstr("uploaded by someone"),entries,bstr("torrent_%06d" %(i)),"\x01"*20))
+
+def main(records=2000,files=10):
+    tmp = tempfile.mkdtemp()
+    try:
+        ltors = []
+        for i in range(records):
+            path = os.path.join(tmp,"%06d.torrent" %(i))
+            with open(path,'wb') as tfile:
+                tfile.write(tfile_gen(i,files))
+            ltors.append(LocalTorrent(path))
+    finally:
+        shutil.rmtree(tmp)
+    rtors = RemoteTorrent.batch_parse(info_gen(records),12345)
+    logger = logging.getLogger("bench")
+    rtor_fields = [dict((key,getattr(r,key)) for key in RemoteTorrent.__slots__ if hasattr(r,key)) for r in rtors]
+    print "%d records, %d files per local torrent" %(records,files)
+    print "%-14s %10s %10s" %("bytes/record","before","after")
+    print "%-14s %10.0f %10.0f" %("LocalTorrent",per_record([Legacy(legacy_fields(l),logger) for l in ltors]),per_record(ltors))
+    print "%-14s %10.0f %10.0f" %("RemoteTorrent",per_record([Legacy(f,logger) for f in rtor_fields]),per_record(rtors))
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
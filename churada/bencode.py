@@ -0,0 +1,125 @@
+import re
+
+class BencodeError(Exception):
+    pass
+
+class Decoder:
+    """
+    Single-pass recursive-descent bencode decoder
+    Purpose is to decode .torrent files without tokenizing or copying data
+     that is never used.
+
+    The decoder walks offsets into the raw byte string; only the values that
+     end up in the result are sliced out of it.
+     - data: the raw bencode (a byte string, as read from a file opened 'rb')
+     - skip: dictionary keys whose values are stepped over without being built
+      (e.g. 'pieces'); skipped keys are absent from the decoded dictionary
+     - spans: keys of the top-level dictionary whose raw (start,end) offsets are
+      recorded in self.span after decoding (e.g. 'info', for the info-hash)
+
+    Trailing data after the top-level value is rejected, as are integers and
+     string lengths that are not a plain run of digits (a sign, a leading zero,
+     '-0', spaces) and values nested deeper than the interpreter's recursion limit.
+    """
+    # i<digits>e and <digits>: as the spec allows them, matched up to the 'e' or ':'
+    __int = re.compile(r"(?:0|-?[1-9][0-9]*)\Z")
+    __length = re.compile(r"(?:0|[1-9][0-9]*)\Z")
+    def __init__(self,data,skip=(),spans=()):
+        self.data = data
+        self.skip = frozenset(skip)
+        self.spans = frozenset(spans)
+        self.span = {}
+    def decode(self):
+        try:
+            if self.spans and self.data[:1] == 'd':
+                value,end = self.__decode_top()
+            else:
+                value,end = self.__decode(0)
+        except (IndexError,ValueError,TypeError):
+            raise BencodeError("decode error: badly formed data")
+        except RuntimeError:
+            # maximum recursion depth exceeded
+            raise BencodeError("decode error: nested too deeply")
+        if end != len(self.data):
+            raise BencodeError("decode error: trailing data at offset %d" %(end))
+        return value
+    # top-level dictionary: as __decode, also recording the spans of self.spans
+    def __decode_top(self):
+        data = self.data
+        result = {}
+        i = 1
+        while data[i] != 'e':
+            key,i = self.__decode(i)
+            if not isinstance(key,str):
+                raise BencodeError("decode error: non-string key at offset %d" %(i))
+            start = i
+            if key in self.skip:
+                i = self.__skip(i)
+            else:
+                result[key],i = self.__decode(i)
+            if key in self.spans:
+                self.span[key] = (start,i)
+        return result,i+1
+    # returns (value, offset of the next value)
+    def __decode(self,i):
+        data = self.data
+        c = data[i]
+        # strings are by far the most common value, test for them first
+        if '0' <= c <= '9':
+            colon = data.index(':',i)
+            start = colon + 1
+            end = start + self.__number(self.__length,i,colon)
+            if end > len(data):
+                raise BencodeError("decode error: string overruns data at offset %d" %(i))
+            return data[start:end],end
+        elif c == 'i':
+            end = data.index('e',i)
+            return self.__number(self.__int,i+1,end),end+1
+        elif c == 'l':
+            result = []
+            i += 1
+            while data[i] != 'e':
+                value,i = self.__decode(i)
+                result.append(value)
+            return result,i+1
+        elif c == 'd':
+            result = {}
+            i += 1
+            while data[i] != 'e':
+                key,i = self.__decode(i)
+                if not isinstance(key,str):
+                    raise BencodeError("decode error: non-string key at offset %d" %(i))
+                if key in self.skip:
+                    i = self.__skip(i)
+                else:
+                    result[key],i = self.__decode(i)
+            return result,i+1
+        raise BencodeError("decode error: unexpected %r at offset %d" %(c,i))
+    # the number in data[start:end], which must match pattern
+    def __number(self,pattern,start,end):
+        if not pattern.match(self.data,start,end):
+            raise BencodeError("decode error: badly formed number at offset %d" %(start))
+        return int(self.data[start:end])
+    # returns the offset following the value at i, without building it
+    def __skip(self,i):
+        data = self.data
+        c = data[i]
+        if '0' <= c <= '9':
+            colon = data.index(':',i)
+            end = colon + 1 + self.__number(self.__length,i,colon)
+            if end > len(data):
+                raise BencodeError("decode error: string overruns data at offset %d" %(i))
+            return end
+        elif c == 'i':
+            end = data.index('e',i)
+            self.__number(self.__int,i+1,end)
+            return end + 1
+        elif c == 'l' or c == 'd':
+            i += 1
+            while data[i] != 'e':
+                i = self.__skip(i)
+            return i+1
+        raise BencodeError("decode error: unexpected %r at offset %d" %(c,i))
+
+def decode(data,skip=()):
+    return Decoder(data,skip).decode()
@@ -0,0 +1,105 @@
+import sqlite3, marshal, os, time, logging
+
+class MetadataCacheError(Exception):
+    pass
+
+class MetadataCache:
+    """
+    Persistent cache of parsed .torrent metadata, backed by SQLite
+    Purpose is to let restarts and repeat scans of large folders cost a stat
+     instead of a decode.
+
+    Entries are keyed by the file's (device, inode) and validated against its
+     (size, mtime): a moved file still hits, a rewritten file misses and its
+     stale entry is dropped.
+     - path: location of the database file (':memory:' for a private cache)
+     - capacity: maximum number of entries; least recently used entries are evicted
+     - commit_every: number of writes buffered before an automatic commit
+
+    Values are dictionaries of plain data (str, int, list, dict) and are
+     stored with marshal, so str values come back as str.
+    """
+    __schema = ("CREATE TABLE IF NOT EXISTS metadata ("
+                "dev INTEGER NOT NULL, "
+                "ino INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "mtime REAL NOT NULL, "
+                "used REAL NOT NULL, "
+                "data BLOB NOT NULL, "
+                "PRIMARY KEY (dev,ino))")
+    __used_index = "CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)"
+    def __init__(self,path,capacity=100000,commit_every=500):
+        self.logger = logging.getLogger("MetadataCache")
+        self.path = path
+        self.capacity = capacity
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.__pending = 0
+        try:
+            self.__db = sqlite3.connect(path)
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("PRAGMA synchronous=NORMAL")
+            self.__db.execute(self.__schema)
+            self.__db.execute(self.__used_index)
+            self.__db.commit()
+            self.__count = self.__db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        except sqlite3.Error as e:
+            raise MetadataCacheError("init error: %s: %s" %(path,e))
+    def __len__(self):
+        return self.__count
+    def __repr__(self):
+        return "<MetadataCache %s (%d entries)>" %(self.path,self.__count)
+    def __written(self):
+        self.__pending += 1
+        if self.__pending >= self.commit_every:
+            self.flush()
+    # returns the cached dictionary for path, or None
+    def get(self,path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        row = self.__db.execute("SELECT size,mtime,data FROM metadata WHERE dev=? AND ino=?",
+                                (st.st_dev,st.st_ino)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        size,mtime,data = row
+        if size != st.st_size or mtime != st.st_mtime:
+            self.logger.debug("get: stale: %s" %(path))
+            self.__db.execute("DELETE FROM metadata WHERE dev=? AND ino=?",(st.st_dev,st.st_ino))
+            self.__count -= 1
+            self.__written()
+            self.misses += 1
+            return None
+        self.__db.execute("UPDATE metadata SET used=? WHERE dev=? AND ino=?",(time.time(),st.st_dev,st.st_ino))
+        self.__written()
+        self.hits += 1
+        return marshal.loads(str(data))
+    def put(self,path,meta):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        key = (st.st_dev,st.st_ino)
+        if not self.__db.execute("SELECT 1 FROM metadata WHERE dev=? AND ino=?",key).fetchone():
+            self.__count += 1
+        self.__db.execute("INSERT OR REPLACE INTO metadata VALUES (?,?,?,?,?,?)",
+                          key + (st.st_size,st.st_mtime,time.time(),sqlite3.Binary(marshal.dumps(meta))))
+        self.__written()
+        if self.__count > self.capacity:
+            self.evict(self.__count - self.capacity)
+    # drops the n least recently used entries
+    def evict(self,n):
+        self.__db.execute("DELETE FROM metadata WHERE rowid IN "
+                          "(SELECT rowid FROM metadata ORDER BY used LIMIT ?)",(n,))
+        self.__count = self.__db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        self.logger.debug("evict: %d entries" %(n))
+        self.flush()
+    def flush(self):
+        self.__db.commit()
+        self.__pending = 0
+    def close(self):
+        self.flush()
+        self.__db.close()
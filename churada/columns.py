@@ -0,0 +1,89 @@
+import logging
+from operator import attrgetter
+
+# numpy is optional: without it Seedbox keeps to the per-record path
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ColumnsError(Exception):
+    pass
+
+class RemoteColumns(object):
+    """
+    Columnar snapshot of a RemoteRecord
+    Purpose is to let deletion and download selection work on whole arrays
+     instead of walking RemoteTorrents one attribute lookup at a time.
+
+     - rtors: the records, in snapshot order; row i of every column is rtors[i]
+     - one float64 column per field in columns; missing values are nan
+     - state: int8 state codes, decoded by states (code -> name)
+     - score: 10**6*ratio/atime as in RemoteTorrent, inf where atime is not positive
+     - rate: recent upload rate (see history.StatsHistory), nan where unknown
+
+    Selection orders by score, or by rate with key='rate'; unknown rates sort last.
+
+    The snapshot is taken once (e.g. after each info refresh) and not updated;
+     records changed after it was taken are not reflected in the columns.
+    """
+    columns = ('size','csize','ratio','stime','atime','uspeed','cseed','tseed','rate')
+    def __init__(self,rtors):
+        if numpy is None:
+            raise ColumnsError("init error: numpy is not available")
+        self.logger = logging.getLogger("RemoteColumns")
+        self.rtors = list(rtors)
+        count = len(self.rtors)
+        # one row per record, then one column per field; None becomes nan
+        getter = attrgetter(*self.columns)
+        table = numpy.array([getter(rtor) for rtor in self.rtors],dtype=numpy.float64).reshape(count,len(self.columns))
+        for key,column in zip(self.columns,table.T):
+            setattr(self,key,numpy.ascontiguousarray(column))
+        codes = {}
+        self.state = numpy.fromiter((codes.setdefault(rtor.state,len(codes)) for rtor in self.rtors),numpy.int8,count)
+        self.states = dict((code,state) for state,code in codes.iteritems())
+        self.score = self.__score(self.ratio,self.atime)
+        self.logger.debug("init: %d records, %d states" %(count,len(codes)))
+    def __len__(self):
+        return len(self.rtors)
+    @staticmethod
+    def __score(ratio,atime):
+        score = numpy.full(len(ratio),numpy.inf)
+        active = atime > 0
+        score[active] = 10**6*ratio[active]/atime[active]
+        return score
+    # boolean mask of the records in any of the given states
+    def state_mask(self,*states):
+        codes = [code for code,state in self.states.iteritems() if state in states]
+        return numpy.in1d(self.state,codes)
+    def __index(self,mask):
+        return numpy.arange(len(self.rtors)) if mask is None else numpy.flatnonzero(mask)
+    def __key(self,key):
+        if key == 'score':
+            return self.score
+        return numpy.where(numpy.isnan(self.rate),numpy.inf,self.rate)
+    # the k lowest entries of index by order, lowest first
+    @staticmethod
+    def __lowest(order,index,k):
+        if k < len(index):
+            index = index[numpy.argpartition(order[index],k)[:k]]
+        return index[numpy.argsort(order[index],kind='mergesort')]
+    # indices of the k lowest scores (or rates) among mask (all records by default), lowest first
+    def top_k(self,k,mask=None,key='score'):
+        return self.__lowest(self.__key(key),self.__index(mask),k)
+    # yields records in increasing score (or rate) order; the caller stops once enough space is freed
+    # the first block is sized from the mean record size, so usually only one partial sort is needed;
+    #  records rejected by the caller simply make the generator continue into the sorted remainder
+    def delete_candidates(self,space,mask=None,key='score'):
+        order = self.__key(key)
+        index = self.__index(mask)
+        sizes = self.size[index]
+        known = sizes[~numpy.isnan(sizes)]
+        mean = known.mean() if len(known) else 0
+        k = min(len(index),2*int(space/mean) + 1) if mean > 0 else len(index)
+        block = self.__lowest(order,index,k)
+        for i in block:
+            yield self.rtors[i]
+        rest = numpy.setdiff1d(index,block,assume_unique=True)
+        for i in rest[numpy.argsort(order[rest],kind='mergesort')]:
+            yield self.rtors[i]
@@ -2,6 +2,8 @@ import logging
 
 from .rule import Rule, CompositeRule
 from .seedbox import Seedbox
+from .deluge import ConsoleBackend, RPCBackend
+from .engine import Engine
 
 # configure logfile
 # logger levels: DEBUG, INFO
@@ -16,23 +18,35 @@ host = "host"
 capacity = 359<<30
 paths = {'remote_torrent':"~/deluge-watch",
          'remote_data':"~/files",
-         'local_data':"/local_data_path"}
+         'local_data':"/local_data_path",
+         'local_history':"/var/lib/churada/history.db"}
 rules = {'download_valid':[],
          'download_path':[],
          'delete_valid':[]}
-seedbox1_args = [uname,host,capacity,paths,rules]
+# deluged access: RPCBackend (falls back to deluge-console) or ConsoleBackend
+backend = RPCBackend
+seedbox1_args = [uname,host,capacity,paths,rules,backend]
 seedbox1 = Seedbox(*seedbox1_args)
 
 seedbox_list = [seedbox1]
 
 controller_paths = {'local_torrent':"/active_torrent_path",
                     'local_invalid':"/invalid_torrent_path",
+                    'local_cache':"/var/lib/churada/metadata.db",
+                    'local_journal':"/var/lib/churada/journal",
                     'local_watch':["/watch_path"]}
 
 
 controller_rules = {'upload_path':[]}
 
-controller_args = (seedbox_list,controller_paths,controller_rules)
+# processes used to parse scanned .torrent files (None: one per core); more than one
+# forks a process pool when the controller is built
+controller_workers = 1
+
+# runs the seedboxes concurrently (None: one after the other)
+controller_engine = Engine()
+
+controller_args = (seedbox_list,controller_paths,controller_rules,controller_workers,controller_engine)
 
 # what we're actually building
 options = {'controller_args':controller_args,
@@ -1,8 +1,12 @@
 from .shell import Shell
 from .record import LocalRecord
-from .torrent import LocalTorrent,LocalTorrentError
+from .torrent import LocalTorrent,LocalTorrentError,parse_local
+from .cache import MetadataCache
+from .journal import StateJournal
+from .locator import Locator
 from operator import itemgetter
 from glob import glob
+from multiprocessing import Pool,cpu_count
 import os,logging,shutil
 
 class ControllerError(Exception):
@@ -14,11 +18,36 @@ class Controller:
     - watches local folders for torrent files
     - 
     - chooses upload path based on free space availability and capacity
+    - if paths['local_cache'] is set, parsed metadata is cached there across scans and restarts
+    - if paths['local_journal'] is set, the queues of the controller and its seedboxes
+     are journaled there (see StateJournal), and restored from it on start
+    - locator: a Locator of the controller's up queue (as (None,'up_queue')), and of each
+     seedbox's up queue and remote torrents (as (seedbox,'up_queue') and (seedbox,'info'));
+     scan checks duplicates against it
+    - workers: processes that parse scanned files (None: one per core); with one, files are
+     parsed in this process. With more, a process pool is forked once, when the controller
+     is built: before the daemon starts any thread (engine workers, SSH transports), as
+     forking a process whose threads may hold locks can deadlock the child. Scans of fewer
+     than __parallel_threshold uncached files are still parsed in this process
+    - engine: an Engine; if given, act runs the seedboxes concurrently on it (see Seedbox.act_async)
+     instead of one after the other
     """
     __upload_limit = 0.25
-    def __init__(self,seedbox_list,paths,rules):
+    __parallel_threshold = 64
+    def __init__(self,seedbox_list,paths,rules,workers=1,engine=None):
         self.logger = logging.getLogger("Controller")
-        self.up_queue = LocalRecord(Shell())
+        if not workers:
+            try:
+                workers = cpu_count()
+            except NotImplementedError:
+                workers = 1
+        self.workers = workers
+        self.__pool = Pool(workers) if workers > 1 else None
+        self.engine = engine
+        self.cache = None
+        if paths.get('local_cache'):
+            self.cache = MetadataCache(os.path.normpath(paths['local_cache']))
+        self.up_queue = LocalRecord(Shell(),self.cache)
         self.seedbox_list = seedbox_list
         self.blacklist = LocalRecord(Shell())
 
@@ -47,20 +76,60 @@ class Controller:
             raise ControllerError("no valid watchpaths")
         if not self.seedbox_list:
             raise ControllerError("no seedboxes")
+        self.journal = None
+        if paths.get('local_journal'):
+            self.journal = StateJournal(os.path.normpath(paths['local_journal']))
+            self.__journal_attach()
+        self.locator = Locator()
+        self.locator.watch((None,'up_queue'),self.up_queue)
+        for seedbox in self.seedbox_list:
+            self.locator.watch((seedbox,'up_queue'),seedbox.up_queue)
+            self.locator.watch((seedbox,'info'),seedbox.info)
     def __repr__(self):
         return self
+    # stops the parse pool, if any
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
     def __check_upload_path(self,ltor):
         for rule,path,priority in self.rules['upload_path']:
             if rule.query(ltor):
                 return upload_path
         return None 
+    # seedbox queues are journaled under the seedbox's ssh path
+    def __journal_attach(self):
+        self.journal.attach('up_queue',self.up_queue)
+        for seedbox in self.seedbox_list:
+            prefix = seedbox.shell.path + ":"
+            self.journal.attach(prefix + 'up_queue',seedbox.up_queue)
+            self.journal.attach(prefix + 'down_queue',seedbox.down_queue)
+            self.journal.track(prefix + 'down_pending',seedbox.down_queue.pending)
+            self.journal.track(prefix + 'upload_failures',seedbox.upload_failures)
+            self.journal.track(prefix + 'download_failures',seedbox.download_failures)
     # act
     def act(self): 
+        if self.engine is not None:
+            self.engine.run(self.act_async(self.engine))
+            return
         for seedbox in self.seedbox_list:
             seedbox.act()
+            if self.journal is not None:
+                self.journal.sync()
+        self.__act_local()
+    # act, as steps for Engine.spawn: the seedboxes act concurrently
+    def act_async(self,engine):
+        yield [engine.spawn(seedbox.act_async(engine)) for seedbox in self.seedbox_list]
+        if self.journal is not None:
+            self.journal.sync()
+        self.__act_local()
+    def __act_local(self):
         for watchpath in self.path_watchlist:
             self.scan(watchpath)
         self.populate()
+        if self.journal is not None:
+            self.journal.sync()
         # scan
         # populate
     # populate 
@@ -101,27 +170,56 @@ class Controller:
                 seedbox_free[seedbox] -= ltor.size
                 seedbox_capacity[seedbox] -= ltor.size
                 self.logger.debug("populate: capacity: %s <- %s"%(seedbox,ltor))
+    # yields (path,ltor) in the order of tfiles; ltor is None if the file is invalid
+    # uncached files are parsed in the process pool, if any; moves and inserts stay with the caller
+    def __parse(self,tfiles):
+        cached = {}
+        misses = []
+        for tpath in tfiles:
+            meta = LocalTorrent.cached_fields(self.cache.get(tpath)) if self.cache is not None else None
+            if meta:
+                cached[tpath] = meta
+            else:
+                misses.append(tpath)
+        if self.__pool is None or len(misses) < self.__parallel_threshold:
+            results = (parse_local(tpath) for tpath in misses)
+        else:
+            self.logger.debug("scan: parsing %d files with %d workers" %(len(misses),self.workers))
+            chunksize = max(1,len(misses)//(4*self.workers))
+            results = self.__pool.imap(parse_local,misses,chunksize)
+        for tpath in tfiles:
+            fields = cached.get(tpath)
+            error = None
+            if not fields:
+                path,fields,error = results.next()
+            try:
+                if not fields:
+                    raise LocalTorrentError(error)
+                ltor = LocalTorrent(tpath,fields=fields)
+            except LocalTorrentError as e:
+                yield tpath,None
+                continue
+            if tpath not in cached and self.cache is not None:
+                self.cache.put(tpath,ltor.metadata())
+            yield tpath,ltor
     def scan(self,scan_path):
         self.logger.info("scanning: %s"%(scan_path))
         path_expr = os.path.join(scan_path,"*.torrent")
         tfiles = glob(path_expr)
-        for tpath in tfiles:
-            try:
-                ltor = LocalTorrent(tpath)
-            except LocalTorrentError as e:
+        for tpath,ltor in self.__parse(tfiles):
+            if not ltor:
                 self.logger.error("scan: invalid: %s" %(tpath))
                 shutil.move(tpath,self.path_local_invalid)
             else:
                 # make sure it's not a duplicate
-                unique_flag = True
-                for seedbox in self.seedbox_list:
-                    if seedbox.find(ltor.name):
-                       unique_flag = False
-                       ltor.move(self.path_local_invalid) 
-                       self.logger.info("scan: duplicate: %s (%s)",ltor,seedbox)
-                       break
-                if unique_flag:
+                location = self.locator.find(info_hash=ltor.info_hash)
+                if location is not None:
+                    ltor.move(self.path_local_invalid) 
+                    self.logger.info("scan: duplicate: %s (%s)",ltor,location)
+                else:
                 # move to active folder and enqueue
                     ltor.move(self.path_local_torrent)
                     self.up_queue.ltor_add(ltor=ltor)
-                    self.logger.info("scan:adding: %s (%s)",ltor,seedbox)
+                    self.logger.info("scan:adding: %s",ltor)
+        if self.cache is not None:
+            self.cache.flush()
@@ -0,0 +1,442 @@
+import socket, ssl, select, struct, threading, zlib, logging, time, pipes
+
+from . import rencode
+from .torrent import RemoteTorrent,RemoteTorrentError
+
+class DelugeError(Exception):
+    pass
+
+class DelugeRPCError(DelugeError):
+    """Error raised by the daemon while running a call"""
+    def __init__(self,exception_type,message,traceback=None):
+        DelugeError.__init__(self,"%s: %s" %(exception_type,message))
+        self.exception_type = exception_type
+        self.message = message
+        self.traceback = traceback
+
+RPC_RESPONSE = 1
+RPC_ERROR = 2
+RPC_EVENT = 3
+
+class Forward(threading.Thread):
+    """
+    Local end of an SSH port-forward
+    Purpose is to reach a port that is only open on the seedbox's loopback
+     (deluged listens on 127.0.0.1) through an existing paramiko transport.
+
+    Listens on an ephemeral port of 127.0.0.1 (self.port); each accepted
+     connection is relayed over a 'direct-tcpip' channel to (host,port) as
+     seen from the seedbox. Connections are relayed one at a time.
+    """
+    __chunk = 1<<16
+    def __init__(self,transport,host,port,timeout=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger("Forward")
+        self.transport = transport
+        self.remote = (host,port)
+        self.timeout = timeout
+        self.listener = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.listener.bind(('127.0.0.1',0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.__closed = threading.Event()
+    def run(self):
+        while not self.__closed.is_set():
+            rl,wl,xl = select.select([self.listener],[],[],self.timeout)
+            if not rl:
+                continue
+            try:
+                sock,peer = self.listener.accept()
+            except socket.error:
+                break
+            try:
+                channel = self.transport.open_channel('direct-tcpip',self.remote,peer)
+            except Exception as e:
+                self.logger.warning("forward: cannot open channel to %s:%d: %s" %(self.remote+(e,)))
+                sock.close()
+                continue
+            self.logger.debug("forward: %s:%d -> %s:%d" %(peer+self.remote))
+            try:
+                self.__relay(sock,channel)
+            finally:
+                channel.close()
+                sock.close()
+        self.listener.close()
+    def __relay(self,sock,channel):
+        while not self.__closed.is_set():
+            rl,wl,xl = select.select([sock,channel],[],[],self.timeout)
+            for source,dest in ((sock,channel),(channel,sock)):
+                if source in rl:
+                    data = source.recv(self.__chunk)
+                    if not data:
+                        return
+                    dest.sendall(data)
+    def close(self):
+        self.__closed.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+        else:
+            self.listener.close()
+
+class DelugeClient:
+    """
+    Client for deluged's RPC protocol
+    Purpose is to query and control deluged without starting deluge-console
+     and scraping its output.
+
+    Messages are zlib-compressed rencode over TLS. A request message is a list of
+     (request_id,method,args,kwargs); each answer is a separate message, either
+     (RPC_RESPONSE,request_id,result) or (RPC_ERROR,request_id,type,message,traceback).
+     Events (RPC_EVENT,...) are ignored.
+     - protocol 1 (deluge 1.3): messages are bare zlib streams, one after the other
+     - protocol 2 (deluge 2.x): each message is prefixed with 'D' and its length
+    Several calls may be sent in one message with batch().
+    """
+    __chunk = 1<<16
+    def __init__(self,host,port,username,password,protocol=1,timeout=30):
+        self.logger = logging.getLogger("DelugeClient")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.protocol = protocol
+        self.timeout = timeout
+        self.sock = None
+        self.__request_id = 0
+        self.__buffer = ''
+    def __repr__(self):
+        return "DelugeClient(\"%s\", %d)" %(self.host,self.port)
+    def connect(self):
+        try:
+            sock = socket.create_connection((self.host,self.port),self.timeout)
+            # deluged uses a self-signed certificate
+            self.sock = ssl.wrap_socket(sock,cert_reqs=ssl.CERT_NONE)
+        except (socket.error,ssl.SSLError) as e:
+            raise DelugeError("connect error: %s" %(e))
+        self.__buffer = ''
+        self.logger.debug("connect: %s:%d" %(self.host,self.port))
+        if self.protocol >= 2:
+            self.call('daemon.login',self.username,self.password,client_version='churada')
+        else:
+            self.call('daemon.login',self.username,self.password)
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+    def call(self,method,*args,**kwargs):
+        return self.batch([(method,args,kwargs)])[0]
+    # calls is a list of (method,args,kwargs); results are returned in the same order
+    # every answer is read before the first error, if any, is raised;
+    #  with raise_errors=False, failed calls are returned as DelugeRPCErrors instead
+    def batch(self,calls,raise_errors=True):
+        if self.sock is None:
+            raise DelugeError("call error: not connected")
+        requests = []
+        for method,args,kwargs in calls:
+            self.__request_id += 1
+            requests.append((self.__request_id,method,tuple(args),dict(kwargs)))
+        self.__send(requests)
+        pending = dict((request[0],i) for i,request in enumerate(requests))
+        results = [None]*len(requests)
+        error = None
+        while pending:
+            message = self.__receive()
+            if not isinstance(message,tuple) or len(message) < 3 or message[0] == RPC_EVENT:
+                continue
+            if message[1] not in pending:
+                self.logger.debug("call: unexpected answer %r" %(message[1],))
+                continue
+            index = pending.pop(message[1])
+            if message[0] == RPC_RESPONSE:
+                results[index] = message[2]
+            elif message[0] == RPC_ERROR:
+                results[index] = DelugeRPCError(*message[2:5])
+                error = error or results[index]
+        if error and raise_errors:
+            raise error
+        return results
+    def __send(self,data):
+        body = zlib.compress(rencode.dumps(data))
+        if self.protocol >= 2:
+            body = 'D' + struct.pack('!i',len(body)) + body
+        try:
+            self.sock.sendall(body)
+        except (socket.error,ssl.SSLError) as e:
+            raise DelugeError("send error: %s" %(e))
+    def __read(self):
+        try:
+            data = self.sock.recv(self.__chunk)
+        except (socket.error,ssl.SSLError) as e:
+            raise DelugeError("receive error: %s" %(e))
+        if not data:
+            raise DelugeError("receive error: connection closed")
+        self.__buffer += data
+    def __receive(self):
+        if self.protocol >= 2:
+            while len(self.__buffer) < 5:
+                self.__read()
+            if self.__buffer[0] != 'D':
+                raise DelugeError("receive error: bad message header")
+            length = struct.unpack('!i',self.__buffer[1:5])[0]
+            while len(self.__buffer) < 5 + length:
+                self.__read()
+            body,self.__buffer = self.__buffer[5:5+length],self.__buffer[5+length:]
+            try:
+                return self.__loads(zlib.decompress(body))
+            except zlib.error as e:
+                raise DelugeError("receive error: %s" %(e))
+        # protocol 1: a message ends where its zlib stream ends, i.e. once the
+        #  adler-32 of the output has been read, or once data follows the stream
+        decompressor = zlib.decompressobj()
+        data = []
+        checksum = zlib.adler32('')
+        tail = ''
+        while True:
+            if self.__buffer:
+                try:
+                    part = decompressor.decompress(self.__buffer)
+                except zlib.error as e:
+                    raise DelugeError("receive error: %s" %(e))
+                data.append(part)
+                checksum = zlib.adler32(part,checksum)
+                tail = (tail + self.__buffer)[-4:]
+                self.__buffer = decompressor.unused_data
+                if self.__buffer or tail == struct.pack('!I',checksum & 0xffffffff):
+                    return self.__loads("".join(data))
+            self.__read()
+    def __loads(self,data):
+        try:
+            return rencode.loads(data)
+        except rencode.RencodeError as e:
+            raise DelugeError("receive error: %s" %(e))
+
+# RemoteTorrent field -> deluge status key
+STATUS_KEYS = (('name','name'),
+               ('state','state'),
+               ('dspeed','download_payload_rate'),
+               ('uspeed','upload_payload_rate'),
+               ('eta','eta'),
+               ('cseed','num_seeds'),
+               ('tseed','total_seeds'),
+               ('cpeer','num_peers'),
+               ('tpeer','total_peers'),
+               ('avail','distributed_copies'),
+               ('csize','total_done'),
+               ('size','total_size'),
+               ('ratio','ratio'),
+               ('stime','seeding_time'),
+               ('atime','active_time'),
+               ('tracker','tracker_host'),
+               ('tracker_status','tracker_status'),
+               ('progress','progress'))
+
+# builds RemoteTorrent fields from a deluge status dictionary
+def status_fields(torrent_id,status):
+    fields = {'id':torrent_id}
+    for field,key in STATUS_KEYS:
+        value = status.get(key)
+        if isinstance(value,(int,long)) and not isinstance(value,bool):
+            value = float(value)
+        fields[field] = value
+    # deluge prefixes the status with the tracker ("tracker.ca: Announce OK"), as the console prints it
+    status = fields['tracker_status']
+    if status and ': ' in status:
+        fields['tracker_status'] = status.partition(': ')[2]
+    return fields
+
+class ConsoleBackend:
+    """
+    Queries deluged by running deluge-console over SSH
+    Purpose is to keep the original text-scraping path available, e.g. as
+     the fallback of RPCBackend.
+
+    Backends enqueue work on the seedbox's Shell; results are delivered when the
+     ssh queue is processed, as func(exitcode=...,output=...,**args):
+     - add_info: output is a list of RemoteTorrents (all torrents, or those
+      with the given names or info-hashes); a listing of all torrents that
+      cannot be read fails with exitcode None, so an empty list with exitcode
+      0 means that the seedbox has no torrents
+     - add_delete: output is a dictionary of info-hash -> True if that torrent was deleted
+
+    Lookups and deletions of several torrents run in a single deluge-console
+     session, one command per torrent. A deletion is followed by a lookup of
+     the same torrents in a second session: a torrent counts as deleted when
+     that lookup succeeds and no longer shows it. Deletions share the Shell
+     chain 'delete', so two batches never run at once. Lookups are queued as
+     idempotent: identical ones queued together run once.
+     - dry_run: deletions only look the torrents up, and a torrent counts as
+      deleted when it is found (as RPCBackend's dry run)
+    """
+    info_command = "deluge-console \"connect 127.0.0.1:33307; info\""
+    session_command = "deluge-console \"connect 127.0.0.1:33307%s\""
+    find_item = "; info %s"
+    delete_item = "; rm --remove-data %s"
+    dry_run = True
+    def __init__(self,shell):
+        self.logger = logging.getLogger("ConsoleBackend")
+        self.shell = shell
+    def __repr__(self):
+        return "ConsoleBackend(%r)" %(self.shell)
+    # a full listing that prints something but no torrent could not be read:
+    #  it is reported as failed (exitcode None), not as a seedbox with no torrents
+    def __info(self,func,args,listing,exitcode,output):
+        rtor_list = []
+        if exitcode == 0:
+            rtor_list = RemoteTorrent.batch_parse(output,time.time())
+            if listing and not rtor_list and output.strip():
+                self.logger.warning("info: unreadable listing: %r" %(output[:200]))
+                exitcode = None
+        func(exitcode=exitcode,output=rtor_list,**args)
+    # quotes an argument for deluge-console, inside the double-quoted remote command
+    @staticmethod
+    def quote(value):
+        value = pipes.quote(value)
+        for c in '\\"$`':
+            value = value.replace(c,'\\'+c)
+        return value
+    def add_info(self,func,args,names=None,ids=None):
+        keys = list(names or ()) + list(ids or ())
+        if keys:
+            command = self.session_command %("".join(self.find_item %(self.quote(key)) for key in keys))
+        else:
+            command = self.info_command
+        self.shell.add_ssh(command,self.__info,{'func':func,'args':args,'listing':not keys},idempotent=True)
+    # the output holds the records of the torrents still there after the deletion
+    #  (found, in a dry run); none are known to be deleted if the lookup failed
+    def __delete(self,rtors,dry_run,func,args,exitcode,output):
+        found = set(rtor.info_hash for rtor in RemoteTorrent.batch_parse(output or "",time.time()))
+        if dry_run:
+            result = dict((rtor.info_hash,rtor.info_hash in found) for rtor in rtors)
+        else:
+            result = dict((rtor.info_hash,exitcode == 0 and rtor.info_hash not in found) for rtor in rtors)
+        func(exitcode=exitcode,output=result,**args)
+    def add_delete(self,rtors,func,args):
+        ids = [self.quote(rtor.info_hash) for rtor in rtors]
+        command = self.session_command %("".join(self.find_item %(key) for key in ids))
+        if not self.dry_run:
+            command = self.session_command %("".join(self.delete_item %(key) for key in ids)) + "; " + command
+        self.shell.add_ssh(command,self.__delete,{'rtors':rtors,'dry_run':self.dry_run,'func':func,'args':args},chain='delete')
+
+class RPCBackend:
+    """
+    Queries deluged over its RPC protocol
+    Purpose is to avoid starting deluge-console (a python interpreter) on the
+     seedbox for every query, and to get structured status instead of text.
+
+    Calls are run on the shell's SSH connection when the ssh queue is processed:
+     deluged's port is reached through a Forward on the connection's transport,
+     and one DelugeClient session is kept for as long as that connection lives.
+     - username/password: deluged credentials; by default the first entry of
+      the seedbox's deluge auth file (the one deluge-console uses locally)
+     - keys: the status keys requested (see STATUS_KEYS)
+     - dry_run: as the console delete command, deletions only query the torrent
+    All deletions of one add_delete are sent as a single batch.
+
+    If a call fails, the request is handed to a ConsoleBackend instead, once the
+     failure is back on the thread processing the ssh queue.
+    """
+    __auth_command = "head -n 1 ~/.config/deluge/auth"
+    # output of a command whose call failed
+    __fallback = 'fallback'
+    keys = tuple(key for field,key in STATUS_KEYS)
+    dry_run = True
+    def __init__(self,shell,username=None,password=None,port=33307,protocol=1):
+        self.logger = logging.getLogger("RPCBackend")
+        self.shell = shell
+        self.username = username
+        self.password = password
+        self.port = port
+        self.protocol = protocol
+        self.fallback = ConsoleBackend(shell)
+        self.__rpc = None
+        self.__forward = None
+        self.__transport = None
+    def __repr__(self):
+        return "RPCBackend(%r)" %(self.shell)
+    def __credentials(self,ssh):
+        if self.username is not None:
+            return self.username,self.password
+        stdin,stdout,stderr = ssh.exec_command(self.__auth_command)
+        username,_,rest = stdout.read().strip().partition(':')
+        return username,rest.partition(':')[0]
+    # the DelugeClient for the current SSH connection
+    def session(self,ssh):
+        transport = ssh.get_transport()
+        if self.__rpc is None or transport is not self.__transport:
+            self.close()
+            username,password = self.__credentials(ssh)
+            self.__forward = Forward(transport,'127.0.0.1',self.port)
+            self.__forward.start()
+            rpc = DelugeClient('127.0.0.1',self.__forward.port,username,password,self.protocol)
+            rpc.connect()
+            self.__rpc = rpc
+            self.__transport = transport
+        return self.__rpc
+    def close(self):
+        if self.__rpc is not None:
+            self.__rpc.close()
+            self.__rpc = None
+        if self.__forward is not None:
+            self.__forward.close()
+            self.__forward = None
+        self.__transport = None
+    # returns a command for Shell.add_ssh: run on the ssh client, returns (exitcode,output)
+    # on failure it returns (None,__fallback), and __done re-queues the request on the fallback
+    # (the command may run on an engine worker, where the shell's queue must not be changed)
+    def __command(self,call):
+        def command(ssh):
+            try:
+                return 0,call(self.session(ssh))
+            except (DelugeError,socket.error,ssl.SSLError,EnvironmentError) as e:
+                self.logger.warning("rpc failed, using deluge-console: %s" %(e))
+                self.close()
+                return None,self.__fallback
+        return command
+    # a failed call is retried on the fallback; any other result (an SSH failure too) goes to func
+    def __done(self,func,args,retry,exitcode,output):
+        if exitcode is None and output is self.__fallback:
+            retry()
+        else:
+            func(exitcode=exitcode,output=output,**args)
+    # all torrents, or those with the given names or info-hashes (in one batch)
+    def torrents(self,rpc,names=None,ids=None):
+        filters = []
+        if names:
+            filters.append({'name':list(names)})
+        if ids:
+            filters.append({'id':list(ids)})
+        calls = [('core.get_torrents_status',(filter_dict,list(self.keys)),{}) for filter_dict in filters or [{}]]
+        status = {}
+        for result in rpc.batch(calls):
+            status.update(result)
+        timestamp = time.time()
+        rtor_list = []
+        for torrent_id,torrent_status in status.iteritems():
+            try:
+                rtor_list.append(RemoteTorrent.from_fields(status_fields(torrent_id,torrent_status),timestamp))
+            except RemoteTorrentError as e:
+                self.logger.debug("torrents: %s" %(e))
+        return rtor_list
+    def add_info(self,func,args,names=None,ids=None):
+        call = lambda rpc: self.torrents(rpc,names,ids)
+        retry = lambda: self.fallback.add_info(func,args,names,ids)
+        self.shell.add_ssh(self.__command(call),self.__done,{'func':func,'args':args,'retry':retry})
+    # returns info-hash -> True if that torrent was deleted
+    def remove(self,rpc,rtors):
+        if self.dry_run:
+            calls = [('core.get_torrent_status',(rtor.info_hash,['name']),{}) for rtor in rtors]
+        else:
+            calls = [('core.remove_torrent',(rtor.info_hash,True),{}) for rtor in rtors]
+        results = rpc.batch(calls,raise_errors=False)
+        for rtor,result in zip(rtors,results):
+            if isinstance(result,DelugeRPCError):
+                self.logger.warning("remove: %s: %s" %(rtor,result))
+        return dict((rtor.info_hash,bool(result) and not isinstance(result,DelugeRPCError))
+                    for rtor,result in zip(rtors,results))
+    def add_delete(self,rtors,func,args):
+        call = lambda rpc: self.remove(rpc,rtors)
+        self.fallback.dry_run = self.dry_run
+        retry = lambda: self.fallback.add_delete(rtors,func,args)
+        self.shell.add_ssh(self.__command(call),self.__done,{'func':func,'args':args,'retry':retry})
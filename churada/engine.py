@@ -0,0 +1,169 @@
+import threading, logging, Queue, sys
+
+class EngineError(Exception):
+    pass
+
+class Task(object):
+    """
+    The eventual result of work started on an Engine
+    Purpose is to wait for blocking work (a remote command, an rsync) without
+     blocking on it, as an asyncio future would.
+
+    A task is done once it has a result or an exception; result() returns the
+     one or raises the other. Functions given to add_done_callback are called
+     with the task when it is done (at once if it already is). Tasks of an Engine
+     are completed, and their callbacks called, in the thread that runs the
+     engine's wait().
+    """
+    def __init__(self):
+        self.__done = False
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = []
+    def __repr__(self):
+        return "<Task (%s)>" %("done" if self.__done else "pending")
+    def done(self):
+        return self.__done
+    def result(self):
+        if not self.__done:
+            raise EngineError("result error: task is not done")
+        if self.__exc_info is not None:
+            raise self.__exc_info[0],self.__exc_info[1],self.__exc_info[2]
+        return self.__result
+    def add_done_callback(self,func):
+        if self.__done:
+            func(self)
+        else:
+            self.__callbacks.append(func)
+    def set_result(self,result):
+        self.__finish(result,None)
+    # exc_info: as returned by sys.exc_info()
+    def set_exception(self,exc_info):
+        self.__finish(None,exc_info)
+    def __finish(self,result,exc_info):
+        if self.__done:
+            raise EngineError("finish error: task is already done")
+        self.__done = True
+        self.__result = result
+        self.__exc_info = exc_info
+        callbacks,self.__callbacks = self.__callbacks,[]
+        for func in callbacks:
+            func(self)
+
+class Engine:
+    """
+    Runs blocking work on a pool of threads, and generator steps on one thread
+    Purpose is to overlap the I/O of several seedboxes (and of the phases of
+     each) while records, journals and other state are only ever changed from
+     the thread that runs the engine; this tree runs on Python 2, which has no
+     asyncio, so threads stand in for an event loop's non-blocking I/O.
+     - workers: threads running submitted functions, started on first use
+
+    submit() runs func(*args) on a worker and returns its Task. spawn() drives a
+     generator: each value it yields is a Task, or a list of Tasks (gathered), and
+     the generator is resumed with the result once it is done; spawn returns a
+     Task of the generator's end. wait() completes the tasks of finished work
+     on the calling thread, running their callbacks, until the given task is done.
+    """
+    __tick = 1.0
+    def __init__(self,workers=8):
+        self.logger = logging.getLogger("Engine")
+        self.workers = workers
+        self.__work = Queue.Queue()
+        self.__finished = Queue.Queue()
+        self.__threads = []
+        # submitted tasks that wait() has not completed yet
+        self.__pending = 0
+    def __repr__(self):
+        return "<Engine (%d workers, %d pending)>" %(self.workers,self.__pending)
+    def __worker(self):
+        while True:
+            item = self.__work.get()
+            if item is None:
+                return
+            task,func,args = item
+            try:
+                self.__finished.put((task,func(*args),None))
+            except Exception:
+                self.__finished.put((task,None,sys.exc_info()))
+    def submit(self,func,*args):
+        if not self.__threads:
+            for i in range(0,self.workers):
+                thread = threading.Thread(target=self.__worker,name="Engine-%d" %(i))
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+        task = Task()
+        self.__pending += 1
+        self.__work.put((task,func,args))
+        return task
+    # a Task of the results of tasks, in order; the first exception is raised
+    def gather(self,tasks):
+        gathered = Task()
+        tasks = list(tasks)
+        left = [len(tasks)]
+        def done(task):
+            if gathered.done():
+                return
+            try:
+                task.result()
+            except Exception:
+                gathered.set_exception(sys.exc_info())
+                return
+            left[0] -= 1
+            if not left[0]:
+                gathered.set_result([task.result() for task in tasks])
+        if not tasks:
+            gathered.set_result([])
+        for task in tasks:
+            task.add_done_callback(done)
+        return gathered
+    def spawn(self,steps):
+        task = Task()
+        def step(value=None,exc_info=None):
+            try:
+                if exc_info is not None:
+                    awaited = steps.throw(*exc_info)
+                else:
+                    awaited = steps.send(value)
+            except StopIteration:
+                task.set_result(None)
+                return
+            except Exception:
+                task.set_exception(sys.exc_info())
+                return
+            if isinstance(awaited,list):
+                awaited = self.gather(awaited)
+            awaited.add_done_callback(resume)
+        def resume(awaited):
+            try:
+                value = awaited.result()
+            except Exception:
+                step(exc_info=sys.exc_info())
+            else:
+                step(value)
+        step()
+        return task
+    def wait(self,task):
+        while not task.done():
+            if not self.__pending:
+                raise EngineError("wait error: task cannot complete, no work is pending")
+            try:
+                done,result,exc_info = self.__finished.get(True,self.__tick)
+            except Queue.Empty:
+                continue
+            self.__pending -= 1
+            if exc_info is not None:
+                done.set_exception(exc_info)
+            else:
+                done.set_result(result)
+        return task.result()
+    # drives the generator steps until it ends
+    def run(self,steps):
+        return self.wait(self.spawn(steps))
+    def close(self):
+        for thread in self.__threads:
+            self.__work.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
@@ -0,0 +1,87 @@
+from array import array
+
+# 64-bit lengths: python 2 has no 'q' typecode, but 'l' is 64-bit on LP64 platforms;
+# elsewhere (32-bit, Windows) lengths fall back to doubles, exact up to 2**53 bytes
+def length_type():
+    for typecode in ('q','l'):
+        try:
+            if array(typecode).itemsize >= 8:
+                return typecode
+        except ValueError:
+            pass
+    return 'd'
+LENGTH_TYPE = length_type()
+# offsets index paths, a string, so they always fit a C long
+OFFSET_TYPE = 'l'
+
+class FileTableError(Exception):
+    pass
+
+class FileTable(object):
+    """
+    Compact file list of a multi-file .torrent
+    Purpose is to keep large file lists (e.g. season packs) as a handful of
+     flat buffers instead of a dict and a list per file.
+
+     - lengths: array of file lengths, in .torrent order
+     - offsets: array of len(lengths)+1 offsets into paths; file i spans paths[offsets[i]:offsets[i+1]]
+     - paths: every path in one string, components separated by '\\0'
+     - total: sum of lengths, computed once
+
+    Files are read as (path,length) views built on access; path is a tuple of
+     interned components, so repeated directory names share one string.
+    """
+    __slots__ = ('lengths','offsets','paths','total')
+    __sep = '\0'
+    def __init__(self,lengths,offsets,paths):
+        if len(offsets) != len(lengths) + 1 or offsets[-1] != len(paths):
+            raise FileTableError("init error: offsets do not match paths")
+        self.lengths = lengths
+        self.offsets = offsets
+        self.paths = paths
+        self.total = int(sum(lengths))
+    # builds a table from the bdecoded 'files' list: [{'length':int,'path':[str,...]},...]
+    @classmethod
+    def from_files(cls,files):
+        try:
+            lengths = array(LENGTH_TYPE,(f['length'] for f in files))
+            joined = [cls.__sep.join(f['path']) for f in files]
+        except (KeyError,TypeError,OverflowError) as e:
+            raise FileTableError("init error: badly formed file list")
+        offsets = array(OFFSET_TYPE,[0])
+        position = 0
+        for path in joined:
+            position += len(path)
+            offsets.append(position)
+        return cls(lengths,offsets,"".join(joined))
+    # inverse of data(); also accepts a bdecoded 'files' list
+    @classmethod
+    def load(cls,data):
+        if isinstance(data,cls):
+            return data
+        if isinstance(data,list):
+            return cls.from_files(data)
+        lengths,offsets,paths = data
+        return cls(array(LENGTH_TYPE,lengths),array(OFFSET_TYPE,offsets),paths)
+    # plain (marshal/pickle friendly) form of the table
+    def data(self):
+        return (self.lengths.tolist(),self.offsets.tolist(),self.paths)
+    def __eq__(self,other):
+        return (isinstance(other,FileTable) and self.lengths == other.lengths and
+                self.offsets == other.offsets and self.paths == other.paths)
+    def __ne__(self,other):
+        return not self == other
+    def __len__(self):
+        return len(self.lengths)
+    def __getitem__(self,i):
+        if i < 0:
+            i += len(self.lengths)
+        return self.path(i),int(self.lengths[i])
+    def __iter__(self):
+        for i in xrange(len(self.lengths)):
+            yield self.path(i),int(self.lengths[i])
+    def __repr__(self):
+        return "<FileTable %d files, %d bytes>" %(len(self.lengths),self.total)
+    def path(self,i):
+        path = self.paths[self.offsets[i]:self.offsets[i+1]]
+        return tuple(intern(component) for component in path.split(self.__sep))
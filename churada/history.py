@@ -0,0 +1,159 @@
+import sqlite3, marshal, math, time, logging
+
+class StatsHistoryError(Exception):
+    pass
+
+class StatsHistory:
+    """
+    Time-series of remote torrent upload stats, backed by SQLite
+    Purpose is to score torrents by what they upload now, rather than by their
+     lifetime ratio/atime, which favours old torrents and hides stalled ones.
+
+    Each append() stores one sample per torrent: (time, uploaded bytes), where
+     uploaded is ratio*csize as reported by deluge. Samples are keyed by
+     (torrent,time), so the latest points of a torrent are one index range.
+     - path: location of the database file (':memory:' for a private store)
+     - windows: time constants (seconds) of the upload-rate EWMAs kept per torrent
+     - downsample: (age,bucket) pairs; samples older than age are thinned to the
+      last one of each bucket of that many seconds (uploaded is cumulative, so
+      rates over the remaining points are unchanged)
+     - expire: samples older than this are dropped
+     - compact_every: seconds between automatic compact() calls from append()
+
+    The EWMAs are updated as samples arrive, so rates() reads one row per torrent;
+     a torrent's rates are None until it has two samples.
+
+    compact() keeps the last sample of each bucket with one grouped query per
+     downsample level, and only thins the samples that aged past the level since
+     the previous compact() (all of them, the first time after opening).
+    """
+    __schema = ("CREATE TABLE IF NOT EXISTS torrents ("
+                "id INTEGER PRIMARY KEY, "
+                "box TEXT NOT NULL, "
+                "info_hash TEXT NOT NULL, "
+                "time INTEGER, "
+                "uploaded INTEGER, "
+                "rates BLOB, "
+                "UNIQUE (box,info_hash))",
+                "CREATE TABLE IF NOT EXISTS samples ("
+                "torrent INTEGER NOT NULL, "
+                "time INTEGER NOT NULL, "
+                "uploaded INTEGER NOT NULL, "
+                "PRIMARY KEY (torrent,time)) WITHOUT ROWID",
+                # the samples kept by compact(), one per torrent and bucket
+                "CREATE TEMP TABLE IF NOT EXISTS kept ("
+                "torrent INTEGER NOT NULL, "
+                "time INTEGER NOT NULL, "
+                "PRIMARY KEY (torrent,time)) WITHOUT ROWID")
+    def __init__(self,path,windows=(60*60,24*60*60),downsample=((2*24*60*60,60*60),(30*24*60*60,24*60*60)),
+                 expire=365*24*60*60,compact_every=24*60*60):
+        self.logger = logging.getLogger("StatsHistory")
+        self.path = path
+        self.windows = tuple(windows)
+        self.downsample = sorted(downsample)
+        self.expire = expire
+        self.compact_every = compact_every
+        self.__compacted = time.time()
+        # age -> time before which samples were thinned to buckets of that level
+        self.__thinned = {}
+        # (box,info_hash) -> [id,time,uploaded,rates]
+        self.__state = {}
+        try:
+            self.__db = sqlite3.connect(path)
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.__schema:
+                self.__db.execute(statement)
+            self.__db.commit()
+            for row in self.__db.execute("SELECT box,info_hash,id,time,uploaded,rates FROM torrents"):
+                box,info_hash,torrent,last,uploaded,rates = row
+                rates = marshal.loads(str(rates)) if rates is not None else None
+                if rates is not None and len(rates) != len(self.windows):
+                    rates = None
+                self.__state[(str(box),str(info_hash))] = [torrent,last,uploaded,rates]
+        except sqlite3.Error as e:
+            raise StatsHistoryError("init error: %s: %s" %(path,e))
+    def __len__(self):
+        return len(self.__state)
+    def __repr__(self):
+        return "<StatsHistory %s (%d torrents)>" %(self.path,len(self.__state))
+    # ewma of rate over each window, after dt seconds
+    def __ewma(self,rates,rate,dt):
+        if rates is None:
+            return tuple(rate for window in self.windows)
+        return tuple(r + (1 - math.exp(-float(dt)/window))*(rate - r) for r,window in zip(rates,self.windows))
+    # adds one sample per torrent of rtor_list, taken at timestamp (default: the torrents' query time)
+    def append(self,box,rtor_list,timestamp=None):
+        samples = []
+        updates = []
+        for rtor in rtor_list:
+            if rtor.ratio is None or rtor.csize is None:
+                continue
+            t = int(timestamp if timestamp is not None else rtor.time)
+            uploaded = int(rtor.ratio*rtor.csize)
+            key = (box,rtor.info_hash)
+            state = self.__state.get(key)
+            if state is None:
+                cursor = self.__db.execute("INSERT INTO torrents (box,info_hash) VALUES (?,?)",key)
+                state = self.__state[key] = [cursor.lastrowid,None,None,None]
+            torrent,last,last_uploaded,rates = state
+            if last is not None and t <= last:
+                continue
+            if last is not None:
+                # a torrent re-added with fresh stats restarts from zero
+                rate = max(0,uploaded - last_uploaded)/float(t - last)
+                rates = self.__ewma(rates,rate,t - last)
+            state[1:] = [t,uploaded,rates]
+            samples.append((torrent,t,uploaded))
+            updates.append((t,uploaded,sqlite3.Binary(marshal.dumps(rates)) if rates is not None else None,torrent))
+        self.__db.executemany("INSERT OR REPLACE INTO samples VALUES (?,?,?)",samples)
+        self.__db.executemany("UPDATE torrents SET time=?,uploaded=?,rates=? WHERE id=?",updates)
+        self.__db.commit()
+        self.logger.debug("append: %s: %d samples" %(box,len(samples)))
+        if time.time() - self.__compacted >= self.compact_every:
+            self.compact()
+        return len(samples)
+    # the latest n (time,uploaded) samples of a torrent, newest first
+    def latest(self,box,info_hash,n):
+        state = self.__state.get((box,info_hash))
+        if state is None:
+            return []
+        return self.__db.execute("SELECT time,uploaded FROM samples WHERE torrent=? ORDER BY time DESC LIMIT ?",
+                                 (state[0],n)).fetchall()
+    # info_hash -> upload rate (bytes/s) over windows[window], for torrents of box with a known rate
+    def rates(self,box,window=0):
+        return dict((info_hash,state[3][window]) for (b,info_hash),state in self.__state.iteritems()
+                    if b == box and state[3] is not None)
+    # thins and expires old samples; returns the number of samples dropped
+    def compact(self,now=None):
+        now = int(now if now is not None else time.time())
+        self.__compacted = time.time()
+        before = self.__db.total_changes
+        self.__db.execute("DELETE FROM samples WHERE time < ?",(now - self.expire,))
+        for age,bucket in self.downsample:
+            end = now - age
+            # from the start of the bucket holding the previous end: new samples may share it
+            start = self.__thinned.get(age)
+            start = start // bucket * bucket if start is not None else -(1<<62)
+            if start >= end:
+                continue
+            self.__db.execute("DELETE FROM kept")
+            self.__db.execute("INSERT INTO kept SELECT torrent,MAX(time) FROM samples "
+                              "WHERE time >= ? AND time < ? GROUP BY torrent,time / ?",(start,end,bucket))
+            self.__db.execute("DELETE FROM samples WHERE time >= ? AND time < ? AND NOT EXISTS ("
+                              "SELECT 1 FROM kept WHERE kept.torrent = samples.torrent AND kept.time = samples.time)",
+                              (start,end))
+            self.__thinned[age] = end
+        # torrents with no samples left are forgotten
+        gone = self.__db.execute("SELECT id,box,info_hash FROM torrents WHERE id NOT IN "
+                                 "(SELECT DISTINCT torrent FROM samples)").fetchall()
+        self.__db.executemany("DELETE FROM torrents WHERE id=?",[(torrent,) for torrent,box,info_hash in gone])
+        for torrent,box,info_hash in gone:
+            self.__state.pop((str(box),str(info_hash)),None)
+        self.__db.commit()
+        dropped = self.__db.total_changes - before - len(gone)
+        self.logger.debug("compact: %d samples, %d torrents dropped" %(dropped,len(gone)))
+        return dropped
+    def close(self):
+        self.__db.commit()
+        self.__db.close()
@@ -0,0 +1,205 @@
+import os, marshal, struct, zlib, copy, functools, logging
+from collections import OrderedDict
+
+from .record import LocalRecord,RemoteRecord
+from .torrent import LocalTorrent,LocalTorrentError,RemoteTorrent,RemoteTorrentError
+
+class StateJournalError(Exception):
+    pass
+
+class StateJournal:
+    """
+    Write-ahead journal of the queues, backed by an append-only file and a snapshot
+    Purpose is to restart where the last run stopped: transfers are neither lost
+     nor redone, and the queues are rebuilt without re-reading every torrent.
+
+    Records (LocalRecord, RemoteRecord) are attached by name: every addition and
+     deletion they report is appended to the journal as it happens. Dictionaries
+     (failure counts, pending lookups) are tracked by name: what changed in them
+     is appended by sync(), which then flushes the journal to disk, and before
+     any change of a record is, so that an item moved from a dictionary to a
+     record or back (an upload: up queue -> pending lookups) is in one of them
+     after a crash.
+     Once snapshot_every entries have been appended, sync() writes a snapshot
+     of everything attached and tracked, and starts an empty journal.
+     - path: location of the journal file; the snapshot is path + '.snapshot'
+     - snapshot_every: number of entries appended between snapshots
+
+    Entries are framed by their length and CRC32, and numbered: on open, the
+     snapshot is read, then the journal entries it does not already hold; a torn
+     entry at the end of the journal (a crash mid-write) is dropped.
+     attach() and track() fill an empty record or dictionary with its saved state;
+     LocalTorrents whose file is gone are not restored. Values are stored with
+     marshal, so they must be plain data.
+
+    Records restore in the order of their additions since the last snapshot;
+     reordering (ltor_sort, insertion at a position) is only kept by snapshots.
+    """
+    __header = struct.Struct("!II")
+    __add = 'a'
+    __del = 'd'
+    def __init__(self,path,snapshot_every=10000):
+        self.logger = logging.getLogger("StateJournal")
+        self.path = path
+        self.path_snapshot = path + '.snapshot'
+        self.snapshot_every = snapshot_every
+        # name -> [(key,value),...] as saved; consumed by attach() and track()
+        self.__saved = {}
+        # name -> (record,encode)
+        self.__attached = {}
+        # name -> (mapping,copy of mapping at the last sync)
+        self.__tracked = {}
+        self.__seq = 0
+        self.__entries = 0
+        try:
+            self.__load()
+            self.__file = open(self.path,'ab')
+        except (IOError,OSError) as e:
+            raise StateJournalError("init error: %s: %s" %(path,e))
+    def __len__(self):
+        return self.__entries
+    def __repr__(self):
+        return "<StateJournal %s (%d entries)>" %(self.path,self.__entries)
+    @classmethod
+    def __frame(cls,data):
+        payload = marshal.dumps(data)
+        return cls.__header.pack(len(payload),zlib.crc32(payload) & 0xffffffff) + payload
+    # yields (offset after the frame,data) for each intact frame of buf
+    @classmethod
+    def __frames(cls,buf):
+        offset = 0
+        size = cls.__header.size
+        while offset + size <= len(buf):
+            length,crc = cls.__header.unpack_from(buf,offset)
+            payload = buf[offset+size:offset+size+length]
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                return
+            try:
+                data = marshal.loads(payload)
+            except (ValueError,EOFError,TypeError):
+                return
+            offset += size + length
+            yield offset,data
+    def __load(self):
+        # name -> OrderedDict of key -> value
+        saved = {}
+        if os.path.exists(self.path_snapshot):
+            with open(self.path_snapshot,'rb') as snapshot:
+                frames = list(self.__frames(snapshot.read()))
+            if len(frames) != 1:
+                raise StateJournalError("init error: bad snapshot: %s" %(self.path_snapshot))
+            self.__seq,state = frames[0][1]
+            saved = dict((name,OrderedDict(items)) for name,items in state.iteritems())
+        good = 0
+        if os.path.exists(self.path):
+            with open(self.path,'rb') as journal:
+                buf = journal.read()
+            for good,(seq,op,name,key,value) in self.__frames(buf):
+                if seq <= self.__seq:
+                    continue
+                self.__seq = seq
+                self.__entries += 1
+                if op == self.__add:
+                    saved.setdefault(name,OrderedDict())[key] = value
+                else:
+                    saved.get(name,{}).pop(key,None)
+            if good < len(buf):
+                self.logger.warning("load: dropping %d bytes of torn entries" %(len(buf) - good))
+                with open(self.path,'r+b') as journal:
+                    journal.truncate(good)
+        self.__saved = dict((name,entries.items()) for name,entries in saved.iteritems())
+        self.logger.info("load: %d names, %d entries since the snapshot" %(len(saved),self.__entries))
+    def __append(self,op,name,key,value=None):
+        self.__seq += 1
+        self.__entries += 1
+        self.__file.write(self.__frame((self.__seq,op,name,key,value)))
+    # journals the changes reported by a record; flushed so that they survive a crash
+    def __delta(self,name,encode,added,removed,changed):
+        self.__append_tracked()
+        for item in removed:
+            self.__append(self.__del,name,encode(item,False)[0])
+        for item in added + changed:
+            key,value = encode(item)
+            self.__append(self.__add,name,key,value)
+        self.__file.flush()
+    # (key,value) of a record item; value is only built when needed
+    @staticmethod
+    def __encode_ltor(ltor,value=True):
+        return ltor.path,ltor.fields() if value else None
+    @staticmethod
+    def __encode_rtor(rtor,value=True):
+        if not value:
+            return rtor.info_hash,None
+        return rtor.info_hash,dict((key,getattr(rtor,key)) for key in RemoteTorrent.__slots__
+                                   if key not in ('score','rate') and hasattr(rtor,key))
+    # journals the changes of record under name; an empty record is first filled with its saved state
+    def attach(self,name,record):
+        if isinstance(record,LocalRecord):
+            encode = self.__encode_ltor
+        elif isinstance(record,RemoteRecord):
+            encode = self.__encode_rtor
+        else:
+            raise StateJournalError("attach error: not a record: %s" %(name))
+        saved = self.__saved.pop(name,())
+        if saved and not record:
+            restored = []
+            for key,value in saved:
+                try:
+                    if isinstance(record,LocalRecord):
+                        restored.append(LocalTorrent(key,cache=record.cache,fields=value))
+                    else:
+                        restored.append(RemoteTorrent.from_fields(value,value['time']))
+                except (LocalTorrentError,RemoteTorrentError) as e:
+                    self.logger.debug("attach: %s: not restored: %s" %(name,e))
+            record.record = restored
+            self.logger.info("attach: %s: restored %d of %d" %(name,len(restored),len(saved)))
+        self.__attached[name] = (record,encode)
+        record.subscribe(functools.partial(self.__delta,name,encode))
+    # journals the changes of mapping under name at each sync(); an empty mapping is first filled
+    def track(self,name,mapping):
+        saved = self.__saved.pop(name,())
+        if saved and not mapping:
+            mapping.update(saved)
+        self.__tracked[name] = (mapping,copy.deepcopy(mapping))
+    # journals the changes of the tracked mappings since they were last journaled
+    def __append_tracked(self):
+        for name,(mapping,synced) in self.__tracked.iteritems():
+            for key in synced.keys():
+                if key not in mapping:
+                    self.__append(self.__del,name,key)
+                    del synced[key]
+            for key,value in mapping.iteritems():
+                if key not in synced or synced[key] != value:
+                    self.__append(self.__add,name,key,value)
+                    synced[key] = copy.deepcopy(value)
+    # journals the changes of the tracked mappings, and makes the journal durable
+    def sync(self):
+        self.__append_tracked()
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        if self.__entries >= self.snapshot_every:
+            self.snapshot()
+    # writes everything attached and tracked to the snapshot, and empties the journal
+    def snapshot(self):
+        state = {}
+        for name,(record,encode) in self.__attached.iteritems():
+            state[name] = [encode(item) for item in record]
+        for name,(mapping,synced) in self.__tracked.iteritems():
+            state[name] = mapping.items()
+            self.__tracked[name] = (mapping,copy.deepcopy(mapping))
+        # saved state that was never attached is kept
+        for name,items in self.__saved.iteritems():
+            state.setdefault(name,items)
+        tmp = self.path_snapshot + '.tmp'
+        with open(tmp,'wb') as snapshot:
+            snapshot.write(self.__frame((self.__seq,state)))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(tmp,self.path_snapshot)
+        self.__file.close()
+        self.__file = open(self.path,'wb')
+        self.logger.debug("snapshot: %d entries compacted at %d" %(self.__entries,self.__seq))
+        self.__entries = 0
+    def close(self):
+        self.sync()
+        self.__file.close()
@@ -0,0 +1,75 @@
+import logging
+
+class LocatorError(Exception):
+    pass
+
+class Locator(object):
+    """
+    Index of where torrents are, across records
+    Purpose is to answer "is torrent X queued or seeded anywhere" with one dict
+     lookup, instead of a search of every record of every seedbox.
+
+    Records (LocalRecord, RemoteRecord) are watched under a location, any hashable
+     label, e.g. (seedbox,'info'). watch() indexes a record's current torrents by
+     info-hash and by name, then follows the changes the record reports to its
+     subscribers (additions, deletions, merges). Replacing a record's contents
+     wholesale (record.record = ...) is not reported: watch it afterwards.
+
+    locate() returns every location holding a torrent, in the order the locations
+     were watched; find() returns the first one, or None.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger("Locator")
+        # location -> position in watch order
+        self.__locations = {}
+        # info_hash/name -> {location: count}
+        self.__by_hash = {}
+        self.__by_name = {}
+    def __len__(self):
+        return len(self.__by_hash)
+    def __repr__(self):
+        return "<Locator (%d locations, %d torrents)>" %(len(self.__locations),len(self.__by_hash))
+    @staticmethod
+    def __add(index,key,location):
+        if key is None:
+            return
+        counts = index.setdefault(key,{})
+        counts[location] = counts.get(location,0) + 1
+    @staticmethod
+    def __del(index,key,location):
+        counts = index.get(key)
+        if not counts or location not in counts:
+            return
+        counts[location] -= 1
+        if not counts[location]:
+            del counts[location]
+            if not counts:
+                del index[key]
+    def __delta(self,location,added,removed,changed):
+        for tor in removed:
+            self.__del(self.__by_hash,tor.info_hash,location)
+            self.__del(self.__by_name,tor.name,location)
+        for tor in added:
+            self.__add(self.__by_hash,tor.info_hash,location)
+            self.__add(self.__by_name,tor.name,location)
+    # indexes record under location, and keeps it indexed as the record changes
+    def watch(self,location,record):
+        if location in self.__locations:
+            raise LocatorError("watch error: location already watched: %s" %(location,))
+        self.__locations[location] = len(self.__locations)
+        self.__delta(location,added=list(record),removed=(),changed=())
+        record.subscribe(lambda added,removed,changed: self.__delta(location,added,removed,changed))
+        self.logger.debug("watch: %s" %(location,))
+    # info_hash > name
+    def locate(self,info_hash=None,name=None):
+        if info_hash:
+            counts = self.__by_hash.get(info_hash)
+        elif name:
+            counts = self.__by_name.get(name)
+        else:
+            counts = None
+        return sorted(counts,key=self.__locations.get) if counts else []
+    # info_hash > name
+    def find(self,info_hash=None,name=None):
+        locations = self.locate(info_hash=info_hash,name=name)
+        return locations[0] if locations else None
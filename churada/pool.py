@@ -0,0 +1,140 @@
+import paramiko, socket, time, logging, threading
+
+class ConnectionPoolError(Exception):
+    pass
+
+class ConnectionPool:
+    """
+    Keeps one authenticated SSH connection per (uname,host) alive across cycles
+    Purpose is to pay for the handshake and authentication once, rather than at
+     every flush of a Shell's ssh queue.
+
+    get() hands out the pooled paramiko SSHClient of a host, after a health check:
+     the transport must be active and authenticated, and a connection idle for
+     more than check_after seconds must also accept an SSH_MSG_IGNORE packet.
+     A dead connection is replaced transparently; failed connects are retried
+     up to attempts times, sleeping backoff seconds doubled after each failure
+     (at most max_backoff). A host that still cannot be reached is not tried
+     again for max_backoff seconds: get() raises ConnectionPoolError meanwhile.
+     - keepalive: seconds between keepalive packets sent by the transport
+     - connect: function (uname,host) -> connected SSHClient (default: paramiko,
+      with the user's keys and AutoAddPolicy)
+
+    stats() reports, per host: connects, reuses, failures (failed connects),
+     discards (connections found dead or dropped after an error), the time spent
+     connecting, and the count and time of the commands run (see Shell).
+
+    A pool may be used from several threads (see engine.Engine): the connection
+     to a host is checked, made and dropped under a lock of that host, so
+     connecting to one host does not hold up the others.
+    """
+    def __init__(self,keepalive=30,check_after=60,attempts=5,backoff=1,max_backoff=60,connect=None):
+        self.logger = logging.getLogger("ConnectionPool")
+        self.keepalive = keepalive
+        self.check_after = check_after
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connect = connect or self.__connect
+        # (uname,host) -> SSHClient
+        self.__clients = {}
+        # (uname,host) -> time of the last get()
+        self.__used = {}
+        # (uname,host) -> time before which no connect is attempted
+        self.__retry_at = {}
+        self.__stats = {}
+        # (uname,host) -> RLock
+        self.__locks = {}
+        self.__lock = threading.Lock()
+    def __len__(self):
+        return len(self.__clients)
+    def __repr__(self):
+        return "<ConnectionPool (%d connections)>" %(len(self.__clients))
+    @staticmethod
+    def __connect(uname,host):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host,username=uname)
+        return client
+    def __key_lock(self,key):
+        with self.__lock:
+            return self.__locks.setdefault(key,threading.RLock())
+    def __stat(self,key):
+        if key not in self.__stats:
+            self.__stats[key] = {'connects':0,'reuses':0,'failures':0,'discards':0,
+                                 'connect_time':0.0,'commands':0,'command_time':0.0}
+        return self.__stats[key]
+    def __healthy(self,key,client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        if time.time() - self.__used.get(key,0) > self.check_after:
+            try:
+                transport.send_ignore()
+            except (paramiko.SSHException,socket.error,EOFError):
+                return False
+        return True
+    # a healthy connection to uname@host, pooled or new
+    def get(self,uname,host):
+        with self.__key_lock((uname,host)):
+            return self.__get(uname,host)
+    def __get(self,uname,host):
+        key = (uname,host)
+        stat = self.__stat(key)
+        client = self.__clients.get(key)
+        if client is not None:
+            if self.__healthy(key,client):
+                stat['reuses'] += 1
+                self.__used[key] = time.time()
+                return client
+            self.logger.info("get: %s@%s: connection lost" %(uname,host))
+            self.discard(uname,host)
+        if time.time() < self.__retry_at.get(key,0):
+            raise ConnectionPoolError("get error: %s@%s: unreachable, backing off" %(uname,host))
+        delay = self.backoff
+        for i in reversed(range(0,self.attempts)):
+            start = time.time()
+            try:
+                client = self.connect(uname,host)
+            except (paramiko.SSHException,socket.error) as e:
+                stat['failures'] += 1
+                self.logger.warning("get: %s@%s: connect failed: %s" %(uname,host,e))
+                if i == 0:
+                    self.__retry_at[key] = time.time() + self.max_backoff
+                    raise
+                time.sleep(delay)
+                delay = min(2*delay,self.max_backoff)
+                continue
+            stat['connects'] += 1
+            stat['connect_time'] += time.time() - start
+            client.get_transport().set_keepalive(self.keepalive)
+            self.__clients[key] = client
+            self.__used[key] = time.time()
+            self.__retry_at.pop(key,None)
+            self.logger.debug("get: %s@%s: connected" %(uname,host))
+            return client
+    # closes and forgets the connection to uname@host, e.g. after an error on it
+    def discard(self,uname,host):
+        with self.__key_lock((uname,host)):
+            client = self.__clients.pop((uname,host),None)
+            if client is not None:
+                self.__stat((uname,host))['discards'] += 1
+                try:
+                    client.close()
+                except (paramiko.SSHException,socket.error,EOFError):
+                    pass
+    # records a command run on the connection to uname@host, and its duration
+    def timed(self,uname,host,seconds):
+        with self.__key_lock((uname,host)):
+            stat = self.__stat((uname,host))
+            stat['commands'] += 1
+            stat['command_time'] += seconds
+    # 'uname@host' -> copy of its counters
+    def stats(self):
+        return dict(("%s@%s" %key,dict(stat)) for key,stat in self.__stats.iteritems())
+    def close(self):
+        for uname,host in self.__clients.keys():
+            self.discard(uname,host)
+
+# connections shared by every Shell that is not given a pool
+shared = ConnectionPool()
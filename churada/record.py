@@ -1,8 +1,78 @@
-import logging,copy,time
-from .torrent import LocalTorrent
+import logging,time,heapq,itertools
+from collections import OrderedDict
+from operator import attrgetter
+from .torrent import LocalTorrent,RemoteTorrent
+from .deluge import ConsoleBackend
 
+class _Slots(object):
+    """
+    Items in order, indexed by key(item)
+    Purpose is to let records be iterated without copying, and mutated meanwhile
+
+    Deleting an item leaves a tombstone (None) in its slot, so positions stay
+     valid and an iteration in progress keeps walking the same list; it stops
+     at the length the list had when it started, so items appended meanwhile
+     are not yielded, and items deleted meanwhile are skipped. Reordering
+     (inserting at a position, sorting, dropping the tombstones once they
+     outnumber the items) builds a new list: iterations in progress keep
+     walking the old one as a snapshot, as if they had copied it.
+
+    A list without tombstones is walked by a plain list iterator, which is about
+     three times faster than one skipping them. The first deletion after such a
+     walk starts then copies the list, so that the walk never meets a tombstone:
+     it goes on over the old list as a snapshot, and items deleted meanwhile
+     are yielded.
+    """
+    __slots__ = ('key','items','pos','dead','shared')
+    def __init__(self,key,items=()):
+        self.key = key
+        self.reset(items)
+    def __len__(self):
+        return len(self.pos)
+    def __contains__(self,key):
+        return key in self.pos
+    def __iter__(self):
+        if not self.dead:
+            self.shared = True
+            return itertools.islice(self.items,0,len(self.items))
+        return (item for item in itertools.islice(self.items,0,len(self.items)) if item is not None)
+    def reset(self,items):
+        self.items = list(items)
+        self.pos = dict((self.key(item),i) for i,item in enumerate(self.items))
+        self.dead = 0
+        # whether a plain walk may be going over items (see __iter__)
+        self.shared = False
+    def values(self):
+        if not self.dead:
+            return self.items[:]
+        return [item for item in self.items if item is not None]
+    def get(self,key,default=None):
+        i = self.pos.get(key)
+        return self.items[i] if i is not None else default
+    def append(self,item):
+        self.pos[self.key(item)] = len(self.items)
+        self.items.append(item)
+    def insert(self,pos,item):
+        if pos is None or not 0 <= pos < len(self.pos):
+            return self.append(item)
+        items = self.values()
+        items.insert(pos,item)
+        self.reset(items)
+    def remove(self,key):
+        i = self.pos.pop(key)
+        if self.shared:
+            self.items = self.items[:]
+            self.shared = False
+        item = self.items[i]
+        self.items[i] = None
+        self.dead += 1
+        if self.dead > len(self.pos) + 32:
+            self.reset(self.values())
+        return item
+    def sort(self,key):
+        self.reset(sorted(self.values(),key=key))
 
-class LocalRecord:
+class LocalRecord(object):
     """
     Manages records, including creation, deletion, updating;
     asserts uniqueness for records, and ensures torrent files are validated
@@ -14,48 +84,104 @@ class LocalRecord:
 
     Supports add, del, find, and update operations for each of 
      LocalTorrent (ltor) and RecordTorrent (rtor) queues
-     Operations may be called by object or name (and by path for LocalTorrents)
+     Operations may be called by object, info-hash or name (and by path for LocalTorrents)
     Since uniqueness is maintained, operations are always performed on any 
      object present in the queue which is equal to the passed argument.
+
+    LocalTorrents are kept in slots keyed by path, with indexes by info-hash
+     and name, so membership, find and delete do not scan the queue; only
+     inserting at a position other than the end rebuilds it. Iterating does not
+     copy the queue, and stays safe while it is mutated (see _Slots).
+
+    Each ltor_add/ltor_del that changes the queue is reported as
+     func(added=[...],removed=[...],changed=[]) to the functions registered with
+     subscribe(), e.g. a StateJournal.
+
+    LocalTorrents created from a path are looked up in cache (a MetadataCache) first.
     """
-    def __init__(self, shell):
+    def __init__(self, shell, cache=None):
         self.logger = logging.getLogger("Record")
-        self.record = []
+        self.__record = _Slots(attrgetter('path'))
+        self.__by_hash = {}
+        # name -> [ltor,...]; names need not be unique
+        self.__by_name = {}
+        self.__subscribers = []
         self.shell = shell
+        self.cache = cache
     def __nonzero__(self):
-        return bool(self.record)
+        return bool(self.__record)
+    def __len__(self):
+        return len(self.__record)
     def __iter__(self):
-        return iter(copy.copy(self.record))
+        return iter(self.__record)
     def __repr__(self):
-        return str(self.record) 
+        return str(self.__record.values()) 
+    @property
+    def record(self):
+        return self.__record.values()
+    @record.setter
+    def record(self,record):
+        self.__record = _Slots(attrgetter('path'))
+        self.__by_hash = {}
+        self.__by_name = {}
+        for ltor in record:
+            self.__index(ltor)
+    def __index(self,ltor,pos=None):
+        self.__record.insert(pos,ltor)
+        if ltor.info_hash is not None:
+            self.__by_hash[ltor.info_hash] = ltor
+        self.__by_name.setdefault(ltor.name,[]).append(ltor)
+    def __unindex(self,ltor):
+        self.__record.remove(ltor.path)
+        if self.__by_hash.get(ltor.info_hash) is ltor:
+            del self.__by_hash[ltor.info_hash]
+        named = self.__by_name[ltor.name]
+        named.remove(ltor)
+        if not named:
+            del self.__by_name[ltor.name]
     # ltor > path
     def ltor_add(self,ltor=None,path=None,pos=None):
-        if ltor and ltor not in self.record:
-            if pos not in range(0,len(self.record)+1):
-                pos = len(self.record)
-            self.record.insert(pos,ltor)
+        if ltor and not self.ltor_find(ltor=ltor):
+            self.__index(ltor,pos)
             self.logger.debug("ltor_add: add %s" %(ltor))
+            for func in self.__subscribers:
+                func(added=[ltor],removed=[],changed=[])
         elif path:
-            ltor = LocalTorrent(path)
+            ltor = LocalTorrent(path,cache=self.cache)
             self.ltor_add(pos=pos,ltor=ltor)
-    # ltor > name > path
-    def ltor_del(self,ltor=None,name=None,path=None):
-        if ltor and ltor in self.record:
-            self.record.remove(ltor)
-            self.logger.debug("ltor_del: delete %s"%(ltor))
+    # ltor > info_hash > name > path
+    def ltor_del(self,ltor=None,name=None,path=None,info_hash=None):
+        if ltor:
+            ltor = self.ltor_find(ltor=ltor)
+            if ltor:
+                self.__unindex(ltor)
+                self.logger.debug("ltor_del: delete %s"%(ltor))
+                for func in self.__subscribers:
+                    func(added=[],removed=[ltor],changed=[])
+        elif info_hash:
+            self.ltor_del(ltor=self.ltor_find(info_hash=info_hash))
         elif name:
             self.ltor_del(ltor=self.ltor_find(name=name))
         elif path:
             self.ltor_del(ltor=self.ltor_find(path=path))
-    # ltor > name > path
-    def ltor_find(self,ltor=None,name=None,path=None):
+    # ltor > info_hash > name > path
+    # ltors are equal if either their info-hash or their path match
+    def ltor_find(self,ltor=None,name=None,path=None,info_hash=None):
         result = None
         if ltor:
-            result = next((e for e in self.record if e == ltor),None)
+            result = self.__by_hash.get(ltor.info_hash) if ltor.info_hash is not None else None
+            result = result or self.__record.get(ltor.path)
+        elif info_hash:
+            result = self.__by_hash.get(info_hash)
         elif name:
-            result = next((e for e in self.record if e.name == name),None)
+            named = self.__by_name.get(name)
+            if named and len(named) > 1:
+                # rare: keep the queue order among torrents sharing a name
+                result = next((e for e in self.__record if e.name == name),None)
+            elif named:
+                result = named[0]
         elif path:
-            result = next((e for e in self.record if e.path == path),None)
+            result = self.__record.get(path)
         return result
     # ltor > name > path
 #    def ltor_update(self,ltor=None,name=None,path=None):
@@ -65,52 +191,234 @@ class LocalRecord:
 #            self.ltor_del(ltor=result)
 #            ltor_new = LocalTorrent(result.path)
 #            self.ltor_add(ltor=ltor_new,pos=index)
+    # func(added=[...],removed=[...],changed=[...]) is called after each change
+    def subscribe(self,func):
+        self.__subscribers.append(func)
+    def unsubscribe(self,func):
+        self.__subscribers.remove(func)
     def ltor_sort(self,key=lambda ltor: ltor.size):
-        self.record.sort(key=key)
-        self.logger("ltor_sort: sorting")
+        self.__record.sort(key)
+        self.logger.debug("ltor_sort: sorting")
+
+class RemoteRecord(object):
+    """
+    Keeps RemoteTorrents in order, indexed by info-hash
+    Purpose is to mirror the torrents present on a seedbox
+
+    merge() folds a fresh listing into the record: new torrents are appended,
+     vanished ones dropped and existing ones updated in place, so per-cycle
+     work follows the churn. Each merge reports its (added,removed,changed)
+     lists to the functions registered with subscribe(); so do rtor_del and
+     the additions of rtor_add and resolve(), one torrent at a time.
+
+    The torrents are kept in slots keyed by info-hash: iterating does not copy
+     the record, and stays safe while it is mutated (see _Slots).
 
-class RemoteRecord:
-    def __init__(self,shell):
+    Torrents added by name or info-hash are not queried one by one: they wait in
+     pending until resolve(), which looks all of them up with a single query
+     through backend (deluge-console by default). Results are matched back by
+     info-hash, then by name; lookups that still fail after __max_attempts
+     resolves are dropped.
+
+    iter_by_score() and iter_by_priority() walk the record in ascending order of
+     the score and priority functions (by default: the torrent's score, with
+     unscored torrents last, and the order of insertion). Each order is a heap
+     built on first use and kept up to date as torrents are added, removed or
+     changed; stale entries are skipped, and the heap is rebuilt once they
+     outnumber the live ones. Taking the next torrent costs O(log n).
+     Scores that change outside of merge() (e.g. rates) are passed to rekey().
+    """
+    __max_attempts = 5
+    def __init__(self,shell,backend=None,score=None,priority=None):
         self.logger = logging.getLogger("RemoteRecord")
-        self.record = []
+        self.__record = _Slots(attrgetter('info_hash'))
+        self.__subscribers = []
+        self.__keys = {'score':score or self.__score,'priority':priority or (lambda rtor: 0)}
+        # order -> (heap of [key,seq,rtor],{info_hash: live entry})
+        self.__orders = {}
+        self.__seq = itertools.count()
+        # bumped whenever a heap changes, so that walks in progress restart
+        self.__version = 0
+        # info_hash or name -> [name,info_hash,pos,attempts]
+        self.pending = OrderedDict()
         self.shell = shell
-        self.info_cmd = "deluge-console \"connect 127.0.0.1:33307; info %s\""
+        self.backend = backend or ConsoleBackend(shell)
     def __iter__(self):
-        return iter(copy.copy(self.record))
+        return iter(self.__record)
+    def __len__(self):
+        return len(self.__record)
     def __repr__(self):
-        return self.record
-    # helper function for seedbox_manager
-    def __rtor_add(self,data,pos=None):
-        rtor = RemoteTorrent(time.time(),data)
-        if rtor not in self.record:
-            if pos not in range(0,len(self.record)+1):
-                pos = len(self.record)
-            self.record.insert(pos,rtor)
-            self.logger.debug("rtor_add: add %s" %(rtor))
-    # rtor > name
-    def rtor_add(self,rtor=None,name=None,pos=None):
-        if rtor and rtor not in self.record:
-            self.record.append(rtor)
-        elif name:
-            command = self.info_cmd %(name)
-            func = self.__rtor_add
-            self.shell.add_ssh(command,func,{'pos':pos})
-    # rtor > name
-    def rtor_del(self,rtor=None,name=None):
-        if rtor and rtor in self.record:
-            self.record.remove(rtor)
-            self.logger.debug("rtro_del: delete %s" %(rtor))
+        return str(self.__record.values())
+    @property
+    def record(self):
+        return self.__record.values()
+    @record.setter
+    def record(self,record):
+        self.__record = _Slots(attrgetter('info_hash'),record)
+        self.__orders = {}
+        self.__version += 1
+    @staticmethod
+    def __score(rtor):
+        score = getattr(rtor,'score',None)
+        return score if score is not None else float('inf')
+    # the (heap,entries) of order, built on first use
+    def __order(self,order):
+        if order not in self.__orders:
+            key = self.__keys[order]
+            entries = dict((rtor.info_hash,[key(rtor),self.__seq.next(),rtor]) for rtor in self.__record)
+            heap = entries.values()
+            heapq.heapify(heap)
+            self.__orders[order] = (heap,entries)
+            self.__version += 1
+        return self.__orders[order]
+    def __order_add(self,rtor):
+        for order,(heap,entries) in self.__orders.iteritems():
+            entry = [self.__keys[order](rtor),self.__seq.next(),rtor]
+            entries[rtor.info_hash] = entry
+            heapq.heappush(heap,entry)
+            self.__version += 1
+    def __order_del(self,rtor):
+        for order,(heap,entries) in self.__orders.iteritems():
+            entries.pop(rtor.info_hash,None)
+            if len(heap) > 2*len(entries) + 64:
+                heap[:] = entries.values()
+                heapq.heapify(heap)
+                self.__version += 1
+    # re-sorts rtors whose score or priority changed
+    def rekey(self,rtors):
+        for order,(heap,entries) in self.__orders.iteritems():
+            key = self.__keys[order]
+            for rtor in rtors:
+                entry = entries.get(rtor.info_hash)
+                if entry is not None and entry[0] != key(rtor):
+                    entry = [key(rtor),self.__seq.next(),rtor]
+                    entries[rtor.info_hash] = entry
+                    heapq.heappush(heap,entry)
+                    self.__version += 1
+            if len(heap) > 2*len(entries) + 64:
+                heap[:] = entries.values()
+                heapq.heapify(heap)
+                self.__version += 1
+    # best-first walk of the heap tree: the heap itself is not popped, so the
+    #  first k torrents cost O(k log k); if the heap changes, the walk restarts
+    #  from the root and skips the torrents already yielded
+    def __iter_order(self,order,filter=None):
+        done = set()
+        while True:
+            heap,entries = self.__order(order)
+            version = self.__version
+            frontier = [(heap[0],0)] if heap else []
+            while frontier and version == self.__version:
+                entry,i = heapq.heappop(frontier)
+                for j in (2*i+1,2*i+2):
+                    if j < len(heap):
+                        heapq.heappush(frontier,(heap[j],j))
+                rtor = entry[2]
+                if entries.get(rtor.info_hash) is not entry or rtor.info_hash in done:
+                    continue
+                done.add(rtor.info_hash)
+                if filter is None or filter(rtor):
+                    yield rtor
+            if version == self.__version:
+                return
+    # lowest score first, e.g. for deletion
+    def iter_by_score(self,filter=None):
+        return self.__iter_order('score',filter)
+    # lowest priority value first, e.g. for downloads
+    def iter_by_priority(self,filter=None):
+        return self.__iter_order('priority',filter)
+    def __insert(self,rtor,pos=None):
+        self.__record.insert(pos,rtor)
+        self.__order_add(rtor)
+        self.logger.debug("rtor_add: add %s" %(rtor))
+        for func in self.__subscribers:
+            func(added=[rtor],removed=[],changed=[])
+    # rtor > info_hash > name
+    def rtor_add(self,rtor=None,name=None,pos=None,info_hash=None):
+        if rtor:
+            if rtor.info_hash not in self.__record:
+                self.__insert(rtor,pos)
+        elif info_hash or name:
+            if info_hash in self.__record or (not info_hash and self.rtor_find(name=name)):
+                return
+            self.pending.setdefault(info_hash or name,[name,info_hash,pos,0])
+    # looks up every pending torrent with a single backend query
+    def resolve(self):
+        if not self.pending:
+            return
+        keys = self.pending.keys()
+        names = [name for name,info_hash,pos,attempts in self.pending.itervalues() if not info_hash]
+        ids = [info_hash for name,info_hash,pos,attempts in self.pending.itervalues() if info_hash]
+        self.logger.debug("resolve: %d names, %d info-hashes" %(len(names),len(ids)))
+        self.backend.add_info(self.__resolved,{'keys':keys},names=names,ids=ids)
+    def __resolved(self,exitcode,output,keys):
+        for rtor in output or ():
+            entry = self.pending.pop(rtor.info_hash,None)
+            named = self.pending.pop(rtor.name,None)
+            entry = entry or named
+            if entry is not None and rtor.info_hash not in self.__record:
+                self.__insert(rtor,entry[2])
+        # only the lookups sent with this query count as attempted
+        for key in keys:
+            entry = self.pending.get(key)
+            if entry is None:
+                continue
+            entry[3] += 1
+            if entry[3] >= self.__max_attempts:
+                del self.pending[key]
+                self.logger.warning("resolve: %s not found after %d attempts" %(key,entry[3]))
+    # rtor > info_hash > name
+    def rtor_del(self,rtor=None,name=None,info_hash=None):
+        if rtor and rtor.info_hash in self.__record:
+            rtor = self.__record.remove(rtor.info_hash)
+            self.__order_del(rtor)
+            self.logger.debug("rtor_del: delete %s" %(rtor))
+            for func in self.__subscribers:
+                func(added=[],removed=[rtor],changed=[])
+        elif info_hash:
+            self.rtor_del(rtor=self.rtor_find(info_hash=info_hash))
         elif name:
             self.rtor_del(rtor=self.rtor_find(name=name))
-    def rtor_find(self,rtor=None,name=None):
+    # rtor > info_hash > name
+    def rtor_find(self,rtor=None,name=None,info_hash=None):
         result = None
         if rtor:
-            result = next((e for e in self.record if e == rtor),None)
+            result = self.__record.get(rtor.info_hash)
+        elif info_hash:
+            result = self.__record.get(info_hash)
         elif name:
-            result = next((e for e in self.record if e.name == name),None)
+            result = next((e for e in self.__record if e.name == name),None)
         return result
+    # folds a fresh listing into the record; returns (added,removed,changed)
+    def merge(self,rtor_list):
+        fresh = set()
+        added = []
+        changed = []
+        for rtor in rtor_list:
+            fresh.add(rtor.info_hash)
+            current = self.__record.get(rtor.info_hash)
+            if current is None:
+                self.__record.append(rtor)
+                self.__order_add(rtor)
+                added.append(rtor)
+            elif current is not rtor and current.update(rtor):
+                changed.append(current)
+        removed = [rtor for rtor in self.__record if rtor.info_hash not in fresh]
+        for rtor in removed:
+            self.__record.remove(rtor.info_hash)
+            self.__order_del(rtor)
+        self.rekey(changed)
+        self.logger.debug("merge: %d added, %d removed, %d changed" %(len(added),len(removed),len(changed)))
+        for func in self.__subscribers:
+            func(added=added,removed=removed,changed=changed)
+        return added,removed,changed
+    # func(added=[...],removed=[...],changed=[...]) is called after each change
+    def subscribe(self,func):
+        self.__subscribers.append(func)
+    def unsubscribe(self,func):
+        self.__subscribers.remove(func)
     def rtor_sort(self,key=lambda rtor: rtor.score):
-        self.record.sort(key=key)
+        self.__record.sort(key)
         self.logger.debug("rtor_sort: sorting")
 #    def rtor_update(self,rtor=None,name=None):
 #        result = self.rtor_find(rtor=rtor,name=name)
@@ -0,0 +1,180 @@
+import struct
+
+class RencodeError(Exception):
+    pass
+
+# type codes, as used by deluge's rencode
+CHR_LIST = chr(59)
+CHR_DICT = chr(60)
+CHR_INT = chr(61)
+CHR_INT1 = chr(62)
+CHR_INT2 = chr(63)
+CHR_INT4 = chr(64)
+CHR_INT8 = chr(65)
+CHR_FLOAT32 = chr(66)
+CHR_FLOAT64 = chr(44)
+CHR_TRUE = chr(67)
+CHR_FALSE = chr(68)
+CHR_NONE = chr(69)
+CHR_TERM = chr(127)
+
+# small values are packed into the type code itself
+INT_POS_FIXED_START = 0
+INT_POS_FIXED_COUNT = 44
+INT_NEG_FIXED_START = 70
+INT_NEG_FIXED_COUNT = 32
+DICT_FIXED_START = 102
+DICT_FIXED_COUNT = 25
+STR_FIXED_START = 128
+STR_FIXED_COUNT = 64
+LIST_FIXED_START = STR_FIXED_START + STR_FIXED_COUNT
+LIST_FIXED_COUNT = 64
+
+_int_formats = ((CHR_INT1,'!b',1<<7),(CHR_INT2,'!h',1<<15),(CHR_INT4,'!l',1<<31),(CHR_INT8,'!q',1<<63))
+
+def _encode(value,out):
+    if value is None:
+        out.append(CHR_NONE)
+    elif value is True:
+        out.append(CHR_TRUE)
+    elif value is False:
+        out.append(CHR_FALSE)
+    elif isinstance(value,(int,long)):
+        if INT_POS_FIXED_START <= value < INT_POS_FIXED_START + INT_POS_FIXED_COUNT:
+            out.append(chr(INT_POS_FIXED_START + value))
+        elif -INT_NEG_FIXED_COUNT <= value < 0:
+            out.append(chr(INT_NEG_FIXED_START - 1 - value))
+        else:
+            for code,fmt,limit in _int_formats:
+                if -limit <= value < limit:
+                    out.extend((code,struct.pack(fmt,value)))
+                    break
+            else:
+                out.extend((CHR_INT,str(value),CHR_TERM))
+    elif isinstance(value,float):
+        out.extend((CHR_FLOAT64,struct.pack('!d',value)))
+    elif isinstance(value,basestring):
+        if isinstance(value,unicode):
+            value = value.encode('utf8')
+        if len(value) < STR_FIXED_COUNT:
+            out.extend((chr(STR_FIXED_START + len(value)),value))
+        else:
+            out.extend((str(len(value)),':',value))
+    elif isinstance(value,(list,tuple)):
+        if len(value) < LIST_FIXED_COUNT:
+            out.append(chr(LIST_FIXED_START + len(value)))
+            for item in value:
+                _encode(item,out)
+        else:
+            out.append(CHR_LIST)
+            for item in value:
+                _encode(item,out)
+            out.append(CHR_TERM)
+    elif isinstance(value,dict):
+        if len(value) < DICT_FIXED_COUNT:
+            out.append(chr(DICT_FIXED_START + len(value)))
+            for key,item in value.iteritems():
+                _encode(key,out)
+                _encode(item,out)
+        else:
+            out.append(CHR_DICT)
+            for key,item in value.iteritems():
+                _encode(key,out)
+                _encode(item,out)
+            out.append(CHR_TERM)
+    else:
+        raise RencodeError("encode error: unsupported type %s" %(type(value).__name__))
+
+def dumps(value):
+    out = []
+    _encode(value,out)
+    return "".join(out)
+
+class Decoder:
+    """
+    Recursive-descent rencode decoder
+    Purpose is to read deluge RPC messages; lists are returned as tuples
+     and strings as byte strings, as deluge's own decoder does for ASCII data.
+
+    Trailing data after the top-level value is rejected.
+    """
+    __fixed_ints = dict((chr(INT_POS_FIXED_START + i),i) for i in range(INT_POS_FIXED_COUNT))
+    __fixed_ints.update((chr(INT_NEG_FIXED_START + i),-1-i) for i in range(INT_NEG_FIXED_COUNT))
+    __packed = {CHR_INT1:('!b',1),CHR_INT2:('!h',2),CHR_INT4:('!l',4),CHR_INT8:('!q',8),
+                CHR_FLOAT32:('!f',4),CHR_FLOAT64:('!d',8)}
+    __constants = {CHR_TRUE:True,CHR_FALSE:False,CHR_NONE:None}
+    def __init__(self,data):
+        self.data = data
+    def decode(self):
+        try:
+            value,end = self.__decode(0)
+        except (IndexError,ValueError,TypeError,struct.error):
+            raise RencodeError("decode error: badly formed data")
+        if end != len(self.data):
+            raise RencodeError("decode error: trailing data at offset %d" %(end))
+        return value
+    # returns (value, offset of the next value)
+    def __decode(self,i):
+        data = self.data
+        c = data[i]
+        code = ord(c)
+        if STR_FIXED_START <= code < STR_FIXED_START + STR_FIXED_COUNT:
+            end = i + 1 + code - STR_FIXED_START
+            return self.__string(i+1,end),end
+        elif c in self.__fixed_ints:
+            return self.__fixed_ints[c],i+1
+        elif LIST_FIXED_START <= code < LIST_FIXED_START + LIST_FIXED_COUNT:
+            result = []
+            i += 1
+            for _ in xrange(code - LIST_FIXED_START):
+                value,i = self.__decode(i)
+                result.append(value)
+            return tuple(result),i
+        elif DICT_FIXED_START <= code < DICT_FIXED_START + DICT_FIXED_COUNT:
+            result = {}
+            i += 1
+            for _ in xrange(code - DICT_FIXED_START):
+                key,i = self.__decode(i)
+                result[key],i = self.__decode(i)
+            return result,i
+        elif '0' <= c <= '9':
+            colon = data.index(':',i)
+            start = colon + 1
+            end = start + int(data[i:colon])
+            return self.__string(start,end),end
+        elif c in self.__packed:
+            fmt,size = self.__packed[c]
+            return struct.unpack(fmt,data[i+1:i+1+size])[0],i+1+size
+        elif c in self.__constants:
+            return self.__constants[c],i+1
+        elif c == CHR_INT:
+            end = data.index(CHR_TERM,i)
+            return int(data[i+1:end]),end+1
+        elif c == CHR_LIST:
+            result = []
+            i += 1
+            while data[i] != CHR_TERM:
+                value,i = self.__decode(i)
+                result.append(value)
+            return tuple(result),i+1
+        elif c == CHR_DICT:
+            result = {}
+            i += 1
+            while data[i] != CHR_TERM:
+                key,i = self.__decode(i)
+                result[key],i = self.__decode(i)
+            return result,i+1
+        raise RencodeError("decode error: unexpected %r at offset %d" %(c,i))
+    def __string(self,start,end):
+        if end > len(self.data):
+            raise RencodeError("decode error: string overruns data at offset %d" %(start))
+        value = self.data[start:end]
+        # deluge sends names as utf8; keep ASCII as byte strings
+        try:
+            decoded = value.decode('utf8')
+        except UnicodeDecodeError:
+            return value
+        return value if len(decoded) == len(value) else decoded
+
+def loads(data):
+    return Decoder(data).decode()
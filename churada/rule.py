@@ -6,12 +6,16 @@ class RuleError(Exception):
 class Rule:
     """
     Wrapper for rule-queries
+    Queries read the key as an attribute, so slotted records work;
+     a missing attribute fails the query.
     """
+    __missing = object()
     def __init__(self,key,func):
         self.key = key
         self.func = func
     def query(self,other):
-        return self.key in other.__dict__ and self.func(other.__dict__[self.key])
+        value = getattr(other,self.key,self.__missing)
+        return value is not self.__missing and self.func(value)
 
 class CompositeRule:
     """
@@ -4,6 +4,9 @@ from operator import itemgetter
 from .torrent import LocalTorrent,RemoteTorrent
 from .record import LocalRecord,RemoteRecord
 from .shell import Shell
+from .deluge import ConsoleBackend
+from .history import StatsHistory
+from . import transfer
 
 class SeedboxError(Exception):
     pass
@@ -16,29 +19,42 @@ class Seedbox:
      - up_queue - LocalRecord representing a queue of files to upload. Populated externally.
      - down_queue - RemoteRecord representing a queue of files to download. Populated individually after each successful upload
      - info - RemoteRecord representing the totality of the records on the remote server
-      used to organize deletion events
+      used to organize deletion events; deletion walks it by lowest score first
+     - history - StatsHistory of info, if paths['local_history'] is set; each update is
+      appended to it, and info is then scored by recent upload rate instead
      
      - rules are a tuple of the form (key,func) for use in query functions
      - r_download_valid - list of rules that determine if a download is valid
      - r_download_path - list of rules that determine where to download a path.
       - elements are triples of the form (rule,path,priority)
       - sorted by priority; first match is used
+      - the down_queue is downloaded in order of the priority of the first match
      - r_delete_valid - list of rules that determine if a deletion is valid
+
+     - backend - how deluged is queried: a callable taking the seedbox's Shell and
+      returning a backend, e.g. deluge.RPCBackend (default: deluge.ConsoleBackend)
     """
     __upload_limit = 0.25
     __download_limit = 0.25
     __upload_command = ["rsync","-n"]
     __download_command = ["rsync","-rn"]
-    __delete_command = "deluge-console \"connect 127.0.0.1:33307; info \'%s\'\"" # rm --remove-data \'%s\'<F12>\"" 
     __size_command = "du --block-size=1 -s ~/"
-    __info_command = "deluge-console \"connect 127.0.0.1:33307; info\""
     __max_failures = 5
+    # ssh commands run at once (see Shell)
+    __channels = 8
+    # uploads (and downloads) in flight at once, within the limits of transfer.shared
+    __transfer_streams = 2
+    # seconds the results of read-only ssh commands are reused (see Shell)
+    __cache_ttl = 60
+    # consecutive read-only ssh commands are sent as one script (see Shell)
+    __bundle = True
     # NOTE: must assign local path when appending things to download queue
-    def __init__(self,uname,host,capacity,paths,rules):
-        self.shell = Shell(uname,host)
+    def __init__(self,uname,host,capacity,paths,rules,backend=ConsoleBackend):
+        self.shell = Shell(uname,host,channels=self.__channels,transfers=transfer.shared,
+                           cache_ttl=self.__cache_ttl,bundle=self.__bundle)
+        self.backend = backend(self.shell)
         self.up_queue = LocalRecord(self.shell)
-        self.down_queue = RemoteRecord(self.shell)
-        self.info = RemoteRecord(self.shell)
+        self.down_queue = RemoteRecord(self.shell,self.backend,priority=self.__download_priority)
 
         self.upload_failures = {}
         self.download_failures = {}
@@ -46,6 +62,13 @@ class Seedbox:
         self.path_remote_torrent = self.shell.path + ":" + paths['remote_torrent']
         self.path_remote_data = self.shell.path + ":" + paths['remote_data']
         self.path_local_data = os.path.normpath(paths['local_data'])
+        self.history = None
+        score = None
+        if paths.get('local_history'):
+            self.history = StatsHistory(os.path.normpath(paths['local_history']))
+            score = lambda rtor: rtor.rate if rtor.rate is not None else float('inf')
+        self.info = RemoteRecord(self.shell,self.backend,score=score)
+        self.info.subscribe(self.__info_delta)
 
         if not os.path.isdir(self.path_local_data):
             raise SeedboxError("init error:  bad local data path")
@@ -67,6 +90,12 @@ class Seedbox:
             if rule.query(rtor):
                 return path
         return self.path_remote_data
+    # higher rule priorities download first; unmatched torrents come last
+    def __download_priority(self,rtor):
+        for rule,path,priority in self.rules['download_path']:
+            if rule.query(rtor):
+                return -priority
+        return float('inf')
     def __check_delete_valid(self,rtor):
         return reduce(lambda x,y: x and y.query(rtor),self.rules['delete_valid'],True)
     def __size(self,exitcode,output):
@@ -74,18 +103,37 @@ class Seedbox:
             match = re.match("\d+",output)
             self.size = int(match.group())
             self.logger.info("size used: %.2f GiB" %(self.size/float(1<<30)))
+    # output is a list of RemoteTorrents (see deluge.ConsoleBackend)
     def __update(self,exitcode,output):
+        # a listing that failed or could not be read has no exitcode 0 (see ConsoleBackend)
         if exitcode == 0:
-            rtor_list = RemoteTorrent.batch_parse(output,time.time())
-            self.info = RemoteRecord(self.shell)
-            for rtor in rtor_list:
-                self.info.rtor_add(rtor=rtor)
-            
-    def act(self):
+            rtor_list = output
+            added,removed,changed = self.info.merge(rtor_list)
+            self.logger.info("update: %d added, %d removed, %d changed" %(len(added),len(removed),len(changed)))
+            if self.history is not None:
+                self.history.append(self.shell.path,rtor_list)
+                rates = self.history.rates(self.shell.path)
+                rerated = []
+                for rtor in self.info:
+                    rate = rates.get(rtor.info_hash)
+                    if rate != rtor.rate:
+                        rtor.rate = rate
+                        rerated.append(rtor)
+                self.info.rekey(rerated)
+    # keeps the download queue in step with the seedbox listing
+    def __info_delta(self,added,removed,changed):
+        for rtor in removed:
+            self.down_queue.rtor_del(info_hash=rtor.info_hash)
+        for rtor in changed:
+            queued = self.down_queue.rtor_find(info_hash=rtor.info_hash)
+            if queued is not None and queued is not rtor:
+                queued.update(rtor)
+    # the steps of act: queues commands, then yields the queue to process ('ssh' or 'shell')
+    def phases(self):
         # update
         self.update_info()
         self.update_size()
-        self.shell.do_ssh()
+        yield 'ssh'
         # delete stuff
         up_size = 0
         for ltor in self.up_queue:
@@ -93,97 +141,135 @@ class Seedbox:
                 up_size += ltor.size
         delete_size = up_size - self.free
         self.delete(delete_size)
-        self.shell.do_ssh()
+        yield 'ssh'
         # check size
         self.update_size()
-        self.shell.do_ssh()
+        yield 'ssh'
         # upload files
         self.upload(self.free)
-        self.shell.do_shell()
+        yield 'shell'
         self.download(self.download_limit)
-        self.shell.do_shell()
-    def delete(self,space,rtor_iter=None,rtor=None,exitcode=None,output=None):
+        yield 'shell'
+    def act(self):
+        for queue in self.phases():
+            if queue == 'ssh':
+                self.shell.do_ssh()
+            else:
+                self.shell.do_shell()
+    # act, as steps for Engine.spawn: each queue is processed on the engine
+    def act_async(self,engine):
+        for queue in self.phases():
+            if queue == 'ssh':
+                yield self.shell.flush_ssh(engine)
+            else:
+                yield self.shell.flush_shell(engine)
+    # deletes torrents until space is freed: victims are planned up front and
+    #  removed in one backend call; torrents that could not be deleted are replaced
+    #  by the next candidates in another call
+    def delete(self,space,rtor_iter=None,victims=None,exitcode=None,output=None):
         if not rtor_iter:
-            rtor_iter = iter(self.info)
-        if rtor and exitcode == 0: # successful delete
-            space -= rtor.size
-            self.down_queue.rtor_del(rtor=rtor)
-            self.logger.info("(%0.f MiB / %0.f MiB left) delete %s" %(rtor.size/float(1<<20),space/float(1<<20),rtor))
+            rtor_iter = self.info.iter_by_score()
+        for rtor in victims or ():
+            if output and output.get(rtor.info_hash):
+                space -= rtor.size
+                self.down_queue.rtor_del(rtor=rtor)
+                self.logger.info("(%0.f MiB / %0.f MiB left) delete %s" %(rtor.size/float(1<<20),space/float(1<<20),rtor))
+            else:
+                self.logger.warning("delete failed: %s" %(rtor))
         if space <= 0: # done with deleting
             return
-        try:
-            rtor = rtor_iter.next()
-            while not self.__check_delete_valid(rtor):
-                rtor = rtor_iter.next()
-        except StopIteration:
+        victims = self.__plan_delete(space,rtor_iter)
+        if not victims:
             return
-        command = self.__delete_command %(rtor.name)
         func = self.delete
-        args = {'rtor':rtor,'rtor_iter':rtor_iter,'space':space}
-        self.shell.add_ssh(command,func,args)
-    def download(self,space,rtor_iter=None,rtor=None,exitcode=None,output=None):
-        if not rtor_iter:
-            rtor_iter = iter(self.down_queue)
-        # check to see if the previous download was successful
-        if rtor and exitcode == 0:
-            space -= rtor.size
-            self.down_queue.rtor_del(rtor=rtor)
-            self.logger.info("(%0.f MiB / %0.f MiB left) download %s" %(rtor.size/float(1<<20),space/float(1<<20),rtor))
-        if space <= 0:
-            return
-        try:
-            rtor = rtor_iter.next()
-            while not self.__check_download_valid(rtor):
-                rtor = rtor_iter.next()
-        except StopIteration:
+        args = {'victims':victims,'rtor_iter':rtor_iter,'space':space}
+        self.backend.add_delete(victims,func,args)
+    # the next valid candidates, until their sizes cover space
+    def __plan_delete(self,space,rtor_iter):
+        victims = []
+        for rtor in rtor_iter:
+            if self.__check_delete_valid(rtor):
+                victims.append(rtor)
+                space -= rtor.size
+                if space <= 0:
+                    break
+        return victims
+    # downloads the down queue by priority while it fits in space, in up to
+    #  __transfer_streams transfers at once (see Shell and TransferPool)
+    def download(self,space):
+        batch = {'space':space,'rtor_iter':self.down_queue.iter_by_priority(),'skipped':[]}
+        for i in range(0,self.__transfer_streams):
+            self.__download_next(batch)
+    # the next item of a batch that fits in its space, which is then reserved until
+    #  the transfer is done; items too large for now are kept for when space is given back
+    @staticmethod
+    def __batch_next(batch,items):
+        for i,item in enumerate(batch['skipped']):
+            if item.size <= batch['space']:
+                del batch['skipped'][i]
+                batch['space'] -= item.size
+                return item
+        for item in items:
+            if item.size <= batch['space']:
+                batch['space'] -= item.size
+                return item
+            batch['skipped'].append(item)
+        return None
+    # queues the next download that fits
+    def __download_next(self,batch):
+        if batch['space'] <= 0:
             return
-        # if we have enough space, download
-        if rtor.size <= space:
+        rtor = self.__batch_next(batch,(rtor for rtor in batch['rtor_iter'] if self.__check_download_valid(rtor)))
+        if rtor is not None:
             download_path = self.__check_download_path(rtor)
             if not download_path:
                 download_path = self.path_local_data
-            command = self.__download_command
-            command.extend([self.path_remote_data,download_path])
-            func = self.download
-            args = {'rtor':rtor,'rtor_iter':rtor_iter,'space':space}
-            self.shell.add_shell(command,func,args)
-        # otherwise, move on 
+            command = self.__download_command + [self.path_remote_data,download_path]
+            args = {'rtor':rtor,'batch':batch}
+            self.shell.add_shell(command,self.__downloaded,args)
+    def __downloaded(self,rtor,batch,exitcode,output):
+        if exitcode == 0:
+            self.down_queue.rtor_del(rtor=rtor)
+            self.logger.info("(%0.f MiB / %0.f MiB left) download %s" %(rtor.size/float(1<<20),batch['space']/float(1<<20),rtor))
         else:
-            self.download(space,rtor_iter=rtor_iter)
+            batch['space'] += rtor.size
+        self.__download_next(batch)
     def enqueue(self,ltor):
         self.up_queue.ltor_add(ltor=ltor)
-    def find(self,name):
-        return self.up_queue.ltor_find(name=name) or self.info.rtor_find(name=name)
+    # info_hash > name
+    def find(self,name=None,info_hash=None):
+        return (self.up_queue.ltor_find(name=name,info_hash=info_hash) or
+                self.info.rtor_find(name=name,info_hash=info_hash))
     @property
     def free(self):
         return self.capacity - self.size
     def update_info(self):
         self.logger.info("updating info")
-        self.shell.add_ssh(self.__info_command,self.__update,{})
+        self.backend.add_info(self.__update,{})
+        # torrents uploaded since the last update, looked up together
+        self.down_queue.resolve()
     def update_size(self):
         self.logger.info("updating size")
-        self.shell.add_ssh(self.__size_command,self.__size,{})
-    def upload(self,space,ltor_iter=None,ltor=None,exitcode=None,output=None):
-        if not ltor_iter:
-            ltor_iter = iter(self.up_queue)
-        # successful upload
-        if ltor and exitcode == 0:
-            space -= ltor.size
-            self.down_queue.rtor_add(name=ltor.name)
+        self.shell.add_ssh(self.__size_command,self.__size,{},idempotent=True)
+    # uploads the up queue in order while it fits in space, in up to
+    #  __transfer_streams transfers at once (see Shell and TransferPool)
+    def upload(self,space):
+        batch = {'space':space,'ltor_iter':iter(self.up_queue),'skipped':[]}
+        for i in range(0,self.__transfer_streams):
+            self.__upload_next(batch)
+    # queues the next upload that fits
+    def __upload_next(self,batch):
+        ltor = self.__batch_next(batch,batch['ltor_iter'])
+        if ltor is not None:
+            command = self.__upload_command + [ltor.path,self.path_remote_torrent]
+            args = {'ltor':ltor,'batch':batch}
+            self.shell.add_shell(command,self.__uploaded,args)
+    def __uploaded(self,ltor,batch,exitcode,output):
+        if exitcode == 0:
+            self.down_queue.rtor_add(name=ltor.name,info_hash=ltor.info_hash)
             self.up_queue.ltor_del(ltor=ltor)
-            self.logger.info("(%0.f MiB / %0.f MiB) upload %s" %(ltor.size/float(1<<20),space/float(1<<20),ltor))
-        try:
-            ltor = ltor_iter.next()
-        except StopIteration:
-            return
-        # if we have enough space, upload
-        if ltor.size <= space:
-            command = self.__upload_command
-            command.extend([ltor.path,self.path_remote_torrent])
-            func = self.upload
-            args = {'ltor':ltor,'ltor_iter':ltor_iter,'space':space}
-            self.shell.add_shell(command,func,args)
-        # otherwise, move on to the next item 
+            self.logger.info("(%0.f MiB / %0.f MiB) upload %s" %(ltor.size/float(1<<20),batch['space']/float(1<<20),ltor))
         else:
-            self.upload(space,ltor_iter=ltor_iter)
+            batch['space'] += ltor.size
+        self.__upload_next(batch)
 
@@ -1,4 +1,60 @@
-import paramiko, subprocess, logging, select
+import paramiko, subprocess, logging, select, socket, time, pipes, sys
+
+from .pool import ConnectionPoolError,shared as shared_pool
+from .engine import Task
+
+class ChannelReader:
+    """
+    Collects the output of a command running on a paramiko Channel
+    Purpose is to wait for output without spinning, and to read it in large
+     chunks: both stdout and stderr are drained as data arrives, so a command
+     that writes a lot to stderr cannot stall on a full channel window.
+     - stream: called with each stdout chunk as it arrives, if given
+
+    drain() reads whatever is ready and returns True once the command is done;
+     read() waits on the channel with select between drains. The channel's pipe
+     wakes select on stdout data and at EOF; stderr data is picked up within
+     wait seconds. Chunks are joined once, when the output is asked for.
+    """
+    chunk = 65536
+    wait = 0.1
+    def __init__(self,channel,stream=None):
+        self.channel = channel
+        self.stream = stream
+        self.exitcode = None
+        self.__out = []
+        self.__err = []
+    def fileno(self):
+        return self.channel.fileno()
+    @property
+    def output(self):
+        return "".join(self.__out)
+    @property
+    def errors(self):
+        return "".join(self.__err)
+    def drain(self):
+        channel = self.channel
+        while channel.recv_ready():
+            chunk = channel.recv(self.chunk)
+            if not chunk:
+                break
+            self.__out.append(chunk)
+            if self.stream is not None:
+                self.stream(chunk)
+        while channel.recv_stderr_ready():
+            chunk = channel.recv_stderr(self.chunk)
+            if not chunk:
+                break
+            self.__err.append(chunk)
+        if not (channel.eof_received or channel.closed) or channel.recv_ready() or channel.recv_stderr_ready():
+            return False
+        # the exit status comes with or before the close: this does not wait long
+        self.exitcode = channel.recv_exit_status()
+        return True
+    def read(self):
+        while not self.drain():
+            select.select([self.channel],[],[],self.wait)
+        return (self.exitcode,self.output)
 
 class Shell:
     """ 
@@ -12,10 +68,71 @@ class Shell:
       which includes both command, func, and arguments
     - resolve the queue using do_ssh or do_shell, 
       individually processing each command, and calling func(output,**args)
+    - an ssh command may also be a callable; it is called with the connected
+      paramiko SSHClient and returns (exitcode,output) (see deluge.RPCBackend)
+    - an ssh command may be given a stream function, called with each chunk of
+      its output as it arrives; func still gets the whole output
+
+    SSH output is read by a ChannelReader; stderr is logged, not returned.
+
+    The SSH connection comes from a ConnectionPool (by default pool.shared), and
+     stays open between flushes. A command whose channel cannot be opened is
+     retried once on a fresh connection; if the host cannot be reached, every
+     queued command is answered with exitcode and output None.
+
+    With channels > 1, do_ssh runs up to that many commands at once, each on its
+     own session channel of the one connection, and calls each func as its
+     command completes: a flush takes as long as its slowest commands instead of
+     the sum of all of them. Commands queued with the same chain key still run
+     one after the other, in queue order, as do their funcs. Callable commands
+     use the client itself, and are run one at a time as they come up.
+
+    On an Engine (see engine.Engine), run_ssh and run_local start one command on
+     the engine's workers and return a Task of its (exitcode,output). flush_ssh
+     and flush_shell process a queue as do_ssh and do_shell do, without blocking:
+     they return a Task that is done once every queued command, including those
+     queued by the funcs, has completed. funcs are called from the thread that
+     waits on the engine. Queued commands keep their chain keys; callable
+     commands share one chain, as they may share state tied to the client.
+
+    Given a TransferPool (see transfer.TransferPool), the shell queue runs there
+     instead, with the shell as owner: several local commands run at once, within
+     the pool's limits, and each func is called as its process exits.
+
+    SSH commands queued as idempotent (read-only, e.g. a listing or a du) are
+     coalesced: an identical command already queued, and not started yet, takes
+     the new func as well, and its result is handed to every func. With cache_ttl
+     set, their successful results are also kept that many seconds, and queuing
+     the command again is answered from the cache. Any other ssh command counts
+     as mutating: queuing it empties the cache, and idempotent commands queued
+     after it are not merged with those queued before. Callable commands are
+     never coalesced, as their funcs may depend on the call itself.
+
+    With bundle set, each run of two or more consecutive idempotent commands in
+     the queue is sent as one remote script when the queue is processed: one
+     exec and one round trip instead of one per command. The script runs the
+     commands one after the other and prints each one's output as a section,
+     headed by its index, exit code and length; the sections are handed back to
+     each command's funcs. Commands in a bundle run sequentially, whatever
+     channels is; commands with a chain key are not bundled.
     """
-    __connection_attempts = 5
-    def __init__(self,uname=None,host=None):
+    # chain of the callable commands of a flush
+    __client_chain = object()
+    # header of a section of a bundle's output: index, exit code, length
+    __section = "#churada %d %d %d\\n"
+    def __init__(self,uname=None,host=None,pool=None,channels=1,transfers=None,cache_ttl=0,bundle=False):
         self.logger = logging.getLogger("Shell")
+        self.pool = pool if pool is not None else shared_pool
+        self.channels = channels
+        self.transfers = transfers
+        self.cache_ttl = cache_ttl
+        self.bundle = bundle
+        # command -> (time,exitcode,output) of idempotent commands
+        self.__cache = {}
+        # command -> [(func,args)] of the queued idempotent command not started yet
+        self.__coalesced = {}
+        # counts the mutating commands queued, so results of older reads are not cached
+        self.__generation = 0
         self.ssh_queue = []
         self.shell_queue = []
         self.host = host
@@ -29,25 +146,6 @@ class Shell:
         return "Shell(\"%s\", \"%s\")" %(self.uname,self.host)
     def __str__(self):
         return self.path
-    def __connect(self):
-        if not self.path:
-            return
-        for i in reversed(range(0,self.__connection_attempts)):
-            try:
-                client = paramiko.SSHClient()
-                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                client.connect(self.host,username=self.uname)
-                self.__client = client
-                self.logger.debug("connect: %s" %(self.path))
-                return 
-            except paramiko.ssh_exception.SSHException as e:
-                if i == 0:
-                    raise e
-                time.sleep(1)
-    def __disconnect(self):
-        if self.__client != None:
-            self.__client.close()
-            self.__client = None
     def __shell_command(self,command):
 #        command = re.split(" ",command)
         self.logger.debug("shell command: (%s) %s",self,command)
@@ -58,63 +156,361 @@ class Shell:
             output = e.output
             exitcode = e.returncode
         return (exitcode,output)
-    def __ssh_command(self,command):
-        if not self.path:
-            return
+    def __ssh_command(self,client,command,stream):
         self.logger.debug("ssh command: (%s) %s",self,command)
-        stdin,stdout,stderr = self.__client.exec_command(command)
-        output = ""
-        while not stdout.channel.exit_status_ready():
-            if stdout.channel.recv_ready():
-                rl,wl,xl = select.select([stdout.channel],[],[],0.0)
-                if len(rl) >= 0:
-                    part = stdout.channel.recv(1024)
-                    while part:
-                        output += part
-                        part = stdout.channel.recv(1024)
-        exitcode = stdout.channel.recv_exit_status()
+        try:
+            stdin,stdout,stderr = client.exec_command(command)
+        except (paramiko.SSHException,socket.error,EOFError):
+            # the pooled connection died since it was checked: once more on a new one
+            self.pool.discard(self.uname,self.host)
+            client = self.pool.get(self.uname,self.host)
+            stdin,stdout,stderr = client.exec_command(command)
+        reader = ChannelReader(stdout.channel,stream)
+        exitcode,output = reader.read()
+        self.__log_errors(command,reader)
         return (exitcode,output)
-    def add_ssh(self,command,func,args):
+    def __log_errors(self,command,reader):
+        errors = reader.errors
+        if errors:
+            self.logger.debug("ssh stderr: (%s) %s: %s",self,command,errors[:1024])
+    # commands with the same chain key (any hashable but None) are never run concurrently
+    def add_ssh(self,command,func,args,chain=None,stream=None,idempotent=False):
         if not self.path:
             return
-        self.ssh_queue.append( (command,func,args) )
+        if not idempotent or callable(command):
+            self.__generation += 1
+            self.__cache.clear()
+            self.__coalesced.clear()
+            self.ssh_queue.append( (command,func,args,chain,stream) )
+            return
+        cached = self.__cache.get(command)
+        if cached is not None and time.time() - cached[0] < self.cache_ttl:
+            self.logger.debug("ssh cached: (%s) %s",self,command)
+            self.ssh_queue.append( (lambda client,result=cached[1:]: result,func,args,chain,None) )
+            return
+        waiters = self.__coalesced.get(command)
+        if waiters is not None:
+            self.logger.debug("ssh coalesced: (%s) %s",self,command)
+            waiters.append((func,args))
+            return
+        waiters = self.__coalesced[command] = [(func,args)]
+        args = {'command':command,'waiters':waiters,'generation':self.__generation}
+        self.ssh_queue.append( (command,self.__fanout,args,chain,stream) )
+    # an idempotent command that starts takes no more funcs
+    def __taken(self,func,args):
+        if func == self.__fanout and self.__coalesced.get(args['command']) is args['waiters']:
+            del self.__coalesced[args['command']]
+    def __fanout(self,command,waiters,generation,exitcode,output):
+        if self.__coalesced.get(command) is waiters:
+            del self.__coalesced[command]
+        if exitcode == 0 and self.cache_ttl and generation == self.__generation:
+            self.__cache[command] = (time.time(),exitcode,output)
+        for func,args in waiters:
+            args['exitcode'] = exitcode
+            args['output'] = output
+            func(**args)
     def add_shell(self,command,func,args):
         self.shell_queue.append( (command,func,args) )
+    # the remote script running commands in turn, and printing their sections
+    @classmethod
+    def bundle_script(cls,commands):
+        lines = ['t=$(mktemp) || exit 1',"trap 'rm -f \"$t\"' EXIT"]
+        for i,command in enumerate(commands):
+            lines.append('( %s ) >"$t"; c=$?; printf %s %d "$c" $(wc -c <"$t"); cat "$t"'
+                         %(command,pipes.quote(cls.__section),i))
+        return "sh -c %s" %(pipes.quote("\n".join(lines)))
+    # (exitcode,output) of each of count commands, from a bundle's output; (None,None) if missing
+    @classmethod
+    def unbundle(cls,output,count):
+        results = [(None,None)]*count
+        pos = 0
+        while output and pos < len(output):
+            end = output.find("\n",pos)
+            if end < 0:
+                break
+            try:
+                marker,i,exitcode,length = output[pos:end].split(" ")
+                i,exitcode,length = int(i),int(exitcode),int(length)
+            except ValueError:
+                break
+            if marker != "#churada" or not 0 <= i < count or end + 1 + length > len(output):
+                break
+            results[i] = (exitcode,output[end + 1:end + 1 + length])
+            pos = end + 1 + length
+        return results
+    # replaces each run of consecutive idempotent commands in the queue by a bundle
+    def __bundle(self):
+        queue = []
+        run = []
+        for entry in self.ssh_queue + [None]:
+            if entry is not None and entry[1] == self.__fanout and entry[3] is None:
+                run.append(entry)
+                continue
+            if len(run) > 1:
+                for command,func,args,chain,stream in run:
+                    self.__taken(func,args)
+                script = self.bundle_script([command for command,func,args,chain,stream in run])
+                self.logger.debug("ssh bundle: (%s) %d commands",self,len(run))
+                queue.append( (script,self.__unbundled,{'entries':run},None,None) )
+            else:
+                queue.extend(run)
+            run = []
+            if entry is not None:
+                queue.append(entry)
+        self.ssh_queue[:] = queue
+    def __unbundled(self,entries,exitcode,output):
+        results = self.unbundle(output,len(entries)) if output is not None else [(None,None)]*len(entries)
+        if output is not None and (None,None) in results:
+            self.logger.error("ssh bundle: (%s) %d of %d sections missing (exit code %s)"
+                              %(self,results.count((None,None)),len(entries),exitcode))
+        for (command,func,args,chain,stream),(exitcode,output) in zip(entries,results):
+            if stream is not None and output:
+                stream(output)
+            args['exitcode'] = exitcode
+            args['output'] = output
+            func(**args)
     def do_ssh(self):
         if not self.path or not self.ssh_queue or self.__doing_ssh:
             return
         self.logger.debug("start ssh queue")
-        self.__processing_ssh = True
-        self.__connect()
-        if self.__client:
-            for command,func,args in self.ssh_queue:
-                data = None
+        self.__doing_ssh = True
+        # a func that raises ends the flush: what is left of the queue is dropped
+        try:
+            if self.bundle:
+                self.__bundle()
+            try:
+                client = self.pool.get(self.uname,self.host)
+            except (paramiko.SSHException,socket.error,ConnectionPoolError) as e:
+                self.logger.error("ssh: %s: %s" %(self,e))
+                client = None
+            if self.channels > 1 and client is not None:
+                self.__do_ssh_multiplexed(client)
+            else:
+                self.__do_ssh_sequential(client)
+        finally:
+            self.ssh_queue = []
+            self.__coalesced = {}
+            self.logger.debug("stop ssh queue")
+            self.__doing_ssh = False
+    def __do_ssh_sequential(self,client):
+        # callbacks may queue more commands: they are run in this flush
+        for command,func,args,chain,stream in self.ssh_queue:
+            self.__taken(func,args)
+            exitcode,output = None,None
+            if client is not None:
+                start = time.time()
                 try:
-                    exitcode,output = self.__ssh_command(command)
-                except (paramiko.ssh_exception.SSHException) as e:
+                    if callable(command):
+                        exitcode,output = command(client)
+                    else:
+                        exitcode,output = self.__ssh_command(client,command,stream)
+                except (paramiko.SSHException,socket.error,ConnectionPoolError) as e:
                     self.logger.warning(e)
-                args['exitcode'] = exitcode
-                args['output'] = output
-                func(**args) #,data=output)
-            self.__disconnect()
-            self.ssh_queue = []
-        self.logger.debug("stop ssh queue")
-        self.__doing_ssh = False
+                    self.pool.discard(self.uname,self.host)
+                    client = None
+                self.pool.timed(self.uname,self.host,time.time() - start)
+            args['exitcode'] = exitcode
+            args['output'] = output
+            func(**args) #,data=output)
+    def __do_ssh_multiplexed(self,client):
+        # (command,func,args,chain,stream) not started yet, in queue order; callbacks may queue more
+        pending = []
+        queued = 0
+        # channel -> (entry,start time,ChannelReader)
+        running = {}
+        busy = set()
+        try:
+            while True:
+                pending.extend(self.ssh_queue[queued:])
+                queued = len(self.ssh_queue)
+                # start what fits, skipping commands whose chain is busy
+                i = 0
+                while i < len(pending) and len(running) < self.channels:
+                    command,func,args,chain,stream = entry = pending[i]
+                    if chain is not None and chain in busy:
+                        i += 1
+                        continue
+                    del pending[i]
+                    self.__taken(func,args)
+                    if client is None:
+                        self.__finish(entry,None,None)
+                        continue
+                    start = time.time()
+                    if callable(command):
+                        exitcode,output = None,None
+                        try:
+                            exitcode,output = command(client)
+                        except (paramiko.SSHException,socket.error,ConnectionPoolError) as e:
+                            self.logger.warning(e)
+                            client = self.__drop(running,busy)
+                        self.pool.timed(self.uname,self.host,time.time() - start)
+                        self.__finish(entry,exitcode,output)
+                        break # the callback may have queued commands that come first
+                    self.logger.debug("ssh command: (%s) %s",self,command)
+                    try:
+                        channel = client.get_transport().open_session()
+                        channel.exec_command(command)
+                    except (paramiko.SSHException,socket.error,EOFError) as e:
+                        self.logger.warning(e)
+                        client = self.__drop(running,busy)
+                        self.__finish(entry,None,None)
+                        continue
+                    running[channel] = (entry,start,ChannelReader(channel,stream))
+                    if chain is not None:
+                        busy.add(chain)
+                if not running:
+                    if pending or len(self.ssh_queue) > queued:
+                        continue
+                    break
+                select.select(running.keys(),[],[],ChannelReader.wait)
+                for channel in running.keys():
+                    entry,start,reader = running[channel]
+                    if not reader.drain():
+                        continue
+                    del running[channel]
+                    busy.discard(entry[3])
+                    channel.close()
+                    self.pool.timed(self.uname,self.host,time.time() - start)
+                    self.__log_errors(entry[0],reader)
+                    self.__finish(entry,reader.exitcode,reader.output)
+        finally:
+            # left open if a func raised
+            for channel in running:
+                channel.close()
+    # the connection failed: commands running on it are answered with None
+    def __drop(self,running,busy):
+        self.pool.discard(self.uname,self.host)
+        for channel,(entry,start,reader) in running.items():
+            self.__finish(entry,None,None)
+        running.clear()
+        busy.clear()
+        return None
+    def __finish(self,entry,exitcode,output):
+        command,func,args,chain,stream = entry
+        args['exitcode'] = exitcode
+        args['output'] = output
+        func(**args)
+    # drops the pooled connection of this shell
+    def close(self):
+        if self.path:
+            self.pool.discard(self.uname,self.host)
+    # moves the shell queue to the transfer pool; commands queued by funcs follow
+    def __transfer(self):
+        queue,self.shell_queue = self.shell_queue,[]
+        for command,func,args in queue:
+            self.transfers.add(self,command,self.__transferred,{'func':func,'args':args})
+    def __transferred(self,func,args,exitcode,output):
+        args['exitcode'] = exitcode
+        args['output'] = output
+        func(**args)
+        self.__transfer()
     def do_shell(self):
         if not self.shell_queue or self.__doing_shell:
             return
         self.logger.debug("start shell queue")
-        self.__processing_shell = True
-        for command,func,args in self.shell_queue:
-            data = None
+        self.__doing_shell = True
+        # a func that raises ends the flush: what is left of the queue is dropped
+        try:
+            if self.transfers is not None:
+                self.__transfer()
+                self.transfers.run(self)
+                return
+            for command,func,args in self.shell_queue:
+                exitcode,output = None,None
+                try:
+                    exitcode,output = self.__shell_command(command)
+                except OSError as e:
+                    self.logger.warning(e)
+                args['exitcode'] = exitcode
+                args['output'] = output
+                func(**args) #data = output
+        finally:
+            self.shell_queue = []
+            self.logger.debug("stop shell queue")
+            self.__doing_shell = False
+    # (exitcode,output) of command on the remote host; errors are raised
+    def __run_ssh(self,command,stream):
+        client = self.pool.get(self.uname,self.host)
+        start = time.time()
+        try:
+            if callable(command):
+                return command(client)
+            return self.__ssh_command(client,command,stream)
+        except (paramiko.SSHException,socket.error):
+            self.pool.discard(self.uname,self.host)
+            raise
+        finally:
+            self.pool.timed(self.uname,self.host,time.time() - start)
+    def run_ssh(self,engine,command,stream=None):
+        return engine.submit(self.__run_ssh,command,stream)
+    def run_local(self,engine,command):
+        return engine.submit(self.__shell_command,command)
+    def flush_ssh(self,engine):
+        if self.bundle:
+            self.__bundle()
+        return self.__flush(engine,'ssh_queue',lambda command,stream: self.run_ssh(engine,command,stream),self.channels)
+    def flush_shell(self,engine):
+        if self.transfers is not None:
+            self.__transfer()
+            return self.transfers.run_async(engine,self)
+        return self.__flush(engine,'shell_queue',lambda command,stream: self.run_local(engine,command),1)
+    def __flush(self,engine,queue,run,limit):
+        flushed = Task()
+        # entries not started yet, in queue order; callbacks may queue more
+        pending = []
+        state = {'queued':0,'running':0}
+        busy = set()
+        def normalize(entry):
+            if len(entry) == 3:
+                command,func,args = entry
+                return command,func,args,None,None
+            command,func,args,chain,stream = entry
+            if chain is None and callable(command):
+                chain = self.__client_chain
+            return command,func,args,chain,stream
+        def pump():
+            entries = getattr(self,queue)
+            pending.extend(normalize(entry) for entry in entries[state['queued']:])
+            state['queued'] = len(entries)
+            i = 0
+            while i < len(pending) and state['running'] < limit:
+                command,func,args,chain,stream = entry = pending[i]
+                if chain is not None and chain in busy:
+                    i += 1
+                    continue
+                del pending[i]
+                self.__taken(func,args)
+                state['running'] += 1
+                if chain is not None:
+                    busy.add(chain)
+                task = run(command,stream)
+                task.add_done_callback(lambda task,entry=entry: done(entry,task))
+            if not state['running'] and not pending and not flushed.done():
+                setattr(self,queue,[])
+                flushed.set_result(None)
+        def done(entry,task):
+            # a func raised: the flush is over, results still coming are dropped
+            if flushed.done():
+                return
+            command,func,args,chain,stream = entry
+            state['running'] -= 1
+            busy.discard(chain)
             try:
-                exitcode,output = self.__shell_command(command)
-            except OSError as e:
+                exitcode,output = task.result()
+            except (paramiko.SSHException,socket.error,ConnectionPoolError,EnvironmentError) as e:
                 self.logger.warning(e)
+                exitcode,output = None,None
             args['exitcode'] = exitcode
             args['output'] = output
-            func(**args) #data = output
-        self.shell_queue = []
-        self.logger.debug("stop shell queue")
-        self.__doing_shell = False
-
+            # as in do_ssh, a func that raises ends the flush: what is left of the queue is dropped
+            try:
+                func(**args)
+                pump()
+            except Exception:
+                del pending[:]
+                setattr(self,queue,[])
+                if queue == 'ssh_queue':
+                    self.__coalesced = {}
+                flushed.set_exception(sys.exc_info())
+        pump()
+        return flushed
@@ -1,93 +1,238 @@
-import os, shutil, re, logging, time
+import os, shutil, re, logging, time, hashlib
+from .bencode import Decoder,BencodeError
+from .filetable import FileTable,FileTableError
 
 
 class RemoteTorrentError(Exception):
     pass
 
-class RemoteTorrent:
+class InfoParser:
+    """
+    Line-oriented parser for the output of deluge-console 'info'
+    Purpose is to turn a (possibly very large) listing into record fields
+     in a single pass, converting sizes and times as each line is read.
+
+    Output may be fed in arbitrary chunks; feed() returns the records completed
+     so far and close() returns the last one. Records are dictionaries with
+     one key per RemoteTorrent field (None when the line is absent).
+    A record is complete once its name, ID, state, size, ratio and times are
+     known; incomplete records are dropped.
+    """
+    __keys = ('name','id','state','dspeed','uspeed','eta','cseed','tseed','cpeer','tpeer','avail',
+              'csize','size','ratio','stime','atime','tracker','tracker_status','progress')
+    __required = ('name','id','state','csize','size','ratio','stime','atime')
+    __size_dict = { 'B':1, 'K':1<<10, 'M':1<<20, 'G':1<<30, 'T':1<<40 }
+    __time_factor = [ 60*60, 60, 1]
+    def __init__(self):
+        self.logger = logging.getLogger("InfoParser")
+        self.record = None
+        self.tail = ''
+        self.__handlers = {'Name':self.__name,
+                           'ID':self.__id,
+                           'State':self.__state,
+                           'Seeds':self.__seeds,
+                           'Size':self.__size,
+                           'Seed time':self.__time,
+                           'Tracker status':self.__tracker,
+                           'Progress':self.__progress}
+    # "14.4 GiB" -> 15461882265.0, "1024" -> 1024.0
+    @classmethod
+    def __bytes(cls,token):
+        token = token.strip()
+        if not token:
+            return None
+        value,_,unit = token.partition(' ')
+        if unit:
+            return float(int(float(value) * cls.__size_dict[unit[0]]))
+        return float(value)
+    # "67 days 15:44:47" -> 5845487.0, "10000" -> 10000.0
+    @classmethod
+    def __seconds(cls,token):
+        days,_,clock = token.strip().rpartition(' days ')
+        if ':' not in clock:
+            return float(clock)
+        seconds = sum(i*int(t) for i,t in zip(cls.__time_factor,clock.split(':')))
+        return float(int(days or 0)*24*60*60 + seconds)
+    def __name(self,fields,rest):
+        fields['name'] = rest
+    def __id(self,fields,rest):
+        fields['id'] = rest.strip()
+    # "Downloading Down Speed: 16.8 MiB/s Up Speed: 44.9 KiB/s ETA: 1h 2m"
+    def __state(self,fields,rest):
+        rest,_,eta = rest.partition(' ETA: ')
+        rest,_,uspeed = rest.partition(' Up Speed: ')
+        state,_,dspeed = rest.partition(' Down Speed: ')
+        fields['state'] = state.strip()
+        fields['dspeed'] = self.__bytes(dspeed.replace('/s',''))
+        fields['uspeed'] = self.__bytes(uspeed.replace('/s',''))
+        fields['eta'] = eta.strip() or None
+    # "13 (86) Peers: 1 (6) Availability: 21.33"
+    def __seeds(self,fields,rest):
+        tokens = rest.split()
+        fields['cseed'] = float(tokens[0])
+        fields['tseed'] = float(tokens[1].strip('()'))
+        fields['cpeer'] = float(tokens[3])
+        fields['tpeer'] = float(tokens[4].strip('()'))
+        fields['avail'] = float(tokens[6])
+    # "6.4 GiB/14.4 GiB Ratio: 3.237"
+    def __size(self,fields,rest):
+        sizes,_,ratio = rest.partition(' Ratio: ')
+        csize,_,size = sizes.partition('/')
+        fields['csize'] = self.__bytes(csize)
+        fields['size'] = self.__bytes(size)
+        fields['ratio'] = float(ratio)
+    # "67 days 15:44:47 Active: 67 days 16:09:22"
+    def __time(self,fields,rest):
+        stime,_,atime = rest.partition(' Active: ')
+        fields['stime'] = self.__seconds(stime)
+        fields['atime'] = self.__seconds(atime)
+    # "tracker.ca: Announce OK"
+    def __tracker(self,fields,rest):
+        tracker,_,status = rest.partition(': ')
+        fields['tracker'] = tracker.strip()
+        fields['tracker_status'] = status.strip()
+    # "44.4% [#####~~~~]"
+    def __progress(self,fields,rest):
+        fields['progress'] = float(rest.partition('%')[0])
+    # returns the current record if it is complete, and starts a new one
+    def __finish(self):
+        fields = self.record
+        self.record = None
+        if fields is None:
+            return None
+        for key in self.__required:
+            if fields[key] is None:
+                self.logger.debug("drop: incomplete record (%s): %s" %(key,fields['name']))
+                return None
+        return fields
+    def __line(self,line,done):
+        key,sep,rest = line.rstrip('\r').partition(': ')
+        handler = self.__handlers.get(key)
+        if not sep or not handler:
+            return
+        if key == 'Name':
+            fields = self.__finish()
+            if fields:
+                done.append(fields)
+            self.record = dict.fromkeys(self.__keys)
+        elif self.record is None:
+            return
+        try:
+            handler(self.record,rest)
+        except (ValueError,IndexError,KeyError) as e:
+            self.logger.debug("drop: bad line: %s" %(line))
+    def feed(self,chunk):
+        done = []
+        lines = (self.tail + chunk).split('\n')
+        self.tail = lines.pop()
+        for line in lines:
+            self.__line(line,done)
+        return done
+    def close(self):
+        done = []
+        if self.tail:
+            self.__line(self.tail,done)
+            self.tail = ''
+        fields = self.__finish()
+        if fields:
+            done.append(fields)
+        return done
+
+class RemoteTorrent(object):
     """Record from seedbox 'info' command
-    uniquely defined by name and state
+    uniquely defined by its info-hash (the deluge torrent ID)
     Purpose is to represent a remote .torrent file and its connection info.
     The name 'Remote' suggests that we may not have access to the .torrent file.
 
     RemoteTorrent instances are meant to be wrappers for parsed deluge-console records
+    The schema is fixed (__slots__): one slot per field of an info record,
+     plus the query time, the score and the rate. Fields missing from a record are None;
+     score is only set for torrents with a non-zero active time.
+     rate is the recent upload rate (bytes/s) set by Seedbox from its StatsHistory.
     """
-    __record_pattern = ("Name: (?P<name>.+)\s*\n"
-              "ID: (?P<id>[0-9a-f]+)\s*\n"
-              "State: (?P<state>[\w]+)( Down Speed: (?P<dspeed>\d+)?/s)?( Up Speed: (?P<uspeed>\d+)/s)?( ETA: (?P<eta>[\d\w ]+))?\s*\n"
-              "(Seeds: (?P<cseed>\d+) \((?P<tseed>\d+)\) Peers: (?P<cpeer>\d+) \((?P<tpeer>\d+)\) Availability: (?P<avail>\d+\.\d+)\s*\n)?"
-			  "Size: (?P<csize>\d+)/(?P<size>\d+) Ratio: (?P<ratio>\d+\.\d+)\s*\n"
-              "Seed time: (?P<stime>\d+) Active: (?P<atime>\d+)\s*\n"
-              "Tracker status: (?P<tracker>[\w.]+): (?P<tracker_status>[\w ]+)\s*(\n)?"
-              "(Progress: (?P<progress>\d+\.\d+)\%)?")
-	
-    __size_pattern = r"(\d+\.\d+) ([KMGT])iB"
-    __time_pattern = r"(\d+) days (\d+):(\d+):(\d+)"
-    __size_dict = { 'K':1<<10, 'M':1<<20, 'G':1<<30, 'T':1<<40 }
-    __time_dict = { 'd':24*60*60, 'h':60*60, 'm':60, 's':1 }
-    __time_factor = [ 24*60*60, 60*60, 60, 1]
+    __slots__ = ('name','id','state','dspeed','uspeed','eta','cseed','tseed','cpeer','tpeer','avail',
+                 'csize','size','ratio','stime','atime','tracker','tracker_status','progress',
+                 'score','rate','time')
+    logger = logging.getLogger("RemoteTorrent")
 #    __state_list = ['Active','Allocating','Checking','Downloading','Error','Paused','Seeding','Queued']
     def __eq__(self,other):
-        return self.name == other.name
+        return self.info_hash == other.info_hash
     def __hash__(self):
-        return hash(self.name)
+        return hash(self.info_hash)
+    # info is the text of a single record
     def __init__(self,info,timestamp):
-        self.logger = logging.getLogger("RemoteTorrent")
-        self.time = timestamp
-        self.__parse(info)
+        parser = InfoParser()
+        records = parser.feed(info) + parser.close()
+        if not records:
+            raise RemoteTorrentError("init error: no data matches pattern")
+        self.__set(records[0],timestamp)
         self.logger.debug("init: %s" %(self))
     def __ne__(self,other):
-        return self.name != other.name
+        return self.info_hash != other.info_hash
     # a non-zero state implies a successful query: that torrent is present on the remote server and data is parsed correctly
     # non-zero records throw errors upon creation
     def __nonzero__(self):
         return bool(self.state) and bool(self.name)
     def __repr__(self):
         return "<rtor %.20s, %s>" %(self.name,self.state)
+    # deluge identifies torrents by their info-hash
+    @property
+    def info_hash(self):
+        return self.id
+    def __set(self,fields,timestamp):
+        self.time = timestamp
+        self.rate = None
+        for key,value in fields.iteritems():
+            setattr(self,key,value)
+        if self.atime > 0:
+            self.score = 10**6*self.ratio/self.atime
+#        if self.state not in self.__state_list:
+#            self.state = None
+        if not self:
+            raise RemoteTorrentError("init error: zero record")
+    # copies the fields of a newer record of the same torrent; returns the names of the changed fields
+    # rate is kept: it comes from the history, not from the listing
+    def update(self,other):
+        changed = []
+        for key in self.__slots__:
+            value = getattr(other,key,None)
+            if key not in ('time','rate') and getattr(self,key,None) != value:
+                setattr(self,key,value)
+                changed.append(key)
+        self.time = other.time
+        return changed
+    # builds a record from already parsed fields (see InfoParser)
     @classmethod
-    def __size_convert(cls,matchobj):
-        return str(int( float(matchobj.group(1)) * cls.__size_dict[matchobj.group(2)] ))
+    def from_fields(cls,fields,timestamp):
+        rtor = cls.__new__(cls)
+        rtor.__set(fields,timestamp)
+        return rtor
+    # yields a record for each complete entry of an info listing given in chunks
     @classmethod
-    def __time_convert(cls,matchobj):
-		return str(sum( [i*j for i,j in zip( cls.__time_factor,[int(t) for t in matchobj.groups('0')] )]) )
-    def __parse(self,info):
-        # name/state will always be present
-        self.name = None
-        self.state = None
-        # convert sizes to bytes, dates to seconds since epoch
-        info = re.sub(self.__size_pattern, self.__size_convert, info)
-        info = re.sub(self.__time_pattern, self.__time_convert, info)
-        matchobj = re.search(self.__record_pattern,info)
-        if not matchobj:
-            raise RemoteTorrentError("init error: no data matches pattern")
-        info_dict = matchobj.groupdict()
-        for key in info_dict:
-            if key != 'name' and key != 'state':
+    def stream_parse(cls,chunks,timestamp):
+        parser = InfoParser()
+        for chunk in chunks:
+            for fields in parser.feed(chunk):
                 try:
-                    info_dict[key] = float(info_dict[key])
-                except (TypeError,ValueError):
-                   pass
-        if info_dict['atime'] > 0:
-            info_dict['score'] = 10**6*info_dict['ratio']/info_dict['atime']
-#        if info_dict['state'] not in self.__state_list:
-#            info_dict['state'] = None
-        self.__dict__.update(info_dict)
-        if not self:
-            raise RemoteTorrentError("init error: zero record")
+                    yield cls.from_fields(fields,timestamp)
+                except RemoteTorrentError as e:
+                    cls.logger.debug("stream_parse: %s" %(e))
+        for fields in parser.close():
+            try:
+                yield cls.from_fields(fields,timestamp)
+            except RemoteTorrentError as e:
+                cls.logger.debug("stream_parse: %s" %(e))
     @classmethod
     def batch_parse(cls,info,timestamp):
-        info = re.sub(cls.__size_pattern, cls.__size_convert, info)
-        info = re.sub(cls.__time_pattern, cls.__time_convert, info)   
-        info_iter = re.finditer(cls.__record_pattern,info)
-        batch = [RemoteTorrent(match.group(),timestamp) for match in info_iter]
-        return batch
+        return list(cls.stream_parse([info],timestamp))
 
 class LocalTorrentError(Exception):
     pass
 
-class LocalTorrent:
+class LocalTorrent(object):
     """ Record constructed from a .torrent file
-    Uniquely defined by both name and path variables.
+    Uniquely defined by both info-hash and path variables.
+    The info-hash is the SHA-1 of the raw bencoded info dictionary, as used by deluge.
     Purpose is to represent a local .torrent file
     The name 'Local' suggests we have direct access to the .torrent file,
      but that we are uncertain of its state on the server
@@ -95,16 +240,32 @@ class LocalTorrent:
     Objects created with faulty paths or data are silently created as empty files
 
     LocalTorrent instances are meant to be wrappers for parsed *.torrent files.
+    If a MetadataCache is passed, the parsed fields (extras included, see
+     metadata) are read from it when the file is unchanged, and stored in it
+     after a parse; a hit and a parse give the same record.
+    If fields are passed (see parse_local), they are used instead of parsing.
+
+    The schema is fixed (__slots__) to the fields used by rules and scheduling;
+     any other key of the .torrent is kept in extra, a tuple of (key,value) pairs,
+     and is still readable as an attribute (e.g. getattr(ltor,'created by')).
+    Multi-file torrents keep their file list as a FileTable in files.
     """
+    __slots__ = ('name','path','size','time','info_hash','announce','files','length','last_path','extra')
+    # fields of the file rather than of its contents, not kept by MetadataCache
+    __uncached_keys = ('path','time','last_path')
+    # version of the cached schema: entries of another version are parsed again
+    __cache_version = 2
+    logger = logging.getLogger("LocalTorrent")
     def __eq__(self,other):
-        return self.name == other.name or self.path == other.path
+        return self.info_hash == other.info_hash or self.path == other.path
     def __hash__(self):
-        return hash(self.name)
-    def __init__(self,path):
-        self.logger = logging.getLogger("LocalTorrent")
+        return hash(self.info_hash)
+    def __init__(self,path,cache=None,fields=None):
+        self.extra = ()
         self.name = None
         self.path = None
         self.size = None
+        self.info_hash = None
         path = os.path.normpath(path)
         if not os.path.isabs(path):
             raise LocalTorrentError("init error: path is not absolute: %s"%(path))
@@ -113,10 +274,24 @@ class LocalTorrent:
         self.path = path
         self.time = time.time()
         self.size = os.path.getsize(self.path)
-        self.__parse()
+        meta = self.cached_fields(cache.get(self.path)) if cache is not None and not fields else None
+        if fields:
+            self.__update(fields)
+        elif meta:
+            self.__update(meta)
+        else:
+            self.__parse()
+            if cache is not None:
+                cache.put(self.path,self.metadata())
         self.logger.debug("init: %s" %(self))
+    # only called for attributes that are not set: look in the extras
+    def __getattr__(self,key):
+        for extra_key,value in object.__getattribute__(self,'extra'):
+            if extra_key == key:
+                return value
+        raise AttributeError(key)
     def __ne__(self,other):
-        return self.name != other.name and self.path != other.path
+        return self.info_hash != other.info_hash and self.path != other.path
     # need both name and path to be nonzero
     def __nonzero__(self):
         return bool(self.path) and bool(self.name)
@@ -162,30 +337,70 @@ class LocalTorrent:
         return data
     def __parse(self):
         try:
-            with open(self.path,'r') as tfile:
+            with open(self.path,'rb') as tfile:
                 bencode = tfile.read()
-            src = self.tokenize(bencode)
-            tfile_dict = self.parse_bencode(src.next,src.next())
-            for token in src:
-                raise SyntaxError("trailing bencode")
-        except OSError as e:
+            # 'pieces' is stepped over by the decoder, it is never built
+            decoder = Decoder(bencode,skip=('pieces',),spans=('info',))
+            tfile_dict = decoder.decode()
+        except (IOError,OSError) as e:
             # log error
             raise LocalTorrentError("parse error: file error")
-        except (AttributeError,ValueError,StopIteration,SyntaxError) as e:
+        except BencodeError as e:
             # log error
             raise LocalTorrentError("parse error: badly formed data")
-        info = tfile_dict['info']
-        del tfile_dict['info']
-        del info['pieces']
+        if not isinstance(tfile_dict,dict) or not isinstance(tfile_dict.get('info'),dict):
+            raise LocalTorrentError("parse error: no info dictionary")
+        # hash the info dictionary exactly as it appears in the file
+        start,end = decoder.span['info']
+        self.info_hash = hashlib.sha1(memoryview(bencode)[start:end]).hexdigest()
+        info = tfile_dict.pop('info')
         tfile_dict.update(info)
-        if 'files' in info:
-            for fdict in info['files']:
-                self.size += fdict['length'] 
-        else:
-            self.size += tfile_dict['length']
-        self.__dict__.update(tfile_dict)
+        try:
+            if 'files' in info:
+                tfile_dict['files'] = FileTable.from_files(info['files'])
+                self.size += tfile_dict['files'].total
+            else:
+                self.size += tfile_dict['length']
+        except (FileTableError,KeyError,TypeError) as e:
+            raise LocalTorrentError("parse error: badly formed file list")
+        self.__update(tfile_dict)
         if not self:
             raise LocalTorrentError("init error: zero record")
+    # sets slotted fields as attributes, everything else as extras
+    def __update(self,fields):
+        extra = dict(self.extra)
+        for key,value in fields.iteritems():
+            if key == 'files':
+                self.files = FileTable.load(value)
+            elif key in self.__slots__ and key != 'extra':
+                setattr(self,key,value)
+            else:
+                extra[key] = value
+        self.extra = tuple(extra.iteritems())
+    # the parsed fields kept by MetadataCache: every field but those of the file itself
+    def metadata(self):
+        result = self.fields()
+        for key in self.__uncached_keys:
+            result.pop(key,None)
+        result['version'] = self.__cache_version
+        return result
+    # the fields of a MetadataCache entry, or None if it is absent or of another version
+    @classmethod
+    def cached_fields(cls,meta):
+        if not meta or meta.get('version') != cls.__cache_version or not meta.get('info_hash'):
+            return None
+        fields = dict(meta)
+        del fields['version']
+        return fields
+    # every parsed field, in a form that can be pickled
+    def fields(self):
+        result = dict(self.extra)
+        for key in self.__slots__:
+            if key != 'extra' and hasattr(self,key):
+                result[key] = getattr(self,key)
+        if 'files' in result:
+            result['files'] = result['files'].data()
+        return result
     # moves the file (filename intact) to a directory
     def move(self,dest):
         dest = os.path.normpath(dest)
@@ -200,3 +415,14 @@ class LocalTorrent:
         self.logger.debug("move: %s <- %s" %(self,os.path.dirname(self.last_path)))
         # log: moved file
 
+# parses a .torrent file in a worker process: returns (path,fields,error)
+#  module-level so that multiprocessing can pickle it
+#  any error is returned, not raised: a file that breaks the parser is invalid, not fatal to the scan
+def parse_local(path):
+    try:
+        ltor = LocalTorrent(path)
+        return (path,ltor.fields(),None)
+    except LocalTorrentError as e:
+        return (path,None,str(e))
+    except Exception as e:
+        return (path,None,"parse error: %s: %s" %(type(e).__name__,e))
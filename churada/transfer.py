@@ -0,0 +1,162 @@
+import subprocess, select, logging, os
+
+from .engine import Task
+
+class TransferPoolError(Exception):
+    pass
+
+class TransferPool:
+    """
+    Runs local commands (rsync transfers) concurrently, within limits
+    Purpose is to use several streams of the link at once, without one seedbox
+     taking all of them.
+     - limit: processes running at once, overall
+     - owner_limit: processes running at once for one owner (e.g. a Shell)
+
+    Commands are queued per owner with add(). A free slot goes to the owners in
+     turn (round-robin), so a seedbox with a long queue does not hold back the
+     others; an owner's commands start in the order they were added.
+     func(exitcode=...,output=...,**args) is called as each process exits, and
+     may add more commands; a command that cannot be started gets exitcode and
+     output None.
+
+    run(owner) starts commands as slots free up and waits for their output with
+     select, until that owner has nothing queued or running (any owner, if None).
+     run_async(engine,owner) does the same without blocking: processes are
+     started from the engine's thread and waited for on its workers, and the
+     returned Task is done once the owner is idle. The two are not mixed: run()
+     raises TransferPoolError while processes started by run_async are running.
+    """
+    chunk = 65536
+    def __init__(self,limit=4,owner_limit=2):
+        self.logger = logging.getLogger("TransferPool")
+        self.limit = limit
+        self.owner_limit = owner_limit
+        # owner -> list of (command,func,args), in round-robin order
+        self.__queues = {}
+        self.__owners = []
+        self.__turn = 0
+        # owner -> processes running
+        self.__running = {}
+        self.__active = 0
+        # stdout fd -> (process,owner,func,args,output parts), for run()
+        self.__procs = {}
+        # run_async: its engine, and owner -> Tasks waiting for the owner to be idle
+        self.__engine = None
+        self.__waiters = {}
+    def __len__(self):
+        return self.__active + sum(len(queue) for queue in self.__queues.itervalues())
+    def __repr__(self):
+        return "<TransferPool (%d running, %d queued)>" %(self.__active,len(self) - self.__active)
+    def add(self,owner,command,func,args):
+        if owner not in self.__queues:
+            self.__queues[owner] = []
+            self.__owners.append(owner)
+            self.__running[owner] = 0
+        self.__queues[owner].append((command,func,args))
+    def busy(self,owner=None):
+        if owner is None:
+            return bool(len(self))
+        return bool(self.__queues.get(owner) or self.__running.get(owner))
+    # the next owner in turn that may start a command
+    def __next_owner(self):
+        count = len(self.__owners)
+        for k in range(0,count):
+            i = (self.__turn + k) % count
+            owner = self.__owners[i]
+            if self.__queues[owner] and self.__running[owner] < self.owner_limit:
+                self.__turn = i + 1
+                return owner
+        return None
+    def __start(self):
+        while self.__active < self.limit:
+            owner = self.__next_owner()
+            if owner is None:
+                return
+            command,func,args = self.__queues[owner].pop(0)
+            self.logger.debug("start: (%r) %s",owner,command)
+            try:
+                process = subprocess.Popen(command,stdout=subprocess.PIPE)
+            except OSError as e:
+                self.logger.warning("start: (%r) %s: %s" %(owner,command,e))
+                self.__forget_idle(owner)
+                self.__call(func,args,None,None)
+                continue
+            self.__active += 1
+            self.__running[owner] += 1
+            if self.__engine is not None:
+                task = self.__engine.submit(self.__communicate,process)
+                task.add_done_callback(lambda task,owner=owner,func=func,args=args: self.__done(owner,func,args,task))
+            else:
+                self.__procs[process.stdout.fileno()] = (process,owner,func,args,[])
+    @staticmethod
+    def __communicate(process):
+        output = process.communicate()[0]
+        return process.returncode,output
+    def __call(self,func,args,exitcode,output):
+        args['exitcode'] = exitcode
+        args['output'] = output
+        func(**args)
+    def __exited(self,owner):
+        self.__active -= 1
+        self.__running[owner] -= 1
+        self.__forget_idle(owner)
+    def __forget_idle(self,owner):
+        if not self.__queues[owner] and not self.__running[owner]:
+            del self.__queues[owner]
+            del self.__running[owner]
+            i = self.__owners.index(owner)
+            del self.__owners[i]
+            if i < self.__turn:
+                self.__turn -= 1
+    def run(self,owner=None):
+        if self.__engine is not None:
+            raise TransferPoolError("run error: transfers of run_async are running")
+        self.__start()
+        while self.busy(owner):
+            ready,_,_ = select.select(self.__procs.keys(),[],[])
+            for fd in ready:
+                process,proc_owner,func,args,parts = self.__procs[fd]
+                chunk = os.read(fd,self.chunk)
+                if chunk:
+                    parts.append(chunk)
+                    continue
+                del self.__procs[fd]
+                process.stdout.close()
+                exitcode = process.wait()
+                self.__exited(proc_owner)
+                self.__call(func,args,exitcode,"".join(parts))
+                self.__start()
+    def run_async(self,engine,owner):
+        if self.__procs:
+            raise TransferPoolError("run_async error: transfers of run are running")
+        task = Task()
+        if not self.busy(owner):
+            task.set_result(None)
+            return task
+        self.__engine = engine
+        self.__waiters.setdefault(owner,[]).append(task)
+        self.__start()
+        self.__wake()
+        return task
+    def __done(self,owner,func,args,task):
+        try:
+            exitcode,output = task.result()
+        except EnvironmentError as e:
+            self.logger.warning("done: (%r) %s" %(owner,e))
+            exitcode,output = None,None
+        self.__exited(owner)
+        self.__call(func,args,exitcode,output)
+        self.__start()
+        self.__wake()
+    # completes the Tasks of idle owners
+    def __wake(self):
+        if not self.__active:
+            self.__engine = None
+        for waiting in self.__waiters.keys():
+            if not self.busy(waiting):
+                for idle in self.__waiters.pop(waiting):
+                    idle.set_result(None)
+
+# transfers shared by every seedbox
+shared = TransferPool()
@@ -0,0 +1,77 @@
+import unittest
+from nose_parameterized import parameterized
+
+from churada.bencode import Decoder,BencodeError,decode
+from churada.torrent import LocalTorrent
+
+from local_torrent_test import tfile_1,tfile_2,tfile_3,tfile_1_dict,tfile_2_dict,tfile_3_dict
+
+class DecoderTest(unittest.TestCase):
+    @parameterized.expand([
+        ("int","i42e",42),
+        ("neg_int","i-3e",-3),
+        ("zero","i0e",0),
+        ("long_string","10:0123456789","0123456789"),
+        ("string","4:spam","spam"),
+        ("empty_string","0:",""),
+        ("list","l4:spami42ee",["spam",42]),
+        ("dict","d3:bar4:spam3:fooi42ee",{'bar':'spam','foo':42}),
+        ("nested","d1:ald1:bi1eeee",{'a':[{'b':1}]}),
+        ("tfile_1",tfile_1,tfile_1_dict),
+        ("tfile_2",tfile_2,tfile_2_dict),
+        ("tfile_3",tfile_3,tfile_3_dict)
+        ])
+    def decode_test(self,_,bencode,control):
+        self.assertEqual(decode(bencode),control)
+    @parameterized.expand([
+        ("tfile_1",tfile_1),
+        ("tfile_2",tfile_2),
+        ("tfile_3",tfile_3)
+        ])
+    def tokenizer_match_test(self,_,bencode):
+        src = LocalTorrent.tokenize(bencode)
+        control = LocalTorrent.parse_bencode(src.next,src.next())
+        self.assertEqual(decode(bencode),control)
+    @parameterized.expand([
+        ("top_level","d6:piecesi1e1:ai2ee",{'a':2}),
+        ("nested","d4:infod6:pieces4:abcd4:name1:xee",{'info':{'name':'x'}}),
+        ("container","d6:piecesld1:a1:bee1:ai2ee",{'a':2}),
+        ("tfile_1",tfile_1,dict(tfile_1_dict,info=dict((k,v) for k,v in tfile_1_dict['info'].items() if k != 'pieces')))
+        ])
+    def skip_test(self,_,bencode,control):
+        self.assertEqual(Decoder(bencode,skip=('pieces',)).decode(),control)
+    @parameterized.expand([
+        ("top_level","d4:infod1:ai1ee1:zi2ee",{'info':(7,15)}),
+        ("skipped","d4:infod1:ai1ee1:zi2ee",{'info':(7,15)},('info',)),
+        ("nested_ignored","d1:ad4:infoi1ee4:infoi2ee",{'info':(21,24)}),
+        ("absent","d1:ai1ee",{})
+        ])
+    def span_test(self,_,bencode,control,skip=()):
+        decoder = Decoder(bencode,skip=skip,spans=('info',))
+        decoder.decode()
+        self.assertEqual(decoder.span,control)
+    @parameterized.expand([
+        ("trailing","i1ei2e"),
+        ("trailing_dict",tfile_1+"e"),
+        ("truncated_string","5:spam"),
+        ("truncated_skip","d6:pieces10:abcde"),
+        ("unterminated_list","l4:spam"),
+        ("unterminated_int","i42"),
+        ("bad_int","ixe"),
+        ("bad_token","x"),
+        ("int_key","di1ei2ee"),
+        ("empty",""),
+        ("int_space","i 12e"),
+        ("int_plus","i+1e"),
+        ("int_negative_zero","i-0e"),
+        ("int_leading_zero","i03e"),
+        ("int_empty","ie"),
+        ("length_leading_zero","03:abc"),
+        ("skipped_bad_int","d6:piecesi03e1:ai2ee"),
+        ("skipped_bad_length","d6:pieces03:abc1:ai2ee"),
+        ("deep_list","l"*5000 + "e"*5000),
+        ("deep_dict","d1:a"*5000 + "i1e" + "e"*5000),
+        ("deep_skipped","d6:pieces" + "l"*5000 + "e"*5000 + "e")
+        ])
+    def error_test(self,_,bencode):
+        self.assertRaises(BencodeError,lambda: Decoder(bencode,skip=('pieces',)).decode())
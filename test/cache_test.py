@@ -0,0 +1,91 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import patch
+import os
+import shutil
+import tempfile
+
+from churada.cache import MetadataCache
+from churada.torrent import LocalTorrent
+
+from local_torrent_test import tfile_1,tfile_3
+
+meta_1 = {'name':'single_file.ext','size':1234,'announce':'http://www.tracker.ca','length':100}
+meta_2 = {'name':'data_directory','size':5200,'files':[{'length':2000,'path':['subdir1','file1']}]}
+
+class MetadataCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = MetadataCache(os.path.join(self.dir,'metadata.db'),capacity=3)
+    def write(self,name,data):
+        path = os.path.join(self.dir,name)
+        with open(path,'wb') as tfile:
+            tfile.write(data)
+        return path
+    @parameterized.expand([
+        ("single_file",meta_1),
+        ("multi_file",meta_2)
+        ])
+    def put_get_test(self,_,meta):
+        path = self.write('a.torrent','data')
+        self.assertEqual(self.cache.get(path),None)
+        self.cache.put(path,meta)
+        result = self.cache.get(path)
+        self.assertEqual(result,meta)
+        self.assertEqual(type(result['name']),str)
+        self.assertEqual((self.cache.hits,self.cache.misses),(1,1))
+    def move_test(self):
+        path = self.write('a.torrent','data')
+        self.cache.put(path,meta_1)
+        dest = os.path.join(self.dir,'b.torrent')
+        shutil.move(path,dest)
+        self.assertEqual(self.cache.get(dest),meta_1)
+    def invalidate_test(self):
+        path = self.write('a.torrent','data')
+        self.cache.put(path,meta_1)
+        with open(path,'ab') as tfile:
+            tfile.write('more data')
+        self.assertEqual(self.cache.get(path),None)
+        self.assertEqual(len(self.cache),0)
+    def evict_test(self):
+        paths = [self.write('%d.torrent' %(i),str(i)) for i in range(0,4)]
+        for i,path in enumerate(paths[:3]):
+            self.cache.put(path,{'name':str(i)})
+        self.cache.get(paths[0])
+        self.cache.put(paths[3],{'name':'3'})
+        self.assertEqual(len(self.cache),3)
+        self.assertEqual(self.cache.get(paths[1]),None)
+        self.assertEqual(self.cache.get(paths[0]),{'name':'0'})
+    def persist_test(self):
+        path = self.write('a.torrent','data')
+        self.cache.put(path,meta_1)
+        self.cache.close()
+        self.cache = MetadataCache(self.cache.path)
+        self.assertEqual(self.cache.get(path),meta_1)
+    @parameterized.expand([
+        ("single_file",tfile_1,'created by','creator'),
+        ("multi_file",tfile_3,'piece length',123)
+        ])
+    def ltor_test(self,_,tfile,extra_key,extra_value):
+        path = self.write('a.torrent',tfile)
+        ltor = LocalTorrent(path,cache=self.cache)
+        self.assertEqual(ltor.metadata()['version'],2)
+        self.assertFalse(set(('path','time','last_path')) & set(ltor.metadata()))
+        with patch("__builtin__.open",side_effect=IOError) as mock_open:
+            cached = LocalTorrent(path,cache=self.cache)
+            self.assertEqual(mock_open.called,False)
+        # a hit gives the same record as a parse, extras included
+        self.assertEqual(cached.metadata(),ltor.metadata())
+        self.assertEqual(dict(cached.extra),dict(ltor.extra))
+        self.assertEqual(getattr(cached,extra_key),extra_value)
+        self.assertEqual(cached,ltor)
+    def ltor_version_test(self):
+        # entries of an older schema are parsed again
+        path = self.write('a.torrent',tfile_1)
+        self.cache.put(path,{'name':'old','size':1,'info_hash':'a'*40})
+        ltor = LocalTorrent(path,cache=self.cache)
+        self.assertEqual(ltor.name,'single_file.ext')
+        self.assertEqual(self.cache.get(path),ltor.metadata())
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
@@ -0,0 +1,75 @@
+import unittest
+from nose_parameterized import parameterized
+
+from churada import columns
+from churada.columns import RemoteColumns,ColumnsError
+
+from generators import rtor_gen
+
+rtor_test = [rtor_gen(name=str(i),state=('Seeding','Paused','Queued')[i%3],size=str(1000+i),
+                      ratio=str(0.1*((i*7)%20)),atime=str(1000*(i%4))) for i in range(0,20)]
+
+@unittest.skipIf(columns.numpy is None,"numpy is not available")
+class RemoteColumnsTest(unittest.TestCase):
+    def setUp(self):
+        self.columns = RemoteColumns(rtor_test)
+    def columns_test(self):
+        self.assertEqual(len(self.columns),len(rtor_test))
+        for key in RemoteColumns.columns:
+            control = [getattr(rtor,key) if getattr(rtor,key) is not None else float('nan') for rtor in rtor_test]
+            columns.numpy.testing.assert_array_equal(getattr(self.columns,key),control)
+        self.assertEqual([self.columns.states[code] for code in self.columns.state],[rtor.state for rtor in rtor_test])
+    def score_test(self):
+        for rtor,score in zip(rtor_test,self.columns.score):
+            self.assertAlmostEqual(score,getattr(rtor,'score',float('inf')))
+    @parameterized.expand([
+        ("one",("Seeding",)),
+        ("two",("Seeding","Paused")),
+        ("absent",("Error",))
+        ])
+    def state_mask_test(self,_,states):
+        mask = self.columns.state_mask(*states)
+        self.assertEqual(list(mask),[rtor.state in states for rtor in rtor_test])
+    @parameterized.expand([
+        ("all",5,None),
+        ("more_than_all",50,None),
+        ("masked",3,("Paused",))
+        ])
+    def top_k_test(self,_,k,states):
+        mask = self.columns.state_mask(*states) if states else None
+        result = [rtor_test[i] for i in self.columns.top_k(k,mask)]
+        control = sorted((rtor for rtor in rtor_test if not states or rtor.state in states),
+                         key=lambda rtor: getattr(rtor,'score',float('inf')))[:k]
+        self.assertEqual([getattr(r,'score',None) for r in result],[getattr(r,'score',None) for r in control])
+    @parameterized.expand([
+        ("small",1500,None),
+        ("large",10**6,None),
+        ("masked",1500,("Seeding",))
+        ])
+    def delete_candidates_test(self,_,space,states):
+        mask = self.columns.state_mask(*states) if states else None
+        result = list(self.columns.delete_candidates(space,mask))
+        pool = [rtor for rtor in rtor_test if not states or rtor.state in states]
+        self.assertEqual(sorted(result,key=lambda rtor: rtor.name),sorted(pool,key=lambda rtor: rtor.name))
+        scores = [getattr(rtor,'score',float('inf')) for rtor in result]
+        self.assertEqual(scores,sorted(scores))
+    def rate_test(self):
+        rtors = [rtor_gen(name=str(i),state='Seeding',size='10') for i in range(0,5)]
+        for rtor,rate in zip(rtors,[3.0,None,1.0,0.0,2.0]):
+            rtor.rate = rate
+        snapshot = RemoteColumns(rtors)
+        self.assertEqual([rtors[i].rate for i in snapshot.top_k(5,key='rate')],[0.0,1.0,2.0,3.0,None])
+        self.assertEqual([r.rate for r in snapshot.delete_candidates(20,key='rate')],[0.0,1.0,2.0,3.0,None])
+    def empty_test(self):
+        empty = RemoteColumns([])
+        self.assertEqual(list(empty.delete_candidates(100)),[])
+        self.assertEqual(len(empty.top_k(3)),0)
+
+class RemoteColumnsMissingTest(unittest.TestCase):
+    def no_numpy_test(self):
+        numpy = columns.numpy
+        columns.numpy = None
+        try:
+            self.assertRaises(ColumnsError,lambda: RemoteColumns(rtor_test))
+        finally:
+            columns.numpy = numpy
@@ -2,12 +2,19 @@ import unittest
 from nose_parameterized import parameterized
 from mock import MagicMock, patch
 from copy import deepcopy
+import os
+import shutil
+import tempfile
+from glob import glob
+from multiprocessing import Pool
 
-from churada.record import LocalRecord
+from churada.record import LocalRecord,RemoteRecord
 from churada.rule import Rule
 from churada.controller import Controller
+from churada.torrent import LocalTorrent
+from churada.engine import Engine
 
-from generators import ltor_gen,seedbox_gen
+from generators import ltor_gen,rtor_gen,seedbox_gen,ltor_template
 
 seedbox_list = [
         seedbox_gen(20,5,10),
@@ -56,3 +63,141 @@ class ControllerTest(unittest.TestCase):
     def tearDown(self):
         patch.stopall()
         self.controller = None
+
+def tfile_gen(name,size):
+    return ltor_template.substitute(announcelen=22,announce='http://www.tracker.com',
+                                    namelen=len(name),name=name,size=size,piece_length=524288)
+
+class ControllerScanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = dict((key,os.path.join(self.dir,key)) for key in ['local_torrent','local_invalid','watch'])
+        for path in self.paths.values():
+            os.mkdir(path)
+        self.paths['local_watch'] = [self.paths.pop('watch')]
+        self.seedbox = MagicMock()
+        self.seedbox.find.return_value = None
+        # enough files to go over the parallel threshold
+        self.names = ["%03d" %(i) for i in range(0,100)]
+        for name in self.names:
+            data = tfile_gen(name,int(name)) if int(name) % 10 else "invalid"
+            with open(os.path.join(self.paths['local_watch'][0],name+".torrent"),'wb') as tfile:
+                tfile.write(data)
+    @parameterized.expand([
+        ("serial",1,False),
+        ("parallel",2,False),
+        ("parallel_cache",2,True)
+        ])
+    def scan_test(self,_,workers,cache_flag):
+        if cache_flag:
+            self.paths['local_cache'] = os.path.join(self.dir,'metadata.db')
+        controller = Controller([self.seedbox],self.paths,{'upload_path':[]},workers=workers)
+        self.addCleanup(controller.close)
+        with patch('churada.controller.glob',side_effect=lambda expr: sorted(glob(expr))):
+            controller.scan(self.paths['local_watch'][0])
+        valid = [name for name in self.names if int(name) % 10]
+        invalid = [name for name in self.names if not int(name) % 10]
+        self.assertEqual([ltor.name for ltor in controller.up_queue],valid)
+        self.assertEqual(sorted(os.listdir(self.paths['local_torrent'])),[name+".torrent" for name in valid])
+        self.assertEqual(sorted(os.listdir(self.paths['local_invalid'])),[name+".torrent" for name in invalid])
+        if cache_flag:
+            self.assertEqual(len(controller.cache),len(valid))
+    @parameterized.expand([
+        ("serial",1),
+        ("parallel",2)
+        ])
+    def parse_error_test(self,_,workers):
+        # an unexpected error in the parser makes that file invalid, and the scan goes on
+        parse = LocalTorrent._LocalTorrent__parse
+        def broken(ltor):
+            if ltor.path.endswith("005.torrent"):
+                raise RuntimeError("maximum recursion depth exceeded")
+            parse(ltor)
+        with patch.object(LocalTorrent,'_LocalTorrent__parse',broken):
+            # the pool is forked here, so its processes see the patch too
+            controller = Controller([self.seedbox],self.paths,{'upload_path':[]},workers=workers)
+            self.addCleanup(controller.close)
+            with patch('churada.controller.glob',side_effect=lambda expr: sorted(glob(expr))):
+                controller.scan(self.paths['local_watch'][0])
+        invalid = [name for name in self.names if not int(name) % 10 or name == "005"]
+        self.assertEqual(sorted(os.listdir(self.paths['local_invalid'])),[name+".torrent" for name in invalid])
+        self.assertEqual(len(controller.up_queue),len(self.names) - len(invalid))
+    @parameterized.expand([
+        ("serial",1,0),
+        ("parallel",2,1)
+        ])
+    def pool_test(self,_,workers,forks):
+        # the pool is forked when the controller is built, never during a scan
+        with patch('churada.controller.Pool',wraps=Pool) as pool:
+            controller = Controller([self.seedbox],self.paths,{'upload_path':[]},workers=workers)
+            self.addCleanup(controller.close)
+            with patch('churada.controller.glob',side_effect=lambda expr: sorted(glob(expr))):
+                controller.scan(self.paths['local_watch'][0])
+                controller.scan(self.paths['local_watch'][0])
+        self.assertEqual(pool.call_count,forks)
+    def duplicate_test(self):
+        self.seedbox.up_queue = LocalRecord(None)
+        self.seedbox.info = RemoteRecord(None,backend=MagicMock())
+        controller = Controller([self.seedbox],self.paths,{'upload_path':[]},workers=1)
+        with patch('churada.controller.glob',side_effect=lambda expr: sorted(glob(expr))):
+            controller.scan(self.paths['local_watch'][0])
+        seeded = list(controller.up_queue)[:2]
+        controller.up_queue.ltor_del(ltor=seeded[0])
+        self.seedbox.info.merge([rtor_gen(name=seeded[0].name,state='Seeding',id=seeded[0].info_hash)])
+        for ltor in seeded:
+            with open(os.path.join(self.paths['local_watch'][0],"copy_"+ltor.name+".torrent"),'wb') as tfile:
+                tfile.write(tfile_gen(ltor.name,int(ltor.name)))
+        with patch('churada.controller.glob',side_effect=lambda expr: sorted(glob(expr))):
+            controller.scan(self.paths['local_watch'][0])
+        self.assertEqual(controller.locator.locate(info_hash=seeded[0].info_hash),[(self.seedbox,'info')])
+        self.assertEqual(controller.locator.locate(info_hash=seeded[1].info_hash),[(None,'up_queue')])
+        self.assertEqual(sorted(name for name in os.listdir(self.paths['local_invalid']) if name.startswith("copy_")),
+                         ["copy_"+ltor.name+".torrent" for ltor in seeded])
+    def journal_test(self):
+        self.paths['local_journal'] = os.path.join(self.dir,'journal')
+        seedboxes = []
+        for i in range(0,2):
+            seedbox = MagicMock()
+            seedbox.shell.path = 'user@host'
+            seedbox.up_queue = LocalRecord(None)
+            seedbox.down_queue = RemoteRecord(None,backend=MagicMock())
+            seedbox.upload_failures = {}
+            seedbox.download_failures = {}
+            seedboxes.append(seedbox)
+        controller = Controller([seedboxes[0]],self.paths,{'upload_path':[]},workers=1)
+        with patch('churada.controller.glob',side_effect=lambda expr: sorted(glob(expr))):
+            controller.scan(self.paths['local_watch'][0])
+        queued = list(controller.up_queue)[:3]
+        for ltor in queued:
+            controller.up_queue.ltor_del(ltor=ltor)
+            seedboxes[0].up_queue.ltor_add(ltor=ltor)
+        seedboxes[0].down_queue.rtor_add(name='uploaded')
+        controller.journal.sync()
+        # restart
+        restarted = Controller([seedboxes[1]],self.paths,{'upload_path':[]},workers=1)
+        self.assertEqual([ltor.path for ltor in restarted.up_queue],[ltor.path for ltor in controller.up_queue])
+        self.assertEqual([ltor.path for ltor in seedboxes[1].up_queue],[ltor.path for ltor in queued])
+        self.assertEqual(seedboxes[1].down_queue.pending.keys(),['uploaded'])
+    def act_engine_test(self):
+        engine = Engine(workers=2)
+        log = []
+        def act_async(name,engine):
+            for phase in range(0,2):
+                log.append((name,phase))
+                yield engine.submit(lambda: None)
+        seedboxes = []
+        for name in ('a','b'):
+            seedbox = MagicMock()
+            seedbox.act_async.side_effect = lambda engine,name=name: act_async(name,engine)
+            seedboxes.append(seedbox)
+        controller = Controller(seedboxes,self.paths,{'upload_path':[]},workers=1,engine=engine)
+        with patch('churada.controller.glob',side_effect=lambda expr: sorted(glob(expr))):
+            controller.act()
+        engine.close()
+        # both seedboxes are in their first phase before either finishes it
+        self.assertEqual(sorted(log[:2]),[('a',0),('b',0)])
+        self.assertEqual(sorted(log),[('a',0),('a',1),('b',0),('b',1)])
+        self.assertFalse(any(seedbox.act.called for seedbox in seedboxes))
+        self.assertEqual(len(os.listdir(self.paths['local_torrent'])),90)
+    def tearDown(self):
+        shutil.rmtree(self.dir)
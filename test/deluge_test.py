@@ -0,0 +1,362 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import MagicMock
+import datetime
+import os
+import shutil
+import socket
+import ssl
+import struct
+import tempfile
+import threading
+import zlib
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes,serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from churada import rencode
+from churada.deluge import DelugeClient,DelugeError,DelugeRPCError,Forward
+from churada.deluge import ConsoleBackend,RPCBackend,status_fields,RPC_RESPONSE,RPC_ERROR,RPC_EVENT
+
+from generators import rtor_gen,rtor_template
+
+status_1 = {'name':'torrent_1','state':'Seeding','download_payload_rate':0,'upload_payload_rate':1024,
+            'eta':0,'num_seeds':1,'total_seeds':10,'num_peers':2,'total_peers':20,'distributed_copies':1.5,
+            'total_done':2048,'total_size':2048,'ratio':1.25,'seeding_time':1000,'active_time':2000,
+            'tracker_host':'tracker.com','tracker_status':'tracker.com: Announce OK','progress':100.0}
+status_2 = dict(status_1,name='torrent_2',state='Paused',ratio=0.5)
+torrents = {'a'*40:status_1,'b'*40:status_2}
+
+# self-signed certificate for the stand-in daemon
+def write_certificate(path):
+    key = rsa.generate_private_key(public_exponent=65537,key_size=2048,backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME,u"deluge")])
+    now = datetime.datetime.utcnow()
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key,hashes.SHA256(),default_backend()))
+    with open(path,'wb') as pem:
+        pem.write(key.private_bytes(serialization.Encoding.PEM,serialization.PrivateFormat.TraditionalOpenSSL,
+                                    serialization.NoEncryption()))
+        pem.write(cert.public_bytes(serialization.Encoding.PEM))
+
+class StandIn(threading.Thread):
+    """Stand-in deluged: answers RPC requests with handlers[method](*args,**kwargs)"""
+    def __init__(self,certfile,handlers,protocol=1,chunk=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.certfile = certfile
+        self.handlers = handlers
+        self.protocol = protocol
+        self.chunk = chunk
+        self.calls = []
+        self.messages = 0
+        self.listener = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1',0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+    def frame(self,data):
+        body = zlib.compress(rencode.dumps(data))
+        if self.protocol >= 2:
+            body = 'D' + struct.pack('!i',len(body)) + body
+        return body
+    def requests(self,sock):
+        buf = ''
+        while True:
+            data = sock.recv(1<<16)
+            if not data:
+                return
+            buf += data
+            while buf:
+                if self.protocol >= 2:
+                    if len(buf) < 5 or len(buf) < 5 + struct.unpack('!i',buf[1:5])[0]:
+                        break
+                    length = struct.unpack('!i',buf[1:5])[0]
+                    body,buf = buf[5:5+length],buf[5+length:]
+                    yield rencode.loads(zlib.decompress(body))
+                else:
+                    decompressor = zlib.decompressobj()
+                    try:
+                        message = rencode.loads(decompressor.decompress(buf))
+                    except (zlib.error,rencode.RencodeError):
+                        break
+                    buf = decompressor.unused_data
+                    yield message
+    def run(self):
+        sock,_ = self.listener.accept()
+        sock = ssl.wrap_socket(sock,server_side=True,certfile=self.certfile)
+        try:
+            for message in self.requests(sock):
+                self.messages += 1
+                out = self.frame((RPC_EVENT,'TorrentStateChangedEvent',('a'*40,'Seeding')))
+                for request_id,method,args,kwargs in message:
+                    self.calls.append((method,args,kwargs))
+                    try:
+                        out += self.frame((RPC_RESPONSE,request_id,self.handlers[method](*args,**kwargs)))
+                    except Exception as e:
+                        out += self.frame((RPC_ERROR,request_id,type(e).__name__,str(e),''))
+                if self.chunk:
+                    for i in range(0,len(out),self.chunk):
+                        sock.sendall(out[i:i+self.chunk])
+                else:
+                    sock.sendall(out)
+        except (socket.error,ssl.SSLError):
+            pass
+        finally:
+            sock.close()
+            self.listener.close()
+
+def handlers_gen():
+    def get_torrents_status(filter_dict,keys):
+        names = filter_dict.get('name')
+        ids = filter_dict.get('id')
+        return dict((tid,dict((k,v) for k,v in status.items() if k in keys))
+                    for tid,status in torrents.items()
+                    if (not names or status['name'] in names) and (not ids or tid in ids))
+    def get_torrent_status(torrent_id,keys):
+        return dict((k,v) for k,v in torrents[torrent_id].items() if k in keys)
+    def login(username,password,**kwargs):
+        if (username,password) != ('user','pass'):
+            raise ValueError("bad login")
+        return 10
+    return {'daemon.login':login,
+            'core.get_torrents_status':get_torrents_status,
+            'core.get_torrent_status':get_torrent_status,
+            'core.remove_torrent':lambda torrent_id,remove_data: bool(torrents[torrent_id])}
+
+class DelugeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.certfile = os.path.join(cls.dir,'deluge.pem')
+        write_certificate(cls.certfile)
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+    def standin(self,protocol=1,chunk=None):
+        server = StandIn(self.certfile,handlers_gen(),protocol,chunk)
+        server.start()
+        return server
+
+class DelugeClientTest(DelugeTest):
+    @parameterized.expand([
+        ("protocol_1",1,None),
+        ("protocol_2",2,None),
+        ("protocol_1_chunked",1,7),
+        ("protocol_2_chunked",2,7)
+        ])
+    def call_test(self,_,protocol,chunk):
+        server = self.standin(protocol,chunk)
+        client = DelugeClient('127.0.0.1',server.port,'user','pass',protocol)
+        client.connect()
+        result = client.call('core.get_torrents_status',{},['name','ratio'])
+        client.close()
+        self.assertEqual(result,{'a'*40:{'name':'torrent_1','ratio':1.25},'b'*40:{'name':'torrent_2','ratio':0.5}})
+        self.assertEqual(server.calls[0][0],'daemon.login')
+    def batch_test(self):
+        server = self.standin()
+        client = DelugeClient('127.0.0.1',server.port,'user','pass')
+        client.connect()
+        result = client.batch([('core.get_torrent_status',('a'*40,['name']),{}),
+                               ('core.remove_torrent',('b'*40,True),{})])
+        client.close()
+        self.assertEqual(result,[{'name':'torrent_1'},True])
+        # login, then both calls in a single message
+        self.assertEqual(server.messages,2)
+    def error_test(self):
+        server = self.standin()
+        client = DelugeClient('127.0.0.1',server.port,'user','pass')
+        client.connect()
+        self.assertRaises(DelugeRPCError,lambda: client.call('core.no_such_method'))
+        result = client.batch([('core.no_such_method',(),{}),('core.remove_torrent',('a'*40,True),{})],raise_errors=False)
+        self.assertEqual(isinstance(result[0],DelugeRPCError),True)
+        self.assertEqual(result[1],True)
+        self.assertEqual(client.call('core.remove_torrent','a'*40,True),True)
+        client.close()
+    def login_test(self):
+        server = self.standin()
+        client = DelugeClient('127.0.0.1',server.port,'user','wrong')
+        self.assertRaises(DelugeRPCError,client.connect)
+        client.close()
+    def connect_test(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1',0))
+        port = listener.getsockname()[1]
+        listener.close()
+        self.assertRaises(DelugeError,DelugeClient('127.0.0.1',port,'user','pass').connect)
+    def not_connected_test(self):
+        self.assertRaises(DelugeError,lambda: DelugeClient('127.0.0.1',1,'user','pass').call('daemon.info'))
+
+class StatusFieldsTest(unittest.TestCase):
+    def status_fields_test(self):
+        fields = status_fields('a'*40,status_1)
+        self.assertEqual(fields['id'],'a'*40)
+        self.assertEqual(fields['size'],2048.0)
+        self.assertEqual(type(fields['size']),float)
+        self.assertEqual(fields['tracker'],'tracker.com')
+        self.assertEqual(fields['tracker_status'],'Announce OK')
+        self.assertEqual(fields['stime'],1000.0)
+    def missing_test(self):
+        fields = status_fields('a'*40,{'name':'x'})
+        self.assertEqual(fields['state'],None)
+
+# a paramiko SSHClient whose transport opens plain sockets to the stand-in daemon
+def ssh_gen(port,username='user',password='pass'):
+    transport = MagicMock()
+    def open_channel(kind,dest,src):
+        return socket.create_connection(('127.0.0.1',port))
+    transport.open_channel.side_effect = open_channel
+    ssh = MagicMock()
+    ssh.get_transport.return_value = transport
+    stdout = MagicMock()
+    stdout.read.return_value = "%s:%s:10\n" %(username,password)
+    ssh.exec_command.return_value = (MagicMock(),stdout,MagicMock())
+    return ssh
+
+class RPCBackendTest(DelugeTest):
+    def setUp(self):
+        self.shell = MagicMock()
+        self.backend = RPCBackend(self.shell)
+    def run_queue(self,ssh):
+        for call_args,_ in self.shell.add_ssh.call_args_list:
+            command,func,args = call_args
+            exitcode,output = command(ssh) if callable(command) else (None,None)
+            func(exitcode=exitcode,output=output,**args)
+    @parameterized.expand([
+        ("all",None,None,['torrent_1','torrent_2']),
+        ("named",('torrent_1',),None,['torrent_1']),
+        ("ids",None,('a'*40,),['torrent_1']),
+        ("names_and_ids",('torrent_2',),('a'*40,),['torrent_1','torrent_2'])
+        ])
+    def add_info_test(self,_,names,ids,control):
+        server = self.standin()
+        func = MagicMock()
+        self.backend.add_info(func,{'key':'value'},names=names,ids=ids)
+        self.run_queue(ssh_gen(server.port))
+        self.backend.close()
+        kwargs = func.call_args[1]
+        self.assertEqual(kwargs['exitcode'],0)
+        self.assertEqual(kwargs['key'],'value')
+        self.assertEqual(sorted(rtor.name for rtor in kwargs['output']),control)
+        # login, then every lookup in one message
+        self.assertEqual(server.messages,2)
+        rtor = next(rtor for rtor in kwargs['output'] if rtor.name == 'torrent_1')
+        self.assertEqual(rtor.info_hash,'a'*40)
+        self.assertAlmostEqual(rtor.score,10**6*1.25/2000)
+    def session_test(self):
+        server = self.standin()
+        ssh = ssh_gen(server.port)
+        func = MagicMock()
+        self.backend.add_info(func,{})
+        self.backend.add_delete([rtor_gen(name='torrent_1',state='Seeding',id='a'*40)],func,{})
+        self.run_queue(ssh)
+        self.backend.close()
+        self.assertEqual(func.call_count,2)
+        # one connection, one login for the whole queue
+        self.assertEqual([call[0] for call in server.calls],['daemon.login','core.get_torrents_status','core.get_torrent_status'])
+        self.assertEqual(func.call_args[1]['output'],{'a'*40:True})
+        self.assertEqual(ssh.get_transport().open_channel.call_count,1)
+    @parameterized.expand([
+        ("dry_run",True,'core.get_torrent_status'),
+        ("remove",False,'core.remove_torrent')
+        ])
+    def add_delete_test(self,_,dry_run,method):
+        server = self.standin()
+        self.backend.dry_run = dry_run
+        rtors = [rtor_gen(name='torrent_1',state='Seeding',id='a'*40),
+                 rtor_gen(name='absent',state='Seeding',id='c'*40),
+                 rtor_gen(name='torrent_2',state='Seeding',id='b'*40)]
+        func = MagicMock()
+        self.backend.add_delete(rtors,func,{'key':'value'})
+        self.run_queue(ssh_gen(server.port))
+        self.backend.close()
+        func.assert_called_once_with(exitcode=0,output={'a'*40:True,'b'*40:True,'c'*40:False},key='value')
+        # login, then every deletion in one message
+        self.assertEqual(server.messages,2)
+        self.assertEqual([call[0] for call in server.calls[1:]],[method]*3)
+    def fallback_test(self):
+        ssh = ssh_gen(1)
+        ssh.get_transport().open_channel.side_effect = socket.error("refused")
+        func = MagicMock()
+        self.backend.add_info(func,{})
+        command,done,args = self.shell.add_ssh.call_args[0]
+        exitcode,output = command(ssh)
+        # the fallback is queued by done, on the thread processing the queue, not by the command
+        self.assertEqual(self.shell.add_ssh.call_count,1)
+        done(exitcode=exitcode,output=output,**args)
+        self.backend.close()
+        self.assertEqual(func.called,False)
+        self.assertEqual(self.shell.add_ssh.call_count,2)
+        self.assertEqual(self.shell.add_ssh.call_args[0][0],ConsoleBackend.info_command)
+    def ssh_error_test(self):
+        # the command could not run: func is told, as by ConsoleBackend, and nothing is retried
+        func = MagicMock()
+        self.backend.add_delete([rtor_gen(name='torrent_1',state='Seeding',id='a'*40)],func,{'key':'value'})
+        command,done,args = self.shell.add_ssh.call_args[0]
+        done(exitcode=None,output=None,**args)
+        func.assert_called_once_with(exitcode=None,output=None,key='value')
+        self.assertEqual(self.shell.add_ssh.call_count,1)
+
+class ConsoleBackendTest(unittest.TestCase):
+    @parameterized.expand([
+        ("plain","name","name"),
+        ("space","a name","'a name'"),
+        ("single_quote","it's","'it'\\\"'\\\"'s'"),
+        ("shell","$(rm -rf) `x`","'\\$(rm -rf) \\`x\\`'")
+        ])
+    def quote_test(self,_,value,control):
+        self.assertEqual(ConsoleBackend.quote(value),control)
+    # the output has records of the first and last torrents: found in a dry run, not deleted otherwise
+    @parameterized.expand([
+        ("dry_run",True,0,
+         "; info %s; info %s; info %s",[True,False,True]),
+        ("remove",False,0,
+         "; rm --remove-data %s; rm --remove-data %s; rm --remove-data %s\"; deluge-console \"connect 127.0.0.1:33307"
+         "; info %s; info %s; info %s",[False,True,False]),
+        ("remove_failed",False,1,
+         "; rm --remove-data %s; rm --remove-data %s; rm --remove-data %s\"; deluge-console \"connect 127.0.0.1:33307"
+         "; info %s; info %s; info %s",[False,False,False])
+        ])
+    def add_delete_test(self,_,dry_run,exitcode,items,control):
+        shell = MagicMock()
+        backend = ConsoleBackend(shell)
+        backend.dry_run = dry_run
+        rtors = [rtor_gen(name=str(i),state='Seeding') for i in range(0,3)]
+        func = MagicMock()
+        backend.add_delete(rtors,func,{'key':'value'})
+        shell.add_ssh.assert_called_once()
+        command,parse,args = shell.add_ssh.call_args[0]
+        ids = tuple(rtor.info_hash for rtor in rtors)
+        self.assertEqual(command,ConsoleBackend.session_command %(items %(ids*(items.count('%s')//3))))
+        output = "\n".join(rtor_template.substitute(name=rtor.name,id=rtor.info_hash,state='Seeding',uspeed='0',
+                                                    cseed='0',tseed='0',cpeer='0',tpeer='0',avail='0',csize='1',
+                                                    size='1',ratio='0',stime='0',atime='0',tracker='t',
+                                                    tracker_status='OK') for rtor in (rtors[0],rtors[2]))
+        parse(exitcode=exitcode,output=output,**args)
+        func.assert_called_once_with(exitcode=exitcode,output=dict(zip(ids,control)),key='value')
+    def add_info_test(self):
+        shell = MagicMock()
+        backend = ConsoleBackend(shell)
+        func = MagicMock()
+        backend.add_info(func,{'key':'value'},names=('a','b c'),ids=('f'*40,))
+        shell.add_ssh.assert_called_once()
+        self.assertEqual(shell.add_ssh.call_args[0][0],
+                         ConsoleBackend.session_command %("; info a; info 'b c'; info "+'f'*40))
+        command,parse,args = shell.add_ssh.call_args[0]
+        parse(exitcode=1,output="",**args)
+        func.assert_called_once_with(exitcode=1,output=[],key='value')
+    @parameterized.expand([
+        ("empty",0,"",0),
+        ("unreadable",0,"Failed to connect to 127.0.0.1:33307\n",None),
+        ("failed",1,"",1)
+        ])
+    def listing_test(self,_,exitcode,output,control):
+        shell = MagicMock()
+        func = MagicMock()
+        ConsoleBackend(shell).add_info(func,{})
+        command,parse,args = shell.add_ssh.call_args[0]
+        parse(exitcode=exitcode,output=output,**args)
+        func.assert_called_once_with(exitcode=control,output=[])
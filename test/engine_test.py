@@ -0,0 +1,95 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import MagicMock
+import threading
+import sys
+
+from churada.engine import Engine,EngineError,Task
+
+class TaskTest(unittest.TestCase):
+    def result_test(self):
+        task = Task()
+        func = MagicMock()
+        task.add_done_callback(func)
+        self.assertFalse(task.done())
+        self.assertRaises(EngineError,task.result)
+        task.set_result(5)
+        func.assert_called_once_with(task)
+        self.assertEqual(task.result(),5)
+        # callbacks added late are called at once
+        task.add_done_callback(func)
+        self.assertEqual(func.call_count,2)
+        self.assertRaises(EngineError,lambda: task.set_result(6))
+    def exception_test(self):
+        task = Task()
+        try:
+            raise KeyError('a')
+        except KeyError:
+            task.set_exception(sys.exc_info())
+        self.assertRaises(KeyError,task.result)
+
+class EngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine(workers=4)
+    def submit_test(self):
+        tasks = [self.engine.submit(lambda x: x*x,i) for i in range(0,10)]
+        self.assertEqual([self.engine.wait(task) for task in tasks],[i*i for i in range(0,10)])
+    def concurrent_test(self):
+        # each call waits for all of them: only returns if they run at once
+        started = []
+        event = threading.Event()
+        def work(i):
+            started.append(i)
+            if len(started) == 4:
+                event.set()
+            return event.wait(5)
+        tasks = [self.engine.submit(work,i) for i in range(0,4)]
+        self.assertEqual(self.engine.wait(self.engine.gather(tasks)),[True]*4)
+    def callback_thread_test(self):
+        threads = []
+        task = self.engine.submit(lambda: threading.current_thread())
+        task.add_done_callback(lambda task: threads.append(threading.current_thread()))
+        worker = self.engine.wait(task)
+        self.assertIsNot(worker,threading.current_thread())
+        self.assertEqual(threads,[threading.current_thread()])
+    def spawn_test(self):
+        log = []
+        def steps(name,n):
+            for i in range(0,n):
+                value = yield self.engine.submit(lambda i: i,i)
+                log.append((name,value))
+            values = yield [self.engine.submit(lambda: name),self.engine.submit(lambda: n)]
+            log.append((name,values))
+        def main():
+            yield [self.engine.spawn(steps('a',2)),self.engine.spawn(steps('b',3))]
+            log.append('end')
+        self.engine.run(main())
+        self.assertEqual(sorted(log[:-1]),sorted([('a',0),('a',1),('a',['a',2]),('b',0),('b',1),('b',2),('b',['b',3])]))
+        self.assertEqual(log[-1],'end')
+        self.assertEqual([value for name,value in log[:-1] if name == 'b'],[0,1,2,['b',3]])
+    def spawn_error_test(self):
+        caught = []
+        def fail():
+            raise ValueError("fail")
+        def steps():
+            try:
+                yield self.engine.submit(fail)
+            except ValueError as e:
+                caught.append(e)
+            yield self.engine.submit(fail)
+        self.assertRaises(ValueError,lambda: self.engine.run(steps()))
+        self.assertEqual(len(caught),1)
+    @parameterized.expand([
+        ("empty",[],[]),
+        ("done",[1,2],[1,2])
+        ])
+    def gather_done_test(self,_,values,control):
+        tasks = []
+        for value in values:
+            tasks.append(Task())
+            tasks[-1].set_result(value)
+        self.assertEqual(self.engine.wait(self.engine.gather(tasks)),control)
+    def wait_error_test(self):
+        self.assertRaises(EngineError,lambda: self.engine.wait(Task()))
+    def tearDown(self):
+        self.engine.close()
@@ -0,0 +1,70 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import patch, mock_open
+import marshal
+
+from churada import filetable
+from churada.filetable import FileTable,FileTableError
+from churada.torrent import LocalTorrent
+
+from local_torrent_test import tfile_3,tfile_3_dict
+
+files_1 = tfile_3_dict['info']['files']
+files_2 = [{'length':i,'path':['season 1','episode %d.mkv' %(i)]} for i in range(0,50)]
+files_3 = [{'length':1<<40,'path':['huge']},{'length':0,'path':['a','b','c','empty']}]
+files_4 = [{'length':(1<<31)+1,'path':['2 GiB']},{'length':(1<<32)+1,'path':['4 GiB']}]
+
+class FileTableTest(unittest.TestCase):
+    @parameterized.expand([
+        ("files_1",files_1),
+        ("files_2",files_2),
+        ("files_3",files_3)
+        ])
+    def from_files_test(self,_,files):
+        table = FileTable.from_files(files)
+        self.assertEqual(len(table),len(files))
+        self.assertEqual(table.total,sum(f['length'] for f in files))
+        self.assertEqual(list(table),[(tuple(f['path']),f['length']) for f in files])
+        self.assertEqual(table[-1],(tuple(files[-1]['path']),files[-1]['length']))
+    @parameterized.expand([
+        ("files_1",files_1),
+        ("files_2",files_2),
+        ("files_3",files_3)
+        ])
+    def load_test(self,_,files):
+        table = FileTable.from_files(files)
+        self.assertEqual(FileTable.load(marshal.loads(marshal.dumps(table.data()))),table)
+        self.assertEqual(FileTable.load(files),table)
+        self.assertEqual(FileTable.load(table) is table,True)
+    @parameterized.expand([
+        ("native",None),
+        ("double",'d')
+        ])
+    def large_test(self,_,typecode):
+        # lengths of 2 GiB or more fit wherever C long is 32-bit, as doubles
+        with patch('churada.filetable.LENGTH_TYPE',typecode or filetable.LENGTH_TYPE):
+            table = FileTable.from_files(files_4)
+            self.assertEqual(FileTable.load(marshal.loads(marshal.dumps(table.data()))),table)
+        self.assertEqual(table.total,(1<<31)+(1<<32)+2)
+        self.assertEqual(list(table),[(tuple(f['path']),f['length']) for f in files_4])
+        self.assertEqual(type(table[1][1]) in (int,long),True)
+    def interned_test(self):
+        table = FileTable.from_files(files_2)
+        self.assertEqual(table[0][0][0] is table[1][0][0],True)
+    @parameterized.expand([
+        ("no_length",[{'path':['a']}]),
+        ("no_path",[{'length':1}]),
+        ("not_list",[1,2]),
+        ("overflow",[{'length':1<<64,'path':['a']}])
+        ])
+    def error_test(self,_,files):
+        self.assertRaises(FileTableError,lambda: FileTable.from_files(files))
+    @patch('os.path.isfile',return_value=True)
+    @patch('os.path.getsize',return_value=0)
+    def ltor_test(self,mock_getsize,mock_isfile):
+        with patch("__builtin__.open",mock_open(read_data=tfile_3)) as m:
+            ltor = LocalTorrent('/path')
+        self.assertEqual(isinstance(ltor.files,FileTable),True)
+        self.assertEqual(ltor.size,5200)
+        self.assertEqual(ltor.files[1],(('subdir1','subdir3','file2'),3200))
+        self.assertEqual(LocalTorrent('/path',fields=ltor.fields()).files,ltor.files)
@@ -1,6 +1,7 @@
 from mock import MagicMock, patch, mock_open
 from string import Template
 import os
+import hashlib
 
 from churada.torrent import RemoteTorrent,RemoteTorrentError
 from churada.torrent import LocalTorrent,LocalTorrentError
@@ -11,7 +12,7 @@ from churada.seedbox import Seedbox
 
 def seedbox_gen(*args,**kwargs):
 #    return Seedbox(*args,**kwargs)
-    pass
+    return MagicMock()
 
 def ltor_gen(name=None,path=None,size=None):
     mock_ltor = MagicMock(spec=LocalTorrent)
@@ -37,7 +38,7 @@ Tracker status: $tracker: $tracker_status""")
 
 def rtor_gen(name,
              state,
-             id='abcdef1234567890',
+             id=None,
              uspeed='53',
              cseed='5',
              tseed='10',
@@ -53,6 +54,9 @@ def rtor_gen(name,
              tracker_status='Announce OK'):
     if not csize or csize > size:
         csize = size
+    # deluge IDs are info-hashes; derive a distinct one per name
+    if not id:
+        id = hashlib.sha1(name).hexdigest()
     rtor_data = rtor_template.substitute(**locals())
     timestamp = 12345
     return RemoteTorrent(rtor_data,timestamp)
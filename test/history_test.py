@@ -0,0 +1,108 @@
+import unittest
+from nose_parameterized import parameterized
+import math
+import os
+import shutil
+import tempfile
+
+from churada.history import StatsHistory
+
+from generators import rtor_gen
+
+day = 24*60*60
+
+# ratio*csize is the uploaded total; csize is 1000 bytes
+def rtor_at(name,uploaded):
+    return rtor_gen(name=name,state='Seeding',size='1000',ratio=str(uploaded/1000.0))
+
+class StatsHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.history = StatsHistory(os.path.join(self.dir,'history.db'),windows=(600,3600),
+                                    downsample=((day,3600),(7*day,day)),expire=30*day)
+    def first_sample_test(self):
+        self.assertEqual(self.history.append('box',[rtor_at('a',1000)],timestamp=0),1)
+        self.assertEqual(self.history.rates('box'),{})
+        self.assertEqual(self.history.latest('box',rtor_at('a',0).info_hash,5),[(0,1000)])
+    def rate_test(self):
+        self.history.append('box',[rtor_at('a',0),rtor_at('b',0)],timestamp=0)
+        self.history.append('box',[rtor_at('a',6000),rtor_at('b',0)],timestamp=600)
+        rates = self.history.rates('box')
+        self.assertAlmostEqual(rates[rtor_at('a',0).info_hash],10.0)
+        self.assertAlmostEqual(rates[rtor_at('b',0).info_hash],0.0)
+        # a stalls: the short window falls faster than the long one
+        self.history.append('box',[rtor_at('a',6000)],timestamp=1200)
+        short = self.history.rates('box',0)[rtor_at('a',0).info_hash]
+        long = self.history.rates('box',1)[rtor_at('a',0).info_hash]
+        self.assertAlmostEqual(short,10.0*math.exp(-1))
+        self.assertAlmostEqual(long,10.0*math.exp(-600/3600.0))
+        self.assertEqual(short < long,True)
+    @parameterized.expand([
+        ("same_time",0,0),
+        ("older",-10,0)
+        ])
+    def out_of_order_test(self,_,timestamp,count):
+        self.history.append('box',[rtor_at('a',0)],timestamp=0)
+        self.assertEqual(self.history.append('box',[rtor_at('a',100)],timestamp=timestamp),count)
+    def readded_test(self):
+        self.history.append('box',[rtor_at('a',5000)],timestamp=0)
+        self.history.append('box',[rtor_at('a',0)],timestamp=600)
+        self.assertEqual(self.history.rates('box')[rtor_at('a',0).info_hash],0.0)
+    def boxes_test(self):
+        self.history.append('box1',[rtor_at('a',0)],timestamp=0)
+        self.history.append('box2',[rtor_at('a',0)],timestamp=0)
+        self.history.append('box1',[rtor_at('a',600)],timestamp=600)
+        self.assertEqual(self.history.rates('box1').keys(),[rtor_at('a',0).info_hash])
+        self.assertEqual(self.history.rates('box2'),{})
+        self.assertEqual(len(self.history),2)
+    def latest_test(self):
+        for i in range(0,10):
+            self.history.append('box',[rtor_at('a',i*100)],timestamp=i*600)
+        self.assertEqual(self.history.latest('box',rtor_at('a',0).info_hash,3),[(5400,900),(4800,800),(4200,700)])
+        self.assertEqual(self.history.latest('box','absent',3),[])
+    def compact_test(self):
+        # one sample every 10 minutes for 10 days
+        for t in range(0,10*day,600):
+            self.history.append('box',[rtor_at('a',t)],timestamp=t)
+        now = 10*day
+        self.history.compact(now)
+        times = [t for t,uploaded in self.history.latest('box',rtor_at('a',0).info_hash,10000)]
+        recent = [t for t in times if t >= now - day]
+        hourly = [t for t in times if now - 7*day <= t < now - day]
+        daily = [t for t in times if t < now - 7*day]
+        self.assertEqual(len(recent),day/600)
+        self.assertEqual(len(hourly),6*24)
+        self.assertEqual(len(daily),3)
+        # the last sample of each bucket is kept
+        self.assertEqual(all(t % 3600 == 3000 for t in hourly),True)
+    def incremental_compact_test(self):
+        # a compact every 3 hours thins as a single compact at the end
+        other = StatsHistory(':memory:',windows=(600,3600),downsample=((day,3600),(7*day,day)),expire=30*day)
+        for t in range(0,10*day,600):
+            self.history.append('box',[rtor_at('a',t),rtor_at('b',2*t)],timestamp=t)
+            other.append('box',[rtor_at('a',t),rtor_at('b',2*t)],timestamp=t)
+            if t % (3*3600) == 0:
+                self.history.compact(t)
+        self.history.compact(10*day)
+        other.compact(10*day)
+        for name in ('a','b'):
+            info_hash = rtor_at(name,0).info_hash
+            self.assertEqual(self.history.latest('box',info_hash,10000),other.latest('box',info_hash,10000))
+        other.close()
+    def expire_test(self):
+        self.history.append('box',[rtor_at('a',0)],timestamp=0)
+        self.history.append('box',[rtor_at('b',0)],timestamp=40*day)
+        self.history.compact(40*day)
+        self.assertEqual(len(self.history),1)
+        self.assertEqual(self.history.latest('box',rtor_at('a',0).info_hash,1),[])
+    def persist_test(self):
+        self.history.append('box',[rtor_at('a',0)],timestamp=0)
+        self.history.append('box',[rtor_at('a',6000)],timestamp=600)
+        self.history.close()
+        self.history = StatsHistory(self.history.path,windows=(600,3600))
+        self.assertAlmostEqual(self.history.rates('box')[rtor_at('a',0).info_hash],10.0)
+        self.history.append('box',[rtor_at('a',6000)],timestamp=1200)
+        self.assertEqual(len(self.history.latest('box',rtor_at('a',0).info_hash,5)),3)
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.dir)
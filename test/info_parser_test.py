@@ -0,0 +1,65 @@
+import unittest
+from nose_parameterized import parameterized
+
+from churada.torrent import InfoParser,RemoteTorrent,RemoteTorrentError
+from churada import core
+
+from remote_torrent_test import info_seeding,info_paused,info_checking,info_error,info_downloading,info_unique_title
+from remote_torrent_test import dict_seeding,dict_paused,dict_checking,dict_error,dict_downloading
+from generators import rtor_gen
+
+infos = [info_seeding,info_paused,info_checking,info_error,info_downloading,info_unique_title]
+listing = "\n".join(infos)
+
+info_speeds = """Name: speeds
+ID: 0123456789abcdef0123456789abcdef01234567
+State: Downloading Down Speed: 0.0 KiB/s Up Speed: 1.5 MiB/s ETA: 1d 2h
+Size: 0.0 KiB/1.0 TiB Ratio: -1.000
+Seed time: 0 days 00:00:00 Active: 0 days 00:01:05
+Tracker status: tracker.ca: Error: unregistered torrent"""
+
+info_incomplete = """Name: incomplete
+ID: 0123456789abcdef0123456789abcdef01234567
+State: Paused
+Seed time: 0 days 00:00:00 Active: 0 days 00:01:05"""
+
+# rate is not part of the listing (see StatsHistory)
+def fields(rtor):
+    return dict((key,getattr(rtor,key)) for key in RemoteTorrent.__slots__ if hasattr(rtor,key) and key != 'rate')
+
+class InfoParserTest(unittest.TestCase):
+    @parameterized.expand([
+        ("seeding",info_seeding,dict_seeding),
+        ("paused",info_paused,dict_paused),
+        ("checking",info_checking,dict_checking),
+        ("error",info_error,dict_error),
+        ("downloading",info_downloading,dict_downloading)
+        ])
+    def parse_test(self,_,info,control):
+        control = dict(control,time=42)
+        self.assertEqual(fields(RemoteTorrent(info,42)),control)
+    @parameterized.expand([
+        ("whole",[listing]),
+        ("lines",[line+"\n" for line in listing.split("\n")]),
+        ("bytes",list(listing)),
+        ("uneven",[listing[i:i+37] for i in range(0,len(listing),37)])
+        ])
+    def stream_test(self,_,chunks):
+        control = [fields(rtor) for rtor in core.RemoteTorrent.batch_parse(listing,42)]
+        result = [fields(rtor) for rtor in RemoteTorrent.stream_parse(iter(chunks),42)]
+        self.assertEqual(result,control)
+    def generated_test(self):
+        rtors = [rtor_gen(name=str(i),state='Seeding',size=str(i)) for i in range(1,20)]
+        listing = "\n".join("Name: %s\nID: %s\nState: %s Up Speed: 53/s\nSize: %d/%d Ratio: 1.234\n"
+                            "Seed time: 10000 Active: 20000\nTracker status: tracker.com: Announce OK"
+                            %(r.name,r.id,r.state,r.csize,r.size) for r in rtors)
+        self.assertEqual(RemoteTorrent.batch_parse(listing,12345),rtors)
+    def lenient_test(self):
+        rtor = RemoteTorrent(info_speeds,42)
+        self.assertEqual((rtor.dspeed,rtor.uspeed,rtor.eta),(0.0,float(3<<19),'1d 2h'))
+        self.assertEqual((rtor.csize,rtor.size,rtor.ratio),(0.0,float(1<<40),-1.0))
+        self.assertEqual((rtor.tracker,rtor.tracker_status),('tracker.ca','Error: unregistered torrent'))
+    def incomplete_test(self):
+        self.assertRaises(RemoteTorrentError,lambda: RemoteTorrent(info_incomplete,42))
+        result = RemoteTorrent.batch_parse("\n".join([info_seeding,info_incomplete,info_unique_title]),42)
+        self.assertEqual([rtor.name for rtor in result],['torrent_name','unique_title'])
@@ -0,0 +1,156 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import MagicMock
+import os
+import shutil
+import tempfile
+
+from churada.journal import StateJournal,StateJournalError
+from churada.record import LocalRecord,RemoteRecord
+from churada.torrent import LocalTorrent
+
+from generators import rtor_gen,ltor_template
+
+rtor_test = [rtor_gen(name=str(i),state='Seeding',size=str(1000+i)) for i in range(0,5)]
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir,'journal')
+        self.ltors = [LocalTorrent(self.tfile(str(i))) for i in range(0,5)]
+        self.open()
+    def tfile(self,name):
+        path = os.path.join(self.dir,name+".torrent")
+        with open(path,'wb') as tfile:
+            tfile.write(ltor_template.substitute(announcelen=22,announce='http://www.tracker.com',
+                                                 namelen=len(name),name=name,size=int(name)+1,piece_length=524288))
+        return path
+    # a fresh journal and records on the same files, as after a restart
+    def open(self,**kwargs):
+        self.journal = StateJournal(self.path,**kwargs)
+        self.lrec = LocalRecord(None)
+        self.rrec = RemoteRecord(None,backend=MagicMock())
+        self.failures = {}
+        self.journal.attach('up_queue',self.lrec)
+        self.journal.attach('down_queue',self.rrec)
+        self.journal.track('failures',self.failures)
+        self.journal.track('down_pending',self.rrec.pending)
+    def reopen(self,**kwargs):
+        self.journal.close()
+        self.open(**kwargs)
+    def fill(self):
+        for ltor in self.ltors:
+            self.lrec.ltor_add(ltor=ltor)
+        for rtor in rtor_test:
+            self.rrec.rtor_add(rtor=rtor)
+        self.lrec.ltor_del(ltor=self.ltors[1])
+        self.rrec.rtor_del(rtor=rtor_test[3])
+        self.failures.update({'a':1,'b':[1,2]})
+    def check(self):
+        self.assertEqual([ltor.path for ltor in self.lrec],[ltor.path for ltor in self.ltors if ltor is not self.ltors[1]])
+        self.assertEqual([ltor.info_hash for ltor in self.lrec],
+                         [ltor.info_hash for ltor in self.ltors if ltor is not self.ltors[1]])
+        self.assertEqual([(r.info_hash,r.size,r.ratio,r.time) for r in self.rrec],
+                         [(r.info_hash,r.size,r.ratio,r.time) for r in rtor_test if r is not rtor_test[3]])
+        self.assertEqual([getattr(r,'score',None) for r in self.rrec],
+                         [getattr(r,'score',None) for r in rtor_test if r is not rtor_test[3]])
+        self.assertEqual(self.failures,{'a':1,'b':[1,2]})
+    def replay_test(self):
+        self.fill()
+        self.reopen()
+        self.check()
+        self.assertEqual(len(self.journal),2*5 + 2 + 2)
+    def tracked_test(self):
+        self.fill()
+        self.journal.sync()
+        self.failures['b'].append(3)
+        del self.failures['a']
+        self.reopen()
+        self.assertEqual(self.failures,{'b':[1,2,3]})
+    def crash_test(self):
+        self.fill()
+        self.journal.sync()
+        # records are journaled as they change: a crash before the next sync keeps them
+        self.lrec.ltor_del(ltor=self.ltors[0])
+        self.journal = None
+        self.open()
+        self.assertEqual([ltor.path for ltor in self.lrec],[ltor.path for ltor in self.ltors[2:]])
+    def upload_crash_test(self):
+        # as Seedbox.__uploaded: the torrent goes to the pending lookups, then leaves the up queue
+        self.fill()
+        self.journal.sync()
+        ltor = self.ltors[0]
+        self.rrec.rtor_add(name=ltor.name,info_hash=ltor.info_hash)
+        self.lrec.ltor_del(ltor=ltor)
+        # crash before the next sync: it is still pending
+        self.journal = None
+        self.open()
+        self.assertEqual([l.path for l in self.lrec],[l.path for l in self.ltors[2:]])
+        self.assertEqual(self.rrec.pending.keys(),[ltor.info_hash])
+    @parameterized.expand([
+        ("truncated",lambda data: data[:-3]),
+        ("garbage",lambda data: data[:-3] + "\x00\x00\x00\x10\x01\x02"),
+        ("corrupted",lambda data: data[:-1] + chr(ord(data[-1]) ^ 0xff))
+        ])
+    def torn_test(self,_,tear):
+        self.fill()
+        self.journal.sync()
+        self.lrec.ltor_del(ltor=self.ltors[0])
+        self.journal.close()
+        with open(self.path,'rb') as journal:
+            data = journal.read()
+        with open(self.path,'wb') as journal:
+            journal.write(tear(data))
+        self.open()
+        self.check()
+        # the torn entry is gone from the file: new entries follow intact ones
+        self.lrec.ltor_del(ltor=self.ltors[2])
+        self.reopen()
+        self.assertEqual([ltor.path for ltor in self.lrec],[self.ltors[i].path for i in (0,3,4)])
+    def snapshot_test(self):
+        self.reopen(snapshot_every=5)
+        self.fill()
+        self.journal.sync()
+        self.assertEqual(len(self.journal),0)
+        self.assertEqual(os.path.getsize(self.path),0)
+        self.rrec.rtor_del(rtor=rtor_test[4])
+        self.rrec.rtor_add(rtor=rtor_test[4])
+        self.reopen()
+        self.check()
+        self.assertEqual(len(self.journal),2)
+    def snapshot_crash_test(self):
+        self.fill()
+        self.journal.sync()
+        with open(self.path,'rb') as journal:
+            data = journal.read()
+        self.journal.snapshot()
+        # crash after the snapshot is in place, before the journal is emptied
+        self.journal.close()
+        with open(self.path,'wb') as journal:
+            journal.write(data)
+        self.open()
+        self.check()
+        self.assertEqual(len(self.journal),0)
+    def missing_file_test(self):
+        self.fill()
+        os.remove(self.ltors[2].path)
+        self.reopen()
+        self.assertEqual([ltor.path for ltor in self.lrec],[self.ltors[i].path for i in (0,3,4)])
+    def unattached_test(self):
+        self.fill()
+        self.journal.close()
+        self.journal = StateJournal(self.path,snapshot_every=1)
+        self.journal.track('failures',self.failures)
+        self.journal.sync()
+        self.assertEqual(len(self.journal),0)
+        self.open()
+        self.check()
+    def attach_error_test(self):
+        self.assertRaises(StateJournalError,lambda: self.journal.attach('other',[]))
+    def bad_snapshot_test(self):
+        self.journal.close()
+        with open(self.path + '.snapshot','wb') as snapshot:
+            snapshot.write("bad")
+        self.assertRaises(StateJournalError,lambda: StateJournal(self.path))
+    def tearDown(self):
+        shutil.rmtree(self.dir)
@@ -46,7 +46,7 @@ class LocalRecordTest(unittest.TestCase):
         ("present_name",ltor_test,{'name':'3'},ltor_test[3]),
         ("present_path",ltor_test,{'path':'/2'},ltor_test[2]),
         ("present_object",ltor_test,{'ltor':ltor_test[4]},ltor_test[4]),
-        ("equal_object_1",ltor_test,{'ltor':ltor_gen(name='4',path='/not4')},ltor_test[4]),
+        ("same_name_object",ltor_test,{'ltor':ltor_gen(name='4',path='/not4')},None),
         ("equal_object_2",ltor_test,{'ltor':ltor_gen(name='not4',path='/4')},ltor_test[4]),
         ("absent_name",ltor_test,{'name':'5'},None),
         ("absent_path",ltor_test,{'path':'/5'},None),
@@ -77,9 +77,10 @@ class LocalRecordTest(unittest.TestCase):
         ("arg_priority_4",ltor_test,{'name':'5','path':'/4'},[3,ltor_elem],True)]
        )
     def ltor_del_test(self,_,control,func_args,ins_args,del_flag):
-        self.lrec.record = control[:]
+        record = control[:]
         if del_flag:
-            self.lrec.record.insert(*ins_args)
+            record.insert(*ins_args)
+        self.lrec.record = record
         self.lrec.ltor_del(**func_args)
         self.assertEqual(self.lrec.record,control)
 #    @parameterized.expand(
@@ -113,5 +114,59 @@ class LocalRecordTest(unittest.TestCase):
 #            mock_ltor_parse(control[index],**upd_args)
 #        self.lrec.ltor_update(**func_args)
 #        self.assertEquals(self.lrec.record,control)
-
+    @parameterized.expand(
+       [("first",0),
+        ("middle",2),
+        ("last",4)]
+       )
+    def ltor_del_index_test(self,_,index):
+        self.lrec.record = ltor_test[:]
+        self.lrec.ltor_del(ltor=ltor_test[index])
+        for ltor in ltor_test:
+            present = ltor is not ltor_test[index]
+            self.assertEqual(self.lrec.ltor_find(name=ltor.name) is ltor,present)
+            self.assertEqual(self.lrec.ltor_find(path=ltor.path) is ltor,present)
+            self.assertEqual(self.lrec.ltor_find(info_hash=ltor.info_hash) is ltor,present)
+        self.assertEqual(len(self.lrec),len(ltor_test)-1)
+    def ltor_shared_name_test(self):
+        first = ltor_gen(name='3',path='/3a',size=30)
+        self.lrec.record = ltor_test[:]
+        self.lrec.ltor_add(ltor=first,pos=1)
+        self.assertEqual(self.lrec.ltor_find(name='3') is first,True)
+        self.lrec.ltor_del(ltor=first)
+        self.assertEqual(self.lrec.ltor_find(name='3') is ltor_test[3],True)
+    def ltor_sort_test(self):
+        self.lrec.record = ltor_test[::-1]
+        self.lrec.ltor_sort()
+        self.assertEqual(self.lrec.record,ltor_test)
+        self.assertEqual(self.lrec.ltor_find(path='/2') is ltor_test[2],True)
+    # a record with tombstones skips items deleted meanwhile; one without walks a snapshot
+    @parameterized.expand([
+        ("holes",True,[ltor_test[0],ltor_test[1],ltor_test[2],ltor_test[4]]),
+        ("no_holes",False,ltor_test)
+        ])
+    def iter_mutate_test(self,_,holes,control):
+        self.lrec.record = ltor_test[:] + [ltor_elem]
+        if holes:
+            self.lrec.ltor_del(ltor=ltor_elem)
+        else:
+            self.lrec.record = ltor_test[:]
+        result = []
+        for ltor in self.lrec:
+            result.append(ltor)
+            self.lrec.ltor_del(ltor=ltor)
+            if ltor is ltor_test[1]:
+                self.lrec.ltor_del(ltor=ltor_test[3])
+                self.lrec.ltor_add(ltor=ltor_elem)
+        self.assertEqual(result,control)
+        self.assertEqual(self.lrec.record,[ltor_elem])
+    def iter_reorder_test(self):
+        self.lrec.record = ltor_test[:]
+        result = []
+        for ltor in self.lrec:
+            result.append(ltor)
+            if ltor is ltor_test[0]:
+                self.lrec.ltor_add(ltor=ltor_elem,pos=0)
+        self.assertEqual(result,ltor_test)
+        self.assertEqual(self.lrec.record,[ltor_elem]+ltor_test)
 
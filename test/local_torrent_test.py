@@ -4,11 +4,12 @@ from mock import MagicMock
 from mock import mock_open
 from mock import patch
 import re
+import hashlib
 import __builtin__
 import os.path
 import shutil
 
-from churada.torrent import LocalTorrent,LocalTorrentError
+from churada.torrent import LocalTorrent,LocalTorrentError,parse_local
 
 tfile_1 = ("d8:announce21:http://www.tracker.ca13:announce-listll10:announce"
 "-110:announce-2ee13:creation datei10000e7:comment4:blah10:created by7:creator4:in"
@@ -132,6 +133,35 @@ class LocalTorrentTest(unittest.TestCase):
             ltor2 = LocalTorrent(path2)
         self.assertEqual(ltor1.__eq__(ltor2), eq_flag)
         self.assertEqual(ltor1.__ne__(ltor2), not eq_flag)
+    @parameterized.expand(
+       [("info_hash_1",tfile_1),
+        ("info_hash_2",tfile_2),
+        ("info_hash_3",tfile_3),
+        ("info_hash_4",tfile_4)])
+    def info_hash_test(self,_,tfile):
+        # the info dictionary is the last value of each test file
+        info = tfile[tfile.index("4:infod")+6:-1]
+        with patch("__builtin__.open", mock_open(read_data=tfile)) as m:
+            ltor = LocalTorrent('/path')
+        self.assertEqual(ltor.info_hash,hashlib.sha1(info).hexdigest())
+    @parameterized.expand(
+       [("slot",tfile_1,'announce','http://www.tracker.ca'),
+        ("extra_1",tfile_1,'created by','creator'),
+        ("extra_2",tfile_3,'announce-list',[['announce-5','announce-6']]),
+        ("extra_info",tfile_3,'piece length',123),
+        ("absent_slot",tfile_1,'files',None),
+        ("absent_extra",tfile_3,'created by',None),
+        ("skipped",tfile_1,'pieces',None)])
+    def fields_test(self,_,tfile,key,value):
+        with patch("__builtin__.open", mock_open(read_data=tfile)) as m:
+            ltor = LocalTorrent('/path')
+        self.assertEqual(hasattr(ltor,'__dict__'),False)
+        if value is None:
+            self.assertRaises(AttributeError,lambda: getattr(ltor,key))
+            self.assertEqual(key in ltor.fields(),False)
+        else:
+            self.assertEqual(getattr(ltor,key),value)
+            self.assertEqual(ltor.fields()[key],value)
     @parameterized.expand(
        [("nonzero_1",tfile_1,'/path',True,True),
         ("nonzero_2",tfile_2,'/path',True,True),
@@ -162,5 +192,17 @@ class LocalTorrentTest(unittest.TestCase):
                 self.assertRaises(LocalTorrentError,lambda: ltor.move(dest))
                 self.assertEqual(mock_move.called,False)
                 self.assertEqual(ltor.path,path)
+    def parse_local_test(self):
+        with patch("__builtin__.open", mock_open(read_data=tfile_1)) as m:
+            path,fields,error = parse_local('/path')
+        self.assertEqual((path,error),('/path',None))
+        self.assertEqual(fields['name'],'single_file.ext')
+    @parameterized.expand(
+       [("invalid",LocalTorrentError("parse error: badly formed data"),"parse error: badly formed data"),
+        ("unexpected",RuntimeError("maximum recursion depth exceeded"),
+         "parse error: RuntimeError: maximum recursion depth exceeded")])
+    def parse_local_error_test(self,_,error,control):
+        with patch.object(LocalTorrent,'_LocalTorrent__parse',side_effect=error):
+            self.assertEqual(parse_local('/path'),('/path',None,control))
     def tearDown(self):
         patch.stopall()
@@ -0,0 +1,56 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import MagicMock
+
+from churada.locator import Locator,LocatorError
+from churada.record import LocalRecord,RemoteRecord
+
+from generators import ltor_gen,rtor_gen
+
+ltor_test = [ltor_gen(name=str(i),path='/'+str(i),size=i) for i in range(0,5)]
+rtor_test = [rtor_gen(name=str(i),state='Seeding') for i in range(3,8)]
+
+class LocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.lrec = LocalRecord(None)
+        self.lrec.record = ltor_test[:3]
+        self.rrec = RemoteRecord(None,backend=MagicMock())
+        self.rrec.record = rtor_test[:3]
+        self.locator = Locator()
+        self.locator.watch('local',self.lrec)
+        self.locator.watch('remote',self.rrec)
+    @parameterized.expand([
+        ("local_hash",{'info_hash':ltor_test[1].info_hash},['local']),
+        ("remote_hash",{'info_hash':rtor_test[2].info_hash},['remote']),
+        ("both_names",{'name':'0'},['local']),
+        ("name",{'name':'4'},['remote']),
+        ("absent_hash",{'info_hash':ltor_test[4].info_hash},[]),
+        ("absent_name",{'name':'9'},[]),
+        ("empty_args",{},[]),
+        ("arg_priority",{'info_hash':rtor_test[0].info_hash,'name':'0'},['remote'])
+        ])
+    def locate_test(self,_,func_args,control):
+        self.assertEqual(self.locator.locate(**func_args),control)
+        self.assertEqual(self.locator.find(**func_args),control[0] if control else None)
+    def mutation_test(self):
+        self.lrec.ltor_add(ltor=ltor_test[3])
+        self.lrec.ltor_del(ltor=ltor_test[0])
+        self.rrec.rtor_add(rtor=rtor_test[3])
+        self.assertEqual(self.locator.locate(name='3'),['local','remote'])
+        self.assertEqual(self.locator.locate(info_hash=ltor_test[0].info_hash),[])
+        self.assertEqual(self.locator.locate(info_hash=rtor_test[3].info_hash),['remote'])
+        self.rrec.rtor_del(rtor=rtor_test[0])
+        self.assertEqual(self.locator.locate(name='3'),['local'])
+    def merge_test(self):
+        self.rrec.merge(rtor_test[2:])
+        self.assertEqual([self.locator.find(info_hash=rtor.info_hash) for rtor in rtor_test],
+                         [None,None,'remote','remote','remote'])
+    def shared_name_test(self):
+        other = ltor_gen(name='1',path='/other',size=10)
+        self.lrec.ltor_add(ltor=other)
+        self.lrec.ltor_del(ltor=ltor_test[1])
+        self.assertEqual(self.locator.locate(name='1'),['local'])
+        self.lrec.ltor_del(ltor=other)
+        self.assertEqual(self.locator.locate(name='1'),[])
+    def watch_twice_test(self):
+        self.assertRaises(LocatorError,lambda: self.locator.watch('local',LocalRecord(None)))
@@ -0,0 +1,130 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import MagicMock,patch
+import socket
+
+from churada.pool import ConnectionPool,ConnectionPoolError
+from churada.shell import Shell
+
+def client_gen(active=True,authenticated=True):
+    client = MagicMock()
+    client.get_transport.return_value.is_active.return_value = active
+    client.get_transport.return_value.is_authenticated.return_value = authenticated
+    return client
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = []
+        self.connect = MagicMock(side_effect=self.client_gen)
+        self.pool = ConnectionPool(keepalive=15,attempts=3,backoff=1,max_backoff=4,connect=self.connect)
+    def client_gen(self,uname,host):
+        self.clients.append(client_gen())
+        return self.clients[-1]
+    def reuse_test(self):
+        client = self.pool.get('user','host')
+        self.assertIs(self.pool.get('user','host'),client)
+        self.assertIsNot(self.pool.get('other','host'),client)
+        self.assertEqual(self.connect.call_count,2)
+        client.get_transport.return_value.set_keepalive.assert_called_once_with(15)
+        stats = self.pool.stats()
+        self.assertEqual((stats['user@host']['connects'],stats['user@host']['reuses']),(1,1))
+        self.assertEqual(len(self.pool),2)
+    @parameterized.expand([
+        ("inactive",lambda transport: setattr(transport.is_active,'return_value',False)),
+        ("unauthenticated",lambda transport: setattr(transport.is_authenticated,'return_value',False)),
+        ("ignore_fails",lambda transport: setattr(transport.send_ignore,'side_effect',EOFError()))
+        ])
+    def dead_test(self,_,kill):
+        self.pool.check_after = 0
+        client = self.pool.get('user','host')
+        kill(client.get_transport.return_value)
+        with patch('time.time',return_value=1e12):
+            other = self.pool.get('user','host')
+        self.assertIsNot(other,client)
+        client.close.assert_called_once_with()
+        self.assertEqual(self.pool.stats()['user@host']['discards'],1)
+    def idle_check_test(self):
+        client = self.pool.get('user','host')
+        self.pool.get('user','host')
+        self.assertFalse(client.get_transport.return_value.send_ignore.called)
+        with patch('time.time',return_value=1e12):
+            self.assertIs(self.pool.get('user','host'),client)
+        client.get_transport.return_value.send_ignore.assert_called_once_with()
+    @patch('time.sleep')
+    def backoff_test(self,sleep):
+        self.connect.side_effect = socket.error("refused")
+        self.assertRaises(socket.error,lambda: self.pool.get('user','host'))
+        self.assertEqual([args[0] for args,kwargs in sleep.call_args_list],[1,2])
+        self.assertEqual(self.pool.stats()['user@host']['failures'],3)
+        # no attempt until max_backoff has passed
+        self.assertRaises(ConnectionPoolError,lambda: self.pool.get('user','host'))
+        self.assertEqual(self.connect.call_count,3)
+        self.connect.side_effect = self.client_gen
+        with patch('time.time',return_value=1e12):
+            self.assertIs(self.pool.get('user','host'),self.clients[-1])
+    @patch('time.sleep')
+    def recover_test(self,sleep):
+        self.connect.side_effect = [socket.error("refused"),client_gen()]
+        client = self.pool.get('user','host')
+        self.assertEqual(self.pool.stats()['user@host']['failures'],1)
+        self.assertIs(self.pool.get('user','host'),client)
+    def close_test(self):
+        clients = [self.pool.get('user',host) for host in ('a','b')]
+        self.pool.close()
+        self.assertEqual(len(self.pool),0)
+        for client in clients:
+            client.close.assert_called_once_with()
+
+class ShellPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.client = client_gen()
+        self.pool = ConnectionPool(connect=MagicMock(return_value=self.client))
+        self.shell = Shell('user','host',pool=self.pool)
+        self.func = MagicMock()
+    def queue(self,*commands):
+        for command in commands:
+            self.shell.add_ssh(command,self.func,{})
+    def persistent_test(self):
+        command = MagicMock(return_value=(0,"out"))
+        for i in range(0,3):
+            self.queue(command)
+            self.shell.do_ssh()
+        self.assertEqual([args[0] for args,kwargs in command.call_args_list],[self.client]*3)
+        self.func.assert_called_with(exitcode=0,output="out")
+        stats = self.pool.stats()['user@host']
+        self.assertEqual((stats['connects'],stats['reuses'],stats['commands']),(1,2,3))
+    def unreachable_test(self):
+        self.pool.connect.side_effect = ConnectionPoolError("down")
+        self.queue("a","b")
+        self.shell.do_ssh()
+        self.assertEqual(self.func.call_args_list,[((),{'exitcode':None,'output':None})]*2)
+        self.assertEqual(self.shell.ssh_queue,[])
+    def command_error_test(self):
+        self.queue(MagicMock(side_effect=socket.error("reset")),MagicMock(return_value=(0,"out")))
+        self.shell.do_ssh()
+        # the connection is dropped: later commands of the flush are not run on it
+        self.assertEqual(self.func.call_args_list,[((),{'exitcode':None,'output':None})]*2)
+        self.client.close.assert_called_once_with()
+        self.assertEqual(len(self.pool),0)
+    def retry_test(self):
+        fresh = client_gen()
+        stdout = MagicMock()
+        fresh.exec_command.return_value = (MagicMock(),stdout,MagicMock())
+        channel = stdout.channel
+        channel.recv_ready.return_value = False
+        channel.recv_stderr_ready.return_value = False
+        channel.eof_received = True
+        channel.recv_exit_status.return_value = 0
+        self.pool.connect.side_effect = [self.client,fresh]
+        self.client.exec_command.side_effect = EOFError()
+        self.queue("ls")
+        self.shell.do_ssh()
+        fresh.exec_command.assert_called_once_with("ls")
+        self.func.assert_called_once_with(exitcode=0,output="")
+    def chained_test(self):
+        def chain(exitcode,output):
+            self.shell.add_ssh(MagicMock(return_value=(0,"second")),self.func,{})
+        self.shell.add_ssh(MagicMock(return_value=(0,"first")),chain,{})
+        self.shell.do_ssh()
+        self.func.assert_called_once_with(exitcode=0,output="second")
+        self.assertEqual(self.shell.ssh_queue,[])
@@ -5,7 +5,7 @@ from mock import MagicMock,patch
 from churada.record import LocalRecord,RemoteRecord
 from churada.torrent import LocalTorrent,RemoteTorrent
 
-from generators import ltor_gen,rtor_gen
+from generators import ltor_gen,rtor_gen,rtor_template
 
 rtor_test = [rtor_gen(name=str(i),state=str(i),size=i) for i in range(0,5)]
 rtor_elem = rtor_gen(name='5',state='5',size=5)
@@ -20,9 +20,11 @@ class RemoteRecordTest(unittest.TestCase):
         ("present_name",rtor_test,{'name':'1'},False,False),
         ("absent_obj",rtor_test,{'rtor':rtor_elem},False,True),
         ("absent_name",rtor_test,{'name':'5'},True,False),
+        ("absent_info_hash",rtor_test,{'info_hash':rtor_elem.info_hash},True,False),
+        ("present_info_hash",rtor_test,{'info_hash':rtor_test[1].info_hash},False,False),
         ("arg_priority",rtor_test,{'rtor':rtor_elem,'name':'5'},False,True)]
        )
-    def rtor_add_test(self,_,control,func_args,ssh_flag,add_flag):
+    def rtor_add_test(self,_,control,func_args,pending_flag,add_flag):
         control = control[:]
         self.rrec.record = control[:]
         self.rrec.rtor_add(**func_args)
@@ -32,11 +34,41 @@ class RemoteRecordTest(unittest.TestCase):
             else:
                 control.append(func_args['rtor'])
             self.assertEqual(self.rrec.shell.add_ssh.called,False)
-        elif ssh_flag:
-            pos = func_args['pos'] if 'pos' in func_args else None
-            command = self.rrec.info_cmd %(func_args['name'])
-            self.rrec.shell.add_ssh.assert_called_once()
+        # lookups wait for resolve()
+        self.assertEqual(self.rrec.shell.add_ssh.called,False)
+        self.assertEqual(len(self.rrec.pending),1 if pending_flag else 0)
         self.assertEqual(control,self.rrec.record)
+    def resolve_test(self):
+        self.rrec.record = rtor_test[:]
+        absent = rtor_gen(name='6',state='6')
+        self.rrec.rtor_add(name='5')
+        self.rrec.rtor_add(name='5',info_hash=rtor_elem.info_hash)
+        self.rrec.rtor_add(name='6',pos=0)
+        self.rrec.rtor_add(name='never')
+        self.rrec.resolve()
+        self.rrec.shell.add_ssh.assert_called_once()
+        command,func,args = self.rrec.shell.add_ssh.call_args[0]
+        # added while the query is queued: not part of it
+        self.rrec.rtor_add(name='late')
+        func(exitcode=0,output=self.__console(rtor_elem,absent),**args)
+        self.assertEqual(self.rrec.record,[absent]+rtor_test+[rtor_elem])
+        self.assertEqual(self.rrec.pending.keys(),['never','late'])
+        self.assertEqual([entry[3] for entry in self.rrec.pending.values()],[1,0])
+    def resolve_drop_test(self):
+        self.rrec.rtor_add(name='never')
+        for i in range(0,5):
+            self.rrec.resolve()
+            command,func,args = self.rrec.shell.add_ssh.call_args[0]
+            func(exitcode=0,output="",**args)
+        self.assertEqual(len(self.rrec.pending),0)
+        self.rrec.resolve()
+        self.assertEqual(self.rrec.shell.add_ssh.call_count,5)
+    @staticmethod
+    def __console(*rtors):
+        return "\n".join(rtor_template.substitute(name=rtor.name,id=rtor.info_hash,state=rtor.state,uspeed='0',
+                                                  cseed='0',tseed='0',cpeer='0',tpeer='0',avail='0',csize='1',
+                                                  size='1',ratio='0',stime='0',atime='0',tracker='t',
+                                                  tracker_status='OK') for rtor in rtors)
     @parameterized.expand(
        [("empty_args",rtor_test,{},[],False),
         ("present_obj",rtor_test,{'rtor':rtor_elem},[3,rtor_elem],True),
@@ -48,7 +80,7 @@ class RemoteRecordTest(unittest.TestCase):
     def rtor_del_test(self,_,control,func_args,ins_args,del_flag):
         self.rrec.record = control[:]
         if del_flag:
-            self.rrec.record.insert(*ins_args)
+            self.rrec.rtor_add(rtor=ins_args[1])
         self.rrec.rtor_del(**func_args)
         self.assertEqual(self.rrec.record,control)
     @parameterized.expand(
@@ -64,6 +96,118 @@ class RemoteRecordTest(unittest.TestCase):
         self.rrec.record = control[:]
         result = self.rrec.rtor_find(**func_args)
         self.assertEqual(result,return_value)
+    @parameterized.expand(
+       [("unchanged",rtor_test,rtor_test,[],[],[]),
+        ("added",rtor_test,rtor_test+[rtor_elem],[rtor_elem],[],[]),
+        ("removed",rtor_test,rtor_test[1:],[],[rtor_test[0]],[]),
+        ("changed",rtor_test,rtor_test[:2]+[rtor_gen(name='2',state='Seeding',size=2)]+rtor_test[3:],[],[],['2']),
+        ("empty",rtor_test,[],[],rtor_test,[]),
+        ("from_empty",[],rtor_test,rtor_test,[],[])]
+       )
+    def merge_test(self,_,record,listing,added,removed,changed):
+        self.rrec.record = [rtor_gen(name=r.name,state=r.state,size=r.size) for r in record]
+        before = dict((r.info_hash,r) for r in self.rrec.record)
+        listener = MagicMock()
+        self.rrec.subscribe(listener)
+        result = self.rrec.merge(listing)
+        self.assertEqual(result[0],added)
+        self.assertEqual(sorted(r.name for r in result[1]),sorted(r.name for r in removed))
+        self.assertEqual([r.name for r in result[2]],changed)
+        listener.assert_called_once_with(added=result[0],removed=result[1],changed=result[2])
+        self.assertEqual([r.name for r in self.rrec.record],[r.name for r in listing])
+        self.assertEqual([r.state for r in self.rrec.record],[r.state for r in listing])
+        # existing records are updated in place
+        for rtor in self.rrec.record:
+            if rtor.info_hash in before:
+                self.assertEqual(rtor is before[rtor.info_hash],True)
+            self.assertEqual(self.rrec.rtor_find(info_hash=rtor.info_hash) is rtor,True)
+    def unsubscribe_test(self):
+        listener = MagicMock()
+        self.rrec.subscribe(listener)
+        self.rrec.unsubscribe(listener)
+        self.rrec.merge(rtor_test)
+        self.assertEqual(listener.called,False)
+    # a record with tombstones skips items deleted meanwhile; one without walks a snapshot
+    @parameterized.expand([
+        ("holes",True,[rtor_test[0],rtor_test[1],rtor_test[3],rtor_test[4]]),
+        ("no_holes",False,rtor_test)
+        ])
+    def iter_mutate_test(self,_,holes,control):
+        self.rrec.record = rtor_test[:] + [rtor_elem]
+        if holes:
+            self.rrec.rtor_del(rtor=rtor_elem)
+        else:
+            self.rrec.record = rtor_test[:]
+        result = []
+        for rtor in self.rrec:
+            result.append(rtor)
+            if rtor is rtor_test[0]:
+                self.rrec.rtor_del(rtor=rtor_test[2])
+                self.rrec.rtor_add(rtor=rtor_elem)
+        self.assertEqual(result,control)
+        self.assertEqual(self.rrec.record,rtor_test[:2]+rtor_test[3:]+[rtor_elem])
+    def compact_test(self):
+        rtors = [rtor_gen(name=str(i),state='Seeding') for i in range(0,200)]
+        self.rrec.record = rtors[:]
+        for rtor in rtors[:150]:
+            self.rrec.rtor_del(rtor=rtor)
+        self.assertEqual(self.rrec.record,rtors[150:])
+        self.assertEqual([self.rrec.rtor_find(info_hash=rtor.info_hash) for rtor in rtors],[None]*150+rtors[150:])
+
+# score is 10**6*ratio/atime: atime 0 leaves a torrent unscored
+rtor_scored = [rtor_gen(name='s'+str(i),state='Seeding' if i % 2 else 'Paused',ratio=str(r),atime=str(a))
+               for i,(r,a) in enumerate([(3,1000),(1,1000),(2,1000),(5,0),(0.5,1000),(4,1000)])]
+
+class RemoteRecordOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.rrec = RemoteRecord(MagicMock())
+        self.rrec.merge([rtor_gen(name=r.name,state=r.state,ratio=str(r.ratio),atime=str(r.atime)) for r in rtor_scored])
+    def names(self,rtor_iter):
+        return [rtor.name for rtor in rtor_iter]
+    @parameterized.expand(
+       [("all",None,['s4','s1','s2','s0','s5','s3']),
+        ("filter",lambda rtor: rtor.state == 'Seeding',['s1','s5','s3'])]
+       )
+    def iter_by_score_test(self,_,filter,control):
+        self.assertEqual(self.names(self.rrec.iter_by_score(filter=filter)),control)
+        # walking does not consume the order
+        self.assertEqual(self.names(self.rrec.iter_by_score(filter=filter)),control)
+    def iter_by_priority_test(self):
+        self.assertEqual(self.names(self.rrec.iter_by_priority()),[r.name for r in rtor_scored])
+        rrec = RemoteRecord(MagicMock(),priority=lambda rtor: -rtor.ratio)
+        rrec.record = rtor_scored[:]
+        self.assertEqual(self.names(rrec.iter_by_priority()),['s3','s5','s0','s2','s1','s4'])
+    def merge_order_test(self):
+        self.rrec.iter_by_score().next()
+        listing = [rtor_gen(name=r.name,state=r.state,ratio=str(r.ratio),atime=str(r.atime)) for r in rtor_scored[1:]]
+        listing[0] = rtor_gen(name='s1',state='Seeding',ratio='10',atime='1000')
+        listing.append(rtor_gen(name='s6',state='Seeding',ratio='0.1',atime='1000'))
+        self.rrec.merge(listing)
+        self.assertEqual(self.names(self.rrec.iter_by_score()),['s6','s4','s2','s5','s1','s3'])
+    def rekey_test(self):
+        rrec = RemoteRecord(MagicMock(),score=lambda rtor: rtor.rate if rtor.rate is not None else float('inf'))
+        rrec.record = [rtor_gen(name=r.name,state=r.state) for r in rtor_scored]
+        self.assertEqual(self.names(rrec.iter_by_score()),[r.name for r in rtor_scored])
+        rtors = rrec.record
+        for rtor,rate in zip(rtors,[2.0,None,1.0,None,0.0,3.0]):
+            rtor.rate = rate
+        rrec.rekey(rtors)
+        self.assertEqual(self.names(rrec.iter_by_score()),['s4','s2','s0','s5','s1','s3'])
+    def del_while_walking_test(self):
+        result = []
+        for rtor in self.rrec.iter_by_score():
+            result.append(rtor.name)
+            self.rrec.rtor_del(rtor=rtor)
+            if rtor.name == 's1':
+                self.rrec.rtor_del(name='s0')
+        self.assertEqual(result,['s4','s1','s2','s5','s3'])
+        self.assertEqual(len(self.rrec),0)
+    def compact_test(self):
+        rtors = [rtor_gen(name=str(i),state='Seeding',ratio=str(i),atime='1000') for i in range(0,200)]
+        self.rrec.merge(rtors)
+        self.rrec.iter_by_score().next()
+        self.rrec.merge(rtors[150:])
+        self.assertEqual(self.names(self.rrec.iter_by_score()),[str(i) for i in range(150,200)])
 #    @parameterized.expand(
 #       [("empty_args",rtor_test,{},None,False),
 #        ("present_obj",rtor_test,{'rtor':rtor_test[1]},1,True),
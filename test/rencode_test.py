@@ -0,0 +1,54 @@
+import unittest
+from nose_parameterized import parameterized
+
+from churada.rencode import dumps,loads,RencodeError
+
+class RencodeTest(unittest.TestCase):
+    @parameterized.expand([
+        ("fixed_int",5),
+        ("fixed_neg_int",-5),
+        ("int1",100),
+        ("int2",-1000),
+        ("int4",1<<20),
+        ("int8",-(1<<40)),
+        ("big_int",1<<70),
+        ("float",0.125),
+        ("true",True),
+        ("false",False),
+        ("none",None),
+        ("string","spam"),
+        ("long_string","x"*1000),
+        ("unicode",u"\xe9t\xe9"),
+        ("list",(1,"a",None)),
+        ("long_list",tuple(range(0,100))),
+        ("dict",{'a':1,'b':(2,3)}),
+        ("long_dict",dict((str(i),i) for i in range(0,30))),
+        ("nested",((1,{'k':("v",)}),{}))
+        ])
+    def roundtrip_test(self,_,value):
+        self.assertEqual(loads(dumps(value)),value)
+    @parameterized.expand([
+        ("zero",0,'\x00'),
+        ("minus_one",-1,'\x46'),
+        ("string","a",'\x81a'),
+        ("empty_list",[],'\xc0'),
+        ("empty_dict",{},'\x66'),
+        ("none",None,'\x45'),
+        ("long_string","x"*64,"64:"+"x"*64)
+        ])
+    def encoding_test(self,_,value,control):
+        self.assertEqual(dumps(value),control)
+    def list_as_tuple_test(self):
+        self.assertEqual(loads(dumps([1,[2]])),(1,(2,)))
+    @parameterized.expand([
+        ("empty",""),
+        ("trailing",dumps(1)+dumps(2)),
+        ("truncated_string",'\x85ab'),
+        ("truncated_list",'\xc2\x01'),
+        ("truncated_int",'\x3f\x01'),
+        ("bad_token",'\x7f')
+        ])
+    def error_test(self,_,data):
+        self.assertRaises(RencodeError,lambda: loads(data))
+    def unsupported_test(self):
+        self.assertRaises(RencodeError,lambda: dumps(object()))
@@ -17,7 +17,9 @@ class RuleTest(unittest.TestCase):
         ("query_true_5",ltor_test[1],{'key':'path','func':lambda x: x == '/11'},True),
         ("query_false_0",rtor_test[4],{'key':'size','func':lambda x: x < 2},False),
         ("query_false_1",ltor_test[2],{'key':'size','func':lambda x: x < 2},False),
-        ("query_false_2",ltor_test[3],{'key':'state','func':lambda: True},False)
+        ("query_false_2",ltor_test[3],{'key':'state','func':lambda: True},False),
+        ("query_extra",ltor_test[4],{'key':'piece length','func':lambda x: x == 524288},True),
+        ("query_none",rtor_test[5],{'key':'dspeed','func':lambda x: x is None},True)
         ])
     def query_test(self,_,obj,func_args,query_flag):
         rule = Rule(**func_args)
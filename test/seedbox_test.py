@@ -17,7 +17,6 @@ rtor_elem = rtor_gen(name='5',state='5',size=5)
 down_list = [rtor_gen(name=str(i),state=str(i),size=i) for i in range(10,5,-1)]
 up_list = [ltor_gen(name=str(i),path="/"+str(i),size=i) for i in range(10,5,-1)]
 info_list = [rtor_elem] + [rtor_gen(name=str(i),state=str(i),size=i) for i in range(20,5,-1)]
-size = 185
 paths = {'remote_torrent':"remote_torrent",
          'remote_data':"remote_data",
          'local_data':"local_data"}
@@ -50,131 +49,127 @@ host = 'host'
 
 # note that validity/path rules are not tested
 class SeedboxTest(unittest.TestCase):
+    """ base of the seedbox tests: a seedbox with filled queues, on a mocked shell """
     def setUp(self):
+        patcher_isdir = patch('os.path.isdir',return_value=True)
+        patcher_isdir.start()
+        self.addCleanup(patcher_isdir.stop)
         self.seedbox = Seedbox(uname,host,capacity,paths,rules)
         self.seedbox.shell = MagicMock()
-        self.seedbox.up_queue.record = up_list
-        self.seedbox.down_queue.record = down_list
-        self.seedbox.info.record = info_list
-        self.capacity = capacity
-        self.size = size
+        self.seedbox.backend.shell = self.seedbox.shell
+        self.seedbox.up_queue.record = up_list[:]
+        self.seedbox.down_queue.record = down_list[:]
+        self.seedbox.info.record = info_list[:]
+
+class SeedboxUpdateTest(SeedboxTest):
+    @parameterized.expand([
+        ("emptied",0,[]),
+        ("failed",None,info_list[:3])
+        ])
+    def empty_listing_test(self,_,exitcode,control):
+        self.seedbox.info.record = info_list[:3]
+        self.seedbox.down_queue.record = info_list[:2]
+        self.seedbox._Seedbox__update(exitcode=exitcode,output=[])
+        self.assertEqual(self.seedbox.info.record,control)
+        self.assertEqual(self.seedbox.down_queue.record,control[:2])
+
+class SeedboxDeleteTest(SeedboxTest):
+    def setUp(self):
+        SeedboxTest.setUp(self)
+        self.seedbox.backend = MagicMock()
+        self.seedbox.down_queue.record = info_list[:3]
     @parameterized.expand(
-        [("zero_space",info_list,{'space':0,'rtor':None,'rtor_iter':None,'exitcode':None,'output':None},False),
-         ("neg_space",info_list,{'space':-10,'rtor':None,'rtor_iter':None,'exitcode':None,'output':None},False),
-         ("none_iter",info_list,{'space':10,'rtor':None,'rtor_iter':None,'exitcode':None,'output':None},True),
-         ("delete_1",info_list,{'space':10,'rtor':None,'rtor_iter':iter(info_list),'exitcode':None,'output':None},True),
-         ("delete_2",info_list,{'space':1,'rtor':None,'rtor_iter':iter(info_list),'exitcode':None,'output':None},True),
-         ("delete_delete",info_list,{'space':6,'rtor':rtor_elem,'rtor_iter':iter(info_list),'exitcode':0,'output':None},True),
-         ("delete_nodelete",info_list,{'space':5,'rtor':rtor_elem,'rtor_iter':iter(info_list),'exitcode':0,'output':None},False),
-         ("nodelete_delete",info_list,{'space':5,'rtor':rtor_elem,'rtor_iter':iter(info_list),'exitcode':1,'output':None},True)
-#         ("invalid_delete",[rtor_delete_invalid]+info_list,{'space':60,'rtor':rtor_elem,'rtor_iter':iter([rtor_delete_invalid]+info_list),'exitcode':0,'output':None},False)
-         ])
-    def delete_test(self,_,control,func_args,call_flag): #rtor,rtor_iter,output,exitcode,call_flag):
-        # setup expected arguments
-        rtor_iter_ = iter(control)
-        rtor_ = rtor_iter_.next()
-        command_ = self.seedbox._Seedbox__delete_command %(rtor_.name)
-        func_ = self.seedbox.delete
-        space_ = func_args['space']
-        if func_args['rtor'] and func_args['exitcode'] == 0:
-            space_ -= func_args['rtor'].size
-        args_ = {'rtor':rtor_,'space':space_}
+       [("zero_space",{'space':0},None),
+        ("neg_space",{'space':-10},None),
+        ("none_iter",{'space':10},info_list[:2]),
+        ("exact",{'space':25,'rtor_iter':iter(info_list)},info_list[:2]),
+        ("all",{'space':1000,'rtor_iter':iter(info_list)},info_list),
+        ("invalid",{'space':30,'rtor_iter':iter([rtor_gen(name='invalid',state='Seeding',size=1)]+info_list)},info_list[:3]),
+        ("empty_iter",{'space':10,'rtor_iter':iter([])},None)]
+       )
+    def plan_test(self,_,func_args,victims):
         self.seedbox.delete(**func_args)
-        if call_flag:
-            self.seedbox.shell.add_ssh.assert_called_once()
-            call_args,call_kwargs = self.seedbox.shell.add_ssh.call_args
-            command,func,args = call_args
-            rtor_iter = args.pop('rtor_iter')
-            # check arguments are the same
-            self.assertEqual(command,command_)
-            self.assertEqual(func,func_)
-            self.assertEqual(args,args_)
-            # check that iterators are the same
-            for rtor,rtor_ in zip(rtor_iter,rtor_iter_):
-                self.assertEqual(rtor,rtor_)
+        if victims:
+            self.seedbox.backend.add_delete.assert_called_once()
+            rtors,func,args = self.seedbox.backend.add_delete.call_args[0]
+            self.assertEqual(rtors,victims)
+            self.assertEqual(func,self.seedbox.delete)
+            self.assertEqual(args['victims'],victims)
+            self.assertEqual(args['space'],func_args['space'])
         else:
-            self.assertEqual(self.seedbox.shell.add_ssh.called,False)
+            self.assertEqual(self.seedbox.backend.add_delete.called,False)
     @parameterized.expand(
-       [("zero_space",down_list,None,{'space':0,'rtor':None,'rtor_iter':None,'exitcode':None,'output':None},False),
-        ("neg_space",down_list,None,{'space':-10,'rtor':None,'rtor_iter':None,'exitcode':None,'output':None},False),
-        ("none_iter",down_list,down_list[0],{'space':10,'rtor':None,'rtor_iter':None,'exitcode':None,'output':None},True),
-        ("download_1",down_list,down_list[0],{'space':10,'rtor':None,'rtor_iter':iter(down_list),'exitcode':None,'output':None},True),
-        ("download_2",down_list,None,{'space':1,'rtor':None,'rtor_iter':iter(down_list),'exitcode':None,'output':None},False),
-        ("download_3",down_list,down_list[1],{'space':9,'rtor':None,'rtor_iter':iter(down_list),'exitcode':None,'output':None},True),
-        ("download_4",down_list,down_list[2],{'space':8,'rtor':None,'rtor_iter':iter(down_list),'exitcode':None,'output':None},True),
-        ("download_5",down_list,down_list[4],{'space':6,'rtor':None,'rtor_iter':iter(down_list),'exitcode':None,'output':None},True),
-        ("download_download",down_list,down_list[1],{'space':14,'rtor':rtor_elem,'rtor_iter':iter(down_list),'exitcode':0,'output':None},True),
-        ("download_nodownload",down_list,None,{'space':7,'rtor':rtor_elem,'rtor_iter':iter(down_list),'exitcode':0,'output':None},False),
-        ("nodownload_download",down_list,down_list[3],{'space':7,'rtor':rtor_elem,'rtor_iter':iter(down_list),'exitcode':1,'output':None},True)
-#        ("nodownload_valid",
-        ])
-    def download_test(self,_,control,rtor_control,func_args,call_flag):
-        rtor_iter_ = iter(control)
-        rtor_ = rtor_iter_.next()
-        while rtor_control and rtor_ != rtor_control:
-            rtor_ = rtor_iter_.next()
-        download_path = self.seedbox._Seedbox__check_download_path(rtor_)
-        command_ = self.seedbox._Seedbox__download_command %(self.seedbox.path_remote_data,download_path)
-        func_ = self.seedbox.download
-        space_ = func_args['space']
-        if func_args['rtor'] and func_args['exitcode'] == 0:
-            space_ -= func_args['rtor'].size
-        args_ = {'rtor':rtor_,'space':space_}
-        self.seedbox.download(**func_args)
-        if call_flag:
-            self.seedbox.shell.add_shell.assert_called_once()
-            call_args,call_kwargs = self.seedbox.shell.add_shell.call_args
-            command,func,args = call_args
-            rtor_iter = args.pop('rtor_iter')
-            self.assertEqual(command,command_)
-            self.assertEqual(func,func_)
-            self.assertEqual(args,args_)
-            for rtor,rtor_ in zip(rtor_iter,rtor_iter_):
-                self.assertEqual(rtor,rtor_)
+       [("all_deleted",25,[True,True],None,2),
+        ("one_failed",24,[True,False],[info_list[2]],1),
+        ("none_deleted",5,[False,False],[info_list[2]],0),
+        ("no_output",5,None,[info_list[2]],0)]
+       )
+    def result_test(self,_,space,deleted,victims,removed):
+        planned = info_list[:2]
+        output = dict((rtor.info_hash,flag) for rtor,flag in zip(planned,deleted)) if deleted else None
+        self.seedbox.delete(space,rtor_iter=iter(info_list[2:]),victims=planned,exitcode=0,output=output)
+        freed = sum(rtor.size for rtor,flag in zip(planned,deleted or [False]*2) if flag)
+        if victims:
+            rtors,func,args = self.seedbox.backend.add_delete.call_args[0]
+            self.assertEqual(rtors,victims)
+            self.assertEqual(args['space'],space - freed)
         else:
-            self.assertEqual(self.seedbox.shell.add_shell.called,False)
-
-# have yet to write this function
-#    def enqueue_test(self):
-#        pass
-# trivial method - shouldn't need testing
-#    def update_test(self):
-#        pass
-
-    @parameterized.expand(
-       [("zero_space",up_list,None,{'space':0,'ltor':None,'ltor_iter':None,'exitcode':None,'output':None},False),
-        ("neg_space",up_list,None,{'space':-10,'ltor':None,'ltor_iter':None,'exitcode':None,'output':None},False),
-        ("none_iter",up_list,up_list[0],{'space':10,'ltor':None,'ltor_iter':None,'exitcode':None,'output':None},True),
-        ("upload_1",up_list,up_list[0],{'space':10,'ltor':None,'ltor_iter':iter(up_list),'exitcode':None,'output':None},True),
-        ("upload_2",up_list,None,{'space':1,'ltor':None,'ltor_iter':iter(up_list),'exitcode':None,'output':None},False),
-        ("upload_3",up_list,up_list[1],{'space':9,'ltor':None,'ltor_iter':iter(up_list),'exitcode':None,'output':None},True),
-        ("upload_4",up_list,up_list[2],{'space':8,'ltor':None,'ltor_iter':iter(up_list),'exitcode':None,'output':None},True),
-        ("upload_5",up_list,up_list[4],{'space':6,'ltor':None,'ltor_iter':iter(up_list),'exitcode':None,'output':None},True),
-        ("upload_upload",up_list,up_list[1],{'space':14,'ltor':ltor_elem,'ltor_iter':iter(up_list),'exitcode':0,'output':None},True),
-        ("upload_upload",up_list,None,{'space':7,'ltor':ltor_elem,'ltor_iter':iter(up_list),'exitcode':0,'output':None},False),
-        ("noupload_upload",up_list,up_list[3],{'space':7,'ltor':ltor_elem,'ltor_iter':iter(up_list),'exitcode':1,'output':None},True)])
-    def upload_test(self,_,control,ltor_control,func_args,call_flag):
-        ltor_iter_ = iter(control)
-        ltor_ = ltor_iter_.next()
-        while ltor_control and ltor_ != ltor_control:
-            ltor_ = ltor_iter_.next()
-        command_ = self.seedbox._Seedbox__upload_command %(ltor_.path,self.seedbox.path_remote_torrent)
-        func_ = self.seedbox.upload
-        space_ = func_args['space']
-        if func_args['ltor'] and func_args['exitcode'] == 0:
-            space_ -= func_args['ltor'].size
-        args_ = {'ltor':ltor_,'space':space_}
-        self.seedbox.upload(**func_args)
-        if call_flag:
-            self.seedbox.shell.add_shell.assert_called_once()
-            call_args,call_kwargs = self.seedbox.shell.add_shell.call_args
-            command,func,args = call_args
-            ltor_iter = args.pop('ltor_iter')
-            self.assertEqual(command,command_)
-            self.assertEqual(func,func_)
-            self.assertEqual(args,args_)
-            for ltor,ltor_ in zip(ltor_iter,ltor_iter_):
-                self.assertEqual(ltor,ltor_)
-        else:
-            self.assertEqual(self.seedbox.shell.add_shell.called,False)
+            self.assertEqual(self.seedbox.backend.add_delete.called,False)
+        self.assertEqual(len(self.seedbox.down_queue),3 - removed)
 
+class SeedboxTransferTest(SeedboxTest):
+    # the queued transfers, as (item,callback,args)
+    def queued(self,key):
+        return [(args[key],func,args) for (command,func,args),kwargs in self.seedbox.shell.add_shell.call_args_list]
+    def complete(self,key,name,exitcode):
+        for item,func,args in self.queued(key):
+            if item.name == name:
+                func(exitcode=exitcode,output="",**dict((k,v) for k,v in args.items() if k not in ('exitcode','output')))
+                return
+        self.fail("not queued: %s" %(name))
+    @parameterized.expand([
+        ("zero_space",0,[]),
+        ("one",10,['10']),
+        ("streams",20,['10','9']),
+        ("skip",8,['8']),
+        ])
+    def upload_test(self,_,space,names):
+        self.seedbox.upload(space)
+        self.assertEqual([ltor.name for ltor,func,args in self.queued('ltor')],names)
+        for (command,func,args),kwargs in self.seedbox.shell.add_shell.call_args_list:
+            self.assertEqual(command[-2:],[args['ltor'].path,self.seedbox.path_remote_torrent])
+            self.assertEqual(command[:-2],["rsync","-n"])
+    def upload_reserve_test(self):
+        self.seedbox.upload(20)
+        # 10 and 9 in flight: 1 left; a failure gives its space back for the next ones
+        self.complete('ltor','9',1)
+        self.assertEqual([ltor.name for ltor,func,args in self.queued('ltor')],['10','9','8'])
+        self.complete('ltor','10',0)
+        self.assertEqual([ltor.name for ltor in self.seedbox.up_queue],['9','8','7','6'])
+        self.assertEqual(self.seedbox.down_queue.pending.keys(),[up_list[0].info_hash])
+        self.complete('ltor','8',0)
+        # nothing else fits in the space left
+        self.assertEqual(len(self.queued('ltor')),3)
+        self.assertEqual(self.queued('ltor')[0][2]['batch']['space'],2)
+    def upload_skipped_test(self):
+        self.seedbox.upload(20)
+        # 8, 7 and 6 do not fit while 10 and 9 are in flight; they do once 9 fails
+        self.complete('ltor','10',0)
+        self.assertEqual(len(self.queued('ltor')),2)
+        self.complete('ltor','9',1)
+        self.assertEqual([ltor.name for ltor,func,args in self.queued('ltor')],['10','9','8'])
+    @parameterized.expand([
+        ("zero_space",0,[]),
+        ("streams",20,['10','9']),
+        ("skip",7,['7'])
+        ])
+    def download_test(self,_,space,names):
+        self.seedbox.download(space)
+        self.assertEqual([rtor.name for rtor,func,args in self.queued('rtor')],names)
+    def download_reserve_test(self):
+        self.seedbox.download(20)
+        self.complete('rtor','10',0)
+        self.assertEqual([rtor.name for rtor,func,args in self.queued('rtor')],['10','9'])
+        self.complete('rtor','9',1)
+        self.assertEqual([rtor.name for rtor,func,args in self.queued('rtor')],['10','9','8'])
+        self.assertEqual([rtor.name for rtor in self.seedbox.down_queue],['9','8','7','6'])
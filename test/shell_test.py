@@ -0,0 +1,461 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import MagicMock,patch
+import socket
+import threading
+import subprocess
+
+from churada.pool import ConnectionPool,ConnectionPoolError
+from churada.shell import Shell,ChannelReader
+from churada.engine import Engine
+
+class FakeChannel(object):
+    """
+    A session channel playing a script of events, one per select (see ShellTestCase)
+     - events: ('out',data), ('err',data), ('wait',) or ('eof',), which may carry
+      the last output as ('eof',data)
+     - exitcode: the exit status, once the eof is received
+     - script: if given, exec_command gets the events of the command from it
+     - meeting: if given, a threading.Event the eof also waits for (up to 5s);
+      the exit status is 1 if it never came
+    """
+    def __init__(self,events=(),exitcode=0,script=None,meeting=None):
+        self.events = list(events)
+        self.exitcode = exitcode
+        self.script = script
+        self.meeting = meeting
+        self.command = None
+        self.out = ""
+        self.err = ""
+        self.eof = False
+        self.closed = False
+        self.reads = []
+    def exec_command(self,command):
+        self.command = command
+        self.events = list(self.script(command))
+    def tick(self):
+        if self.events:
+            event = self.events.pop(0)
+            if event[0] == 'out':
+                self.out += event[1]
+            elif event[0] == 'err':
+                self.err += event[1]
+            elif event[0] == 'eof':
+                self.out += "".join(event[1:])
+                self.eof = True
+    # plays the whole script at once: the command is done
+    def play(self):
+        while self.events:
+            self.tick()
+    @property
+    def eof_received(self):
+        return self.eof and (self.meeting is None or self.meeting.wait(5))
+    def recv_ready(self):
+        return bool(self.out)
+    def recv(self,size):
+        self.reads.append(size)
+        data,self.out = self.out[:size],self.out[size:]
+        return data
+    def recv_stderr_ready(self):
+        return bool(self.err)
+    def recv_stderr(self,size):
+        data,self.err = self.err[:size],self.err[size:]
+        return data
+    def recv_exit_status(self):
+        assert self.eof
+        if self.meeting is not None and not self.meeting.is_set():
+            return 1
+        return self.exitcode
+    def close(self):
+        self.closed = True
+
+class ShellTestCase(unittest.TestCase):
+    """
+    A Shell on a mocked connection whose channels are FakeChannels
+     - shell_args: keyword arguments of the Shell
+     - meeting: passed to every channel (see FakeChannel)
+
+    script(command) gives the events of each command; started lists the commands
+     in the order they were run. Each select ticks the channels it waits on; a
+     command run by client.exec_command has played its script when it returns.
+    """
+    shell_args = {}
+    meeting = None
+    def setUp(self):
+        self.started = []
+        self.channels = []
+        self.log = []
+        self.threads = set()
+        self.selects = 0
+        self.client = MagicMock()
+        self.client.exec_command.side_effect = self.exec_command
+        self.client.get_transport.return_value.open_session.side_effect = self.open_session
+        self.pool = ConnectionPool(connect=MagicMock(return_value=self.client))
+        self.shell = Shell('user','host',pool=self.pool,**self.shell_args)
+        select = patch('select.select',side_effect=self.select_gen)
+        select.start()
+        self.addCleanup(select.stop)
+    def select_gen(self,rlist,wlist,xlist,timeout):
+        self.selects += 1
+        for channel in rlist:
+            channel.tick()
+        return rlist,[],[]
+    def script(self,command):
+        return [('out',command),('eof',)]
+    def start(self,command):
+        self.started.append(command)
+        return self.script(command)
+    def open_session(self):
+        self.channels.append(FakeChannel(script=self.start,meeting=self.meeting))
+        return self.channels[-1]
+    def exec_command(self,command):
+        channel = self.open_session()
+        channel.exec_command(command)
+        channel.play()
+        stdout = MagicMock()
+        stdout.channel = channel
+        return MagicMock(),stdout,MagicMock()
+    def func(self,name,exitcode,output):
+        self.log.append((name,exitcode,output))
+        self.threads.add(threading.current_thread())
+    def queue(self,name,command,**kwargs):
+        self.shell.add_ssh(command,self.func,{'name':name},**kwargs)
+
+class ChannelReaderTest(ShellTestCase):
+    @parameterized.expand([
+        ("empty",[('eof',)],""),
+        ("chunks",[('out',"ab"),('out',"cd"),('eof',)],"abcd"),
+        ("large",[('out',"x"*200000),('eof',)],"x"*200000),
+        ("stderr",[('err',"warning\n"*20000),('out',"ok"),('eof',)],"ok")
+        ])
+    def read_test(self,_,events,control):
+        channel = FakeChannel(events,exitcode=3)
+        reader = ChannelReader(channel)
+        self.assertEqual(reader.read(),(3,control))
+        # one wait per event: no polling in between
+        self.assertEqual(self.selects,len(events))
+        self.assertTrue(all(size >= 65536 for size in channel.reads))
+        self.assertEqual(len(reader.errors),sum(len(event[1]) for event in events if event[0] == 'err'))
+    def stream_test(self):
+        chunks = []
+        reader = ChannelReader(FakeChannel([('out',"ab"),('out',"x"*70000),('eof',)]),stream=chunks.append)
+        self.assertEqual(reader.read(),(0,"ab"+"x"*70000))
+        self.assertEqual(chunks,["ab","x"*65536,"x"*(70000-65536)])
+    def drain_test(self):
+        channel = FakeChannel([('out',"ab"),('eof',)])
+        reader = ChannelReader(channel)
+        self.assertFalse(reader.drain())
+        channel.tick()
+        self.assertFalse(reader.drain())
+        self.assertEqual((reader.output,reader.exitcode),("ab",None))
+        channel.tick()
+        self.assertTrue(reader.drain())
+        self.assertEqual(reader.exitcode,0)
+
+class ShellMultiplexTest(ShellTestCase):
+    shell_args = {'channels':3}
+    # "name ticks": ends after ticks selects, with output name-out
+    def script(self,command):
+        name,ticks = command.split()
+        self.log.append(('start',name))
+        return [('wait',)]*(int(ticks) - 1) + [('eof',name+"-out")]
+    def func(self,name,exitcode,output):
+        self.log.append(('done',name,exitcode,output))
+    def queue(self,name,ticks,**kwargs):
+        ShellTestCase.queue(self,name,"%s %d" %(name,ticks),**kwargs)
+    def stream_test(self):
+        chunks = []
+        self.shell.add_ssh("a 2",self.func,{'name':'a'},stream=chunks.append)
+        self.shell.do_ssh()
+        self.assertEqual(chunks,['a-out'])
+        self.assertEqual(self.log[-1],('done','a',0,'a-out'))
+    def concurrent_test(self):
+        for name,ticks in [('a',5),('b',1),('c',3),('d',1)]:
+            self.queue(name,ticks)
+        self.shell.do_ssh()
+        self.assertEqual(self.log,[('start','a'),('start','b'),('start','c'),
+                                   ('done','b',0,'b-out'),('start','d'),
+                                   ('done','d',0,'d-out'),('done','c',0,'c-out'),('done','a',0,'a-out')])
+        # bounded by the slowest command, not by the sum
+        self.assertEqual(self.selects,5)
+        self.assertTrue(all(channel.closed for channel in self.channels))
+        self.assertEqual(self.pool.stats()['user@host']['commands'],4)
+        self.assertEqual(self.shell.ssh_queue,[])
+    def chain_test(self):
+        self.queue('a',3,chain='x')
+        self.queue('b',1,chain='x')
+        self.queue('c',1)
+        self.shell.do_ssh()
+        self.assertEqual([entry[1] for entry in self.log],['a','c','c','a','b','b'])
+        self.assertEqual(self.selects,4)
+    def chained_callback_test(self):
+        def again(name,exitcode,output):
+            self.func(name,exitcode,output)
+            if name == 'a':
+                self.queue('a2',1,chain='x')
+        self.shell.add_ssh("a 2",again,{'name':'a'},chain='x')
+        self.queue('b',1,chain='x')
+        self.shell.do_ssh()
+        self.assertEqual([entry[:2] for entry in self.log],
+                         [('start','a'),('done','a'),('start','b'),('done','b'),('start','a2'),('done','a2')])
+    def callable_test(self):
+        command = MagicMock(return_value=(0,"rpc"))
+        self.queue('a',3)
+        self.shell.add_ssh(command,self.func,{'name':'rpc'})
+        self.queue('b',1)
+        self.shell.do_ssh()
+        command.assert_called_once_with(self.client)
+        self.assertEqual([entry[:2] for entry in self.log],
+                         [('start','a'),('done','rpc'),('start','b'),('done','b'),('done','a')])
+    def open_error_test(self):
+        self.queue('a',3)
+        self.queue('b',1)
+        self.client.get_transport.return_value.open_session.side_effect = [self.open_session(),socket.error("reset")]
+        self.shell.do_ssh()
+        # the connection is gone: the running command is answered with None as well
+        self.assertEqual(sorted(entry for entry in self.log if entry[0] == 'done'),
+                         [('done','a',None,None),('done','b',None,None)])
+        self.assertEqual(len(self.pool),0)
+    def raise_test(self):
+        def fail(name,exitcode,output):
+            raise ValueError(name)
+        self.queue('a',3)
+        self.shell.add_ssh("b 1",fail,{'name':'b'})
+        self.assertRaises(ValueError,self.shell.do_ssh)
+        # the running command is not left open, and the next flush runs
+        self.assertTrue(all(channel.closed for channel in self.channels))
+        self.assertEqual(self.shell.ssh_queue,[])
+        self.queue('c',1)
+        self.shell.do_ssh()
+        self.assertEqual(self.log[-1],('done','c',0,'c-out'))
+
+class ShellEngineTest(ShellTestCase):
+    shell_args = {'channels':3}
+    def setUp(self):
+        # commands end once count of them have started, or fail after 5s
+        self.meeting = threading.Event()
+        ShellTestCase.setUp(self)
+        self.engine = Engine(workers=4)
+        self.addCleanup(self.engine.close)
+    def script(self,command):
+        if len(self.started) >= self.count:
+            self.meeting.set()
+        return [('out',command+"-out"),('eof',)]
+    def run_ssh_test(self):
+        self.count = 1
+        self.assertEqual(self.engine.wait(self.shell.run_ssh(self.engine,"a")),(0,"a-out"))
+        self.assertEqual(self.pool.stats()['user@host']['commands'],1)
+    def run_local_test(self):
+        self.assertEqual(self.engine.wait(self.shell.run_local(self.engine,["echo","hi"])),(0,"hi\n"))
+        self.assertEqual(self.engine.wait(self.shell.run_local(self.engine,["false"]))[0],1)
+    def flush_ssh_test(self):
+        # the three commands only succeed if they run at once
+        self.count = 3
+        for name in ('a','b','c'):
+            self.shell.add_ssh(name,self.func,{'name':name})
+        self.engine.wait(self.shell.flush_ssh(self.engine))
+        self.assertEqual(sorted(self.log),[('a',0,'a-out'),('b',0,'b-out'),('c',0,'c-out')])
+        self.assertEqual(self.threads,set([threading.current_thread()]))
+        self.assertEqual(self.shell.ssh_queue,[])
+    def flush_chain_test(self):
+        self.count = 1
+        def chain(name,exitcode,output):
+            self.func(name,exitcode,output)
+            if name == 'a':
+                self.shell.add_ssh("a2",chain,{'name':'a2'},chain='x')
+        self.shell.add_ssh("a",chain,{'name':'a'},chain='x')
+        self.shell.add_ssh("b",chain,{'name':'b'},chain='x')
+        self.shell.add_ssh(MagicMock(return_value=(0,"rpc")),self.func,{'name':'rpc'})
+        self.engine.wait(self.shell.flush_ssh(self.engine))
+        self.assertEqual([name for name in self.started],['a','b','a2'])
+        self.assertEqual(sorted(self.log),
+                         [('a',0,'a-out'),('a2',0,'a2-out'),('b',0,'b-out'),('rpc',0,'rpc')])
+    def flush_error_test(self):
+        self.pool.connect.side_effect = ConnectionPoolError("down")
+        self.shell.add_ssh("a",self.func,{'name':'a'})
+        self.engine.wait(self.shell.flush_ssh(self.engine))
+        self.assertEqual(self.log,[('a',None,None)])
+    def flush_shell_test(self):
+        def upload(name,exitcode,output):
+            self.func(name,exitcode,output)
+            if name == 'a':
+                self.shell.add_shell(["echo","b"],upload,{'name':'b'})
+        self.shell.add_shell(["echo","a"],upload,{'name':'a'})
+        self.engine.wait(self.shell.flush_shell(self.engine))
+        self.assertEqual(self.log,[('a',0,"a\n"),('b',0,"b\n")])
+        self.assertEqual(self.shell.shell_queue,[])
+    def flush_raise_test(self):
+        self.count = 1
+        def fail(name,exitcode,output):
+            raise ValueError(name)
+        self.shell.add_ssh("a",fail,{'name':'a'},chain='x')
+        self.shell.add_ssh("b",self.func,{'name':'b'},chain='x',idempotent=True)
+        self.assertRaises(ValueError,lambda: self.engine.wait(self.shell.flush_ssh(self.engine)))
+        self.assertEqual(self.shell.ssh_queue,[])
+        # the dropped read takes no more funcs, and the next flush runs
+        self.shell.add_ssh("b",self.func,{'name':'c'},idempotent=True)
+        self.assertEqual(len(self.shell.ssh_queue),1)
+        self.engine.wait(self.shell.flush_ssh(self.engine))
+        self.assertEqual(self.log,[('c',0,'b-out')])
+    def flush_empty_test(self):
+        self.assertTrue(self.shell.flush_ssh(self.engine).done())
+
+class ShellCoalesceTest(ShellTestCase):
+    shell_args = {'cache_ttl':60}
+    # the output tells which run of the command it came from
+    def script(self,command):
+        return [('out',"%s-%d" %(command,len(self.started))),('eof',)]
+    def coalesce_test(self):
+        self.queue('a',"du",idempotent=True)
+        self.queue('b',"info",idempotent=True)
+        self.queue('c',"du",idempotent=True)
+        self.assertEqual(len(self.shell.ssh_queue),2)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["du","info"])
+        self.assertEqual(self.log,[('a',0,"du-1"),('c',0,"du-1"),('b',0,"info-2")])
+    def mutating_test(self):
+        self.queue('a',"rm x")
+        self.queue('b',"rm x")
+        self.queue('c',"du",idempotent=True)
+        self.queue('d',"rm y")
+        # a read queued after a mutation is not merged with one queued before it
+        self.queue('e',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["rm x","rm x","du","rm y","du"])
+        self.assertEqual([entry[2] for entry in self.log],["rm x-1","rm x-2","du-3","rm y-4","du-5"])
+    def cache_test(self):
+        self.queue('a',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.queue('b',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["du"])
+        self.assertEqual(self.log,[('a',0,"du-1"),('b',0,"du-1")])
+        # expired
+        with patch('time.time',return_value=1e12):
+            self.queue('c',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.log[-1],('c',0,"du-2"))
+    def cache_invalidate_test(self):
+        self.queue('a',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.queue('b',"rm x")
+        self.queue('c',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["du","rm x","du"])
+    def no_stale_cache_test(self):
+        # a read that was queued before a mutation is not cached
+        def mutate(name,exitcode,output):
+            self.func(name,exitcode,output)
+            self.queue('m',"rm x")
+        self.queue('a',"du",idempotent=True)
+        self.shell.add_ssh("info",mutate,{'name':'b'},idempotent=True)
+        self.shell.do_ssh()
+        self.queue('c',"info",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["du","info","rm x","info"])
+    def error_not_cached_test(self):
+        self.pool.connect.side_effect = ConnectionPoolError("down")
+        self.queue('a',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.pool.connect.side_effect = None
+        self.queue('b',"du",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.log,[('a',None,None),('b',0,"du-1")])
+    def queued_by_func_test(self):
+        # a func may queue a read identical to one not started yet: it joins it
+        def again(name,exitcode,output):
+            self.func(name,exitcode,output)
+            if name == 'a':
+                self.queue('b',"info",idempotent=True)
+        self.shell.add_ssh("du",again,{'name':'a'},idempotent=True)
+        self.queue('c',"info",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["du","info"])
+        self.assertEqual(self.log,[('a',0,"du-1"),('c',0,"info-2"),('b',0,"info-2")])
+    def started_test(self):
+        # an identical read queued once the first has started runs again
+        self.shell.cache_ttl = 0
+        def again(name,exitcode,output):
+            self.func(name,exitcode,output)
+            if name == 'a':
+                self.queue('b',"info",idempotent=True)
+        self.queue('c',"info",idempotent=True)
+        self.shell.add_ssh("du",again,{'name':'a'},idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["info","du","info"])
+        self.assertEqual(self.log,[('c',0,"info-1"),('a',0,"du-2"),('b',0,"info-3")])
+    def raise_test(self):
+        def fail(name,exitcode,output):
+            raise ValueError(name)
+        self.shell.add_ssh("du",fail,{'name':'a'},idempotent=True)
+        self.queue('b',"info",idempotent=True)
+        self.assertRaises(ValueError,self.shell.do_ssh)
+        # the dropped read takes no more funcs, and the next flush runs
+        self.queue('c',"info",idempotent=True)
+        self.assertEqual(len(self.shell.ssh_queue),1)
+        self.shell.do_ssh()
+        self.assertEqual(self.log,[('c',0,"info-2")])
+    def shell_raise_test(self):
+        def fail(exitcode,output):
+            raise ValueError(output)
+        self.shell.add_shell(["echo","a"],fail,{})
+        self.shell.add_shell(["echo","b"],self.func,{'name':'b'})
+        self.assertRaises(ValueError,self.shell.do_shell)
+        self.assertEqual(self.shell.shell_queue,[])
+        self.shell.add_shell(["echo","c"],self.func,{'name':'c'})
+        self.shell.do_shell()
+        self.assertEqual(self.log,[('c',0,"c\n")])
+    def callable_test(self):
+        command = MagicMock(return_value=(0,"rpc"))
+        self.queue('a',command,idempotent=True)
+        self.queue('b',command,idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(command.call_count,2)
+
+class ShellBundleTest(ShellTestCase):
+    shell_args = {'bundle':True}
+    # runs the command here, as the remote shell would
+    def script(self,command):
+        return [('eof',subprocess.Popen(command,shell=True,stdout=subprocess.PIPE).communicate()[0])]
+    def bundle_test(self):
+        self.queue('a',"echo a",idempotent=True)
+        self.queue('b',"printf 'x\ny'",idempotent=True)
+        self.queue('c',"echo c; exit 3",idempotent=True)
+        self.queue('d',"echo a",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(len(self.started),1)
+        self.assertEqual(self.log,[('a',0,"a\n"),('d',0,"a\n"),('b',0,"x\ny"),('c',3,"c\n")])
+    def mutating_test(self):
+        self.queue('a',"echo a",idempotent=True)
+        self.queue('b',"echo b",idempotent=True)
+        self.queue('c',"true")
+        self.queue('d',"echo d",idempotent=True)
+        self.queue('e',"echo e",idempotent=True)
+        self.queue('f',"echo f",chain='f')
+        self.queue('g',"echo g",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(len(self.started),5)
+        self.assertEqual(self.started[1],"true")
+        self.assertEqual(self.started[3:],["echo f","echo g"])
+        self.assertEqual(self.log,[('a',0,"a\n"),('b',0,"b\n"),('c',0,""),('d',0,"d\n"),
+                                   ('e',0,"e\n"),('f',0,"f\n"),('g',0,"g\n")])
+    def single_test(self):
+        self.queue('a',"echo a",idempotent=True)
+        self.shell.do_ssh()
+        self.assertEqual(self.started,["echo a"])
+    def engine_test(self):
+        engine = Engine(workers=2)
+        self.queue('a',"echo a",idempotent=True)
+        self.queue('b',"echo b",idempotent=True)
+        engine.wait(self.shell.flush_ssh(engine))
+        engine.close()
+        self.assertEqual(len(self.started),1)
+        self.assertEqual(self.log,[('a',0,"a\n"),('b',0,"b\n")])
+    @parameterized.expand([
+        ("truncated","#churada 0 0 2\na\n#churada 1 0 5\nb\n",[(0,"a\n"),(None,None)]),
+        ("garbled","#churada 0 0 2\na\nnoise\n",[(0,"a\n"),(None,None)]),
+        ("empty","",[(None,None),(None,None)]),
+        ("out_of_order","#churada 1 0 2\nb\n#churada 0 1 0\n",[(1,""),(0,"b\n")]),
+        ])
+    def unbundle_test(self,_,output,control):
+        self.assertEqual(Shell.unbundle(output,2),control)
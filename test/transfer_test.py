@@ -0,0 +1,117 @@
+import unittest
+from nose_parameterized import parameterized
+from mock import MagicMock,patch
+
+from churada.transfer import TransferPool,TransferPoolError
+from churada.engine import Engine
+from churada.shell import Shell
+
+class FakeProcess(object):
+    """ a process that exits when communicate() is called """
+    def __init__(self,log,command):
+        self.log = log
+        self.command = command
+        self.returncode = None
+        self.log.append(('start',command[0]))
+    def communicate(self):
+        self.log.append(('exit',self.command[0]))
+        self.returncode = 0
+        return self.command[0]+"-out",None
+
+class TransferPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = TransferPool(limit=3,owner_limit=2)
+        self.log = []
+    def func(self,name,exitcode,output):
+        self.log.append((name,exitcode,output))
+    @parameterized.expand([
+        ("all",None,['a1','a2','b1']),
+        ("owner",'a',['a1','a2'])
+        ])
+    def run_test(self,_,owner,control):
+        for name in ('a1','a2'):
+            self.pool.add('a',["echo",name],self.func,{'name':name})
+        self.pool.add('b',["sh","-c","sleep 0.2; echo b1"],self.func,{'name':'b1'})
+        self.pool.run(owner)
+        self.assertEqual(sorted(name for name,exitcode,output in self.log),control)
+        self.assertTrue(all(output == name+"\n" and exitcode == 0 for name,exitcode,output in self.log))
+        self.assertEqual(self.pool.busy('a'),False)
+    def concurrent_test(self):
+        # b1 waits for a1: they only both end if they run at once
+        fifo = "/tmp/churada_transfer_test_%d" %(id(self))
+        self.pool.add('a',["sh","-c","rm -f %s; mkfifo %s; echo a1 > %s" %(fifo,fifo,fifo)],self.func,{'name':'a1'})
+        self.pool.add('b',["sh","-c","while [ ! -p %s ]; do sleep 0.01; done; cat %s; rm %s" %(fifo,fifo,fifo)],self.func,{'name':'b1'})
+        self.pool.run()
+        self.assertEqual(sorted(self.log),[('a1',0,""),('b1',0,"a1\n")])
+    def callback_test(self):
+        def again(name,exitcode,output):
+            self.func(name,exitcode,output)
+            if name == 'a1':
+                self.pool.add('a',["echo","a2"],self.func,{'name':'a2'})
+        self.pool.add('a',["echo","a1"],again,{'name':'a1'})
+        self.pool.run('a')
+        self.assertEqual(self.log,[('a1',0,"a1\n"),('a2',0,"a2\n")])
+    def start_error_test(self):
+        self.pool.add('a',["/nonexistent/command"],self.func,{'name':'a1'})
+        self.pool.run()
+        self.assertEqual(self.log,[('a1',None,None)])
+        self.assertEqual(len(self.pool),0)
+    def fair_test(self):
+        engine = Engine(workers=1)
+        starts = []
+        running = {'a':0,'b':0,'all':[0]}
+        with patch('subprocess.Popen',side_effect=lambda command,stdout: FakeProcess(starts,command)):
+            for i in range(0,6):
+                self.pool.add('a',['a%d' %(i)],self.func,{'name':'a%d' %(i)})
+            for i in range(0,2):
+                self.pool.add('b',['b%d' %(i)],self.func,{'name':'b%d' %(i)})
+            engine.wait(self.pool.run_async(engine,'b'))
+            self.assertTrue(self.pool.busy('a'))
+            engine.wait(self.pool.run_async(engine,'a'))
+        engine.close()
+        started = [name for event,name in starts if event == 'start']
+        # turns alternate between owners while both have work
+        self.assertEqual(started[:4],['a0','b0','a1','b1'])
+        self.assertEqual(sorted(started),['a%d' %(i) for i in range(0,6)]+['b0','b1'])
+        active = {}
+        for event,name in starts:
+            active[name[0]] = active.get(name[0],0) + (1 if event == 'start' else -1)
+            self.assertTrue(active[name[0]] <= 2)
+            self.assertTrue(sum(active.values()) <= 3)
+        self.assertEqual(len(self.log),8)
+    def mixed_test(self):
+        engine = Engine(workers=1)
+        with patch('subprocess.Popen',side_effect=lambda command,stdout: FakeProcess([],command)):
+            self.pool.add('a',['a1'],self.func,{'name':'a1'})
+            task = self.pool.run_async(engine,'a')
+            self.assertRaises(TransferPoolError,self.pool.run)
+            engine.wait(task)
+        engine.close()
+        self.assertEqual(self.log,[('a1',0,'a1-out')])
+
+    def tearDown(self):
+        # transfers of other owners are still running after run(owner)
+        self.pool.run()
+
+class ShellTransferTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = TransferPool(limit=2,owner_limit=2)
+        self.shell = Shell(transfers=self.pool)
+        self.log = []
+    def upload(self,name,exitcode,output):
+        self.log.append((name,exitcode,output))
+        if name == 'a':
+            self.shell.add_shell(["echo","c"],self.upload,{'name':'c'})
+    def do_shell_test(self):
+        self.shell.add_shell(["echo","a"],self.upload,{'name':'a'})
+        self.shell.add_shell(["echo","b"],self.upload,{'name':'b'})
+        self.shell.do_shell()
+        self.assertEqual(sorted(self.log),[('a',0,"a\n"),('b',0,"b\n"),('c',0,"c\n")])
+        self.assertEqual(self.shell.shell_queue,[])
+        self.assertFalse(self.pool.busy())
+    def flush_shell_test(self):
+        engine = Engine(workers=2)
+        self.shell.add_shell(["echo","a"],self.upload,{'name':'a'})
+        engine.wait(self.shell.flush_shell(engine))
+        engine.close()
+        self.assertEqual(self.log,[('a',0,"a\n"),('c',0,"c\n")])